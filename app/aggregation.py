@@ -0,0 +1,94 @@
+"""In-memory ingredient matrix for computing grocery list totals."""
+
+from models import db, RecipeIngredient, Ingredient, Conversion, Category
+from catalog import current_catalog_version
+from array import array
+from threading import Lock
+
+
+class IngredientMatrix():
+    """
+    Sparse recipe x ingredient matrix in compressed row form.
+    Each recipe owns the slice rows[recipe_id] of indices/values,
+    where indices point into keys (food_name, unit_to, category_label)
+    and values hold quantity * conversion_factor for one serving batch.
+    """
+    def __init__(self, entries, version):
+        self.version = version
+        self.keys = []
+        self.rows = {}
+        self.indices = array('l')
+        self.values = array('d')
+        key_positions = {}
+        by_recipe = {}
+        for recipe_id, food_name, unit, label, quantity in entries:
+            key = (food_name, unit, label)
+            if key not in key_positions:
+                key_positions[key] = len(self.keys)
+                self.keys.append(key)
+            row = by_recipe.setdefault(recipe_id, {})
+            position = key_positions[key]
+            row[position] = row.get(position, 0.0) + float(quantity)
+        for recipe_id in sorted(by_recipe):
+            start = len(self.indices)
+            for position, value in sorted(by_recipe[recipe_id].items()):
+                self.indices.append(position)
+                self.values.append(value)
+            self.rows[recipe_id] = (start, len(self.indices))
+
+    @classmethod
+    def build(cls, version):
+        entries = db.session \
+                .query(RecipeIngredient.recipe_id,
+                       Ingredient.food_name,
+                       Conversion.unit_to,
+                       Category.category_label,
+                       RecipeIngredient.quantity * Conversion.conversion_factor) \
+                .join(Ingredient, RecipeIngredient.ingredient_id == Ingredient.id) \
+                .join(Conversion, Ingredient.conversion_id == Conversion.id) \
+                .join(Category, Ingredient.category_id == Category.id) \
+                .all()
+        return cls(entries, version)
+
+    def totals(self, recipe_quantities):
+        """
+        Multiplies the sparse vector {recipe_id: quantity} by the matrix.
+        Returns rows shaped like Cart.query_ingredient_quantities:
+        (food_name, unit, total, category_label), ordered by
+        category label then lower-cased food name.
+        """
+        sums = {}
+        for recipe_id, quantity in recipe_quantities.items():
+            if recipe_id not in self.rows:
+                continue
+            quantity = float(quantity)
+            start, end = self.rows[recipe_id]
+            for j in range(start, end):
+                position = self.indices[j]
+                sums[position] = sums.get(position, 0.0) + quantity * self.values[j]
+        totals = [(self.keys[position][0], self.keys[position][1], total, self.keys[position][2])
+                  for position, total in sums.items()]
+        return sorted(totals, key=lambda row: (row[3], row[0].lower()))
+
+
+_matrix = None
+_lock = Lock()
+
+
+def get_ingredient_matrix(check_interval):
+    """
+    Returns the current IngredientMatrix, rebuilding it
+    when the catalog version stamp has been bumped.
+    Returns None if the stamp cannot be read, so that callers
+    fall back to the SQL aggregation.
+    """
+    global _matrix
+    version = current_catalog_version(check_interval)
+    if version is None:
+        return None
+    if _matrix is not None and _matrix.version == version:
+        return _matrix
+    with _lock:
+        if _matrix is None or _matrix.version != version:
+            _matrix = IngredientMatrix.build(version)
+        return _matrix
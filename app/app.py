@@ -1,10 +1,21 @@
-from flask import Flask, request, redirect, render_template, jsonify, flash, session, g, url_for
-from models import db, connect_db, Recipe, Ingredient, Category, RecipeIngredient, Step, User, Favorite, Cart, RecipeCart, Conversion
-from sqlalchemy import func
+from flask import Flask, request, redirect, render_template, jsonify, flash, session, g, url_for, abort, make_response
+from models import db, connect_db, statement_timeout, Recipe, Ingredient, Category, RecipeIngredient, Step, User, Favorite, Cart, RecipeCart, Conversion, recipe_overlay
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
 from functools import wraps
 from forms import CartAddForm, UserAddForm, LoginForm
-from sqlalchemy.exc import IntegrityError, InvalidRequestError
+from sqlalchemy.exc import IntegrityError, OperationalError, TimeoutError as PoolTimeoutError
 from collections import defaultdict
+from cache import TTLCache, LRUCache
+from pagination import keyset_paginate, keyset_paginate_list
+from catalog import get_facet_index, current_catalog_version
+from aggregation import get_ingredient_matrix
+from flask_sqlalchemy import Pagination
+from commands import register_commands
+from pooling import engine_options
+from instrumentation import init_instrumentation, Metrics
+import hmac
+import json
 import os
 
 CURR_USER_KEY = "curr_user"
@@ -15,12 +26,63 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgresql:///recipe'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
+# Pool sizing, recycling, pre-ping and pgbouncer support, see pooling.py.
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(os.environ)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'my-secret')
 app.config['RECIPES_PER_PAGE'] = 40
+app.config['CART_HISTORY_PER_PAGE'] = 12
+app.config['CART_BATCH_MAX_OPERATIONS'] = 100
+app.config['OVERLAY_MAX_RECIPES'] = 200
+# 'sql' aggregates grocery lists with a join in Postgres,
+# 'matrix' multiplies cart quantities by an in-memory ingredient matrix.
+app.config['CHECKOUT_ENGINE'] = os.environ.get('CHECKOUT_ENGINE', 'sql')
+# Milliseconds before the SQL grocery list aggregation is cancelled (0 for no limit).
+app.config['GROCERY_LIST_STATEMENT_TIMEOUT'] = int(os.environ.get('GROCERY_LIST_STATEMENT_TIMEOUT', 5000))
+# 'offset' numbers pages with LIMIT/OFFSET plus a COUNT query,
+# 'keyset' seeks on Recipe.id with opaque cursors and no COUNT.
+app.config['RECIPES_PAGINATION'] = os.environ.get('RECIPES_PAGINATION', 'offset')
+# Answer /recipes filters from an in-memory facet index instead of SQL.
+# The catalog version stamp is re-checked every CATALOG_VERSION_CHECK_SECONDS.
+app.config['RECIPES_FACET_INDEX'] = os.environ.get('RECIPES_FACET_INDEX', '1') == '1'
+app.config['CATALOG_VERSION_CHECK_SECONDS'] = int(os.environ.get('CATALOG_VERSION_CHECK_SECONDS', 30))
+# Recipe detail cache: 'memory' (per worker) or 'sqlite' (file shared by workers on a host).
+app.config['RECIPE_CACHE_BACKEND'] = os.environ.get('RECIPE_CACHE_BACKEND', 'memory')
+app.config['RECIPE_CACHE_SIZE'] = int(os.environ.get('RECIPE_CACHE_SIZE', 512))
+app.config['RECIPE_CACHE_PATH'] = os.environ.get('RECIPE_CACHE_PATH', 'recipe_cache.sqlite')
+# Render /recipes card grids once for all users and cache them (same backends as above);
+# per-user cart and favorite state is then filled in by app.js from /api/overlay.
+app.config['RECIPE_GRID_SHARED'] = os.environ.get('RECIPE_GRID_SHARED', '0') == '1'
+app.config['RECIPE_GRID_CACHE_BACKEND'] = os.environ.get('RECIPE_GRID_CACHE_BACKEND', 'memory')
+app.config['RECIPE_GRID_CACHE_SIZE'] = int(os.environ.get('RECIPE_GRID_CACHE_SIZE', 256))
+app.config['RECIPE_GRID_CACHE_PATH'] = os.environ.get('RECIPE_GRID_CACHE_PATH', 'recipe_grid_cache.sqlite')
+# Seconds anonymous visitors and shared caches may reuse a /recipes page.
+app.config['RECIPE_GRID_MAX_AGE'] = int(os.environ.get('RECIPE_GRID_MAX_AGE', 60))
 app.config['IMAGE_PATH'] = os.environ.get('IMAGE_PATH', 'https://jt-springboard-recipe-bucket.s3-us-west-2.amazonaws.com')
-
+# Serve card/hero size derivatives via srcset; enable once data/scraping/images.py has generated them.
+app.config['IMAGE_SRCSET'] = os.environ.get('IMAGE_SRCSET', '0') == '1'
+app.config['SESSION_STATE_TTL'] = int(os.environ.get('SESSION_STATE_TTL', 5))
+# Per-request SQL, render and bcrypt timings, see instrumentation.py.
+# Requests issuing more than QUERY_BUDGET statements are logged (0 disables).
+# /admin/metrics is served only to requests bearing METRICS_TOKEN.
+app.config['INSTRUMENTATION'] = os.environ.get('INSTRUMENTATION', '1') == '1'
+app.config['SERVER_TIMING'] = os.environ.get('SERVER_TIMING', '1') == '1'
+app.config['QUERY_BUDGET'] = int(os.environ.get('QUERY_BUDGET', 20))
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# No database work happens at import: the engine and its connection pool
+# are created on first use, and the schema is created by `flask create-db`.
 connect_db(app)
-db.create_all()
+register_commands(app)
+request_metrics = Metrics()
+init_instrumentation(app, request_metrics)
+
+session_state_cache = TTLCache(app.config['SESSION_STATE_TTL'])
+recipe_detail_cache = LRUCache.from_config(app.config['RECIPE_CACHE_BACKEND'],
+                                           app.config['RECIPE_CACHE_SIZE'],
+                                           app.config['RECIPE_CACHE_PATH'])
+recipe_grid_cache = LRUCache.from_config(app.config['RECIPE_GRID_CACHE_BACKEND'],
+                                         app.config['RECIPE_GRID_CACHE_SIZE'],
+                                         app.config['RECIPE_GRID_CACHE_PATH'])
 
 def login_required(f):
     @wraps(f)
@@ -31,26 +93,69 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def _snapshot(instance):
+    """
+    Copies the column values of a loaded model instance
+    so it can outlive the session it was loaded in.
+    """
+    mapper = inspect(instance).mapper
+    return (mapper.class_, {attr.key: getattr(instance, attr.key) for attr in mapper.column_attrs})
+
+def _restore(snapshot):
+    """
+    Attaches a snapshotted instance to the current session
+    without emitting a SELECT.
+    """
+    model, values = snapshot
+    instance = model(**values)
+    make_transient_to_detached(instance)
+    return db.session.merge(instance, load=False)
+
+def invalidate_session_state(user_id):
+    session_state_cache.invalidate(user_id)
+
 @app.before_request
-def add_user_to_g():
-    if CURR_USER_KEY in session:
-        user = User.query.filter_by(id=session[CURR_USER_KEY]).first()
-        if user:
-            g.user = user
-        else:
-            del session[CURR_USER_KEY]
-    else:
-        g.user = None
-@app.before_request
-def add_cart_to_g():
-    if CURR_CART_KEY in session:
-        cart = Cart.query.filter_by(id=session[CURR_CART_KEY]).first()
-        if cart:
-            g.cart = cart
-        else:
+def load_session_state():
+    """
+    Sets g.user and g.cart from the ids stored in the session.
+    Both are resolved in a single query and cached per process
+    for SESSION_STATE_TTL seconds, keyed by user id.
+    """
+    g.user = None
+    g.cart = None
+    if CURR_USER_KEY not in session:
+        if CURR_CART_KEY in session:
             del session[CURR_CART_KEY]
+        return
+    user_id = session[CURR_USER_KEY]
+    cart_id = session.get(CURR_CART_KEY)
+
+    cached = session_state_cache.get(user_id)
+    if cached and cached[0] == cart_id:
+        _, user_snapshot, cart_snapshot = cached
+        g.user = _restore(user_snapshot)
+        g.cart = _restore(cart_snapshot) if cart_snapshot else None
+        return
+
+    if cart_id is None:
+        user, cart = User.query.get(user_id), None
     else:
-        g.cart = None
+        row = db.session.query(User, Cart) \
+                .outerjoin(Cart, Cart.id == cart_id) \
+                .filter(User.id == user_id) \
+                .first()
+        user, cart = row if row else (None, None)
+
+    if not user:
+        del session[CURR_USER_KEY]
+        clear_active_cart()
+        return
+    if cart_id is not None and not cart:
+        clear_active_cart()
+        cart_id = None
+    g.user = user
+    g.cart = cart
+    session_state_cache.set(user_id, (cart_id, _snapshot(user), _snapshot(cart) if cart else None))
 
 def create_cart(name=None):
     """
@@ -62,6 +167,7 @@ def create_cart(name=None):
     db.session.commit()
     session[CURR_CART_KEY] = new_cart.id
     g.cart = new_cart
+    invalidate_session_state(g.user.id)
 
 def make_cart_active(cart):
     session[CURR_CART_KEY] = cart.id
@@ -76,6 +182,7 @@ def do_login(user):
 def do_logout():
 
     if CURR_USER_KEY in session:
+        invalidate_session_state(session[CURR_USER_KEY])
         del session[CURR_USER_KEY]
     clear_active_cart()
 
@@ -83,10 +190,41 @@ def floatToString(value):
     result = '{0:.2f}'.format(value).rstrip('0').rstrip('.')
     return '0' if result == '-0' else result
 
+def group_by_category(totals):
+    """
+    Groups (name, unit, qty, category label) rows, already ordered
+    by category, into the structure carts/checkout.html expects.
+    """
+    ingr_grouped_by_category = defaultdict(list)
+    for name,unit,qty,label in totals:
+        ingr_grouped_by_category[label].append((name.lower(), unit.lower(), floatToString(qty)))
+    return [{'category':k, 'ingredients':v} for k,v in ingr_grouped_by_category.items()]
+
 @app.context_processor
 def utility_processor():
     return dict(floatToString=floatToString,
-                image_path=app.config['IMAGE_PATH'])
+                image_path=app.config['IMAGE_PATH'],
+                image_srcset=app.config['IMAGE_SRCSET'])
+
+@app.errorhandler(PoolTimeoutError)
+@app.errorhandler(OperationalError)
+def database_busy(error):
+    """
+    Answers 503 with Retry-After when no pooled connection frees up in
+    time or a statement hits its statement_timeout (SQLSTATE 57014),
+    instead of holding the worker any longer.
+    """
+    if isinstance(error, OperationalError) and getattr(error.orig, 'pgcode', None) != '57014':
+        raise error
+    db.session.rollback()
+    message = 'The server is busy, please try again in a moment.'
+    if request.path.startswith('/api/'):
+        response = jsonify({"message": message})
+    else:
+        response = make_response(message)
+    response.status_code = 503
+    response.headers['Retry-After'] = '5'
+    return response
 ############################################################################
 @app.route('/')
 def home():
@@ -95,6 +233,24 @@ def home():
 @app.route('/about')
 def about():
     return render_template('about.html')
+
+def metrics_authorized():
+    """Checks the request for an 'Authorization: Bearer <METRICS_TOKEN>' header."""
+    token = app.config['METRICS_TOKEN']
+    return bool(token) and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+
+@app.route('/admin/metrics')
+def admin_metrics():
+    """
+    Returns this process's per-endpoint timing histograms as JSON.
+    Requires an 'Authorization: Bearer <METRICS_TOKEN>' header;
+    answers 404 when no token is configured.
+    """
+    if not metrics_authorized():
+        abort(404)
+    if request.args.get('reset'):
+        request_metrics.reset()
+    return jsonify(request_metrics.snapshot())
 ############################################################################
 # Auth Routes
 ############################################################################
@@ -156,72 +312,145 @@ def logout():
 ##############################################################################
 # Recipe Routes
 ##############################################################################
+def find_recipes(filter_args, page):
+    """
+    Returns (page of recipes, page number, next url, prev url, facet counts)
+    for the /recipes filters in filter_args.
+    """
+    category, time, difficulty, spice = (filter_args[name] for name in ('category', 'time', 'difficulty', 'spice'))
+    favorites_only = filter_args['faves']
+    keyset = app.config['RECIPES_PAGINATION'] == 'keyset'
+    per_page = app.config['RECIPES_PER_PAGE']
+
+    facet_index = get_facet_index(app.config['CATALOG_VERSION_CHECK_SECONDS']) \
+        if app.config['RECIPES_FACET_INDEX'] else None
+    filters = facet_index.parse_filters(category, time, difficulty, spice) if facet_index else None
+    facet_counts = None
+    if filters is not None:
+        within = facet_index.mask_for_ids(Favorite.recipe_ids(g.user.id)) if (g.user and favorites_only) else None
+        facet_counts = facet_index.counts(filters, within)
+        cards = facet_index.select(facet_index.filter(filters, within))
+        if keyset:
+            recipes = keyset_paginate_list(cards, [card.id for card in cards], request.args.get('cursor'), per_page)
+        else:
+            page = max(page, 1)
+            offset = (page - 1) * per_page
+            recipes = Pagination(None, page, per_page, len(cards), cards[offset:offset + per_page])
+    else:
+        recipes_query = Recipe.query
+        if category not in [None, '']:
+            recipes_query = recipes_query.filter_by(category=category)
+        if not time == None:
+            recipes_query = recipes_query.filter(Recipe.prep_time <= time)
+        if difficulty not in [None, '']:
+            recipes_query = recipes_query.filter_by(difficulty=difficulty)
+        if spice not in [None, '']:
+            recipes_query = recipes_query.filter_by(spice_level=spice)
+        if g.user and favorites_only:
+            recipes_query = recipes_query.filter(Favorite.favorited_by(g.user.id))
+        if keyset:
+            recipes = keyset_paginate(recipes_query, Recipe.id, request.args.get('cursor'), per_page)
+        else:
+            recipes_query = recipes_query.order_by(Recipe.id)
+            recipes = recipes_query.paginate(page, per_page, False)
+
+    if keyset:
+        page = recipes.page
+        next_url = url_for('index_recipes', cursor=recipes.next_cursor, **filter_args) \
+            if recipes.has_next else None
+        prev_url = url_for('index_recipes', cursor=recipes.prev_cursor, **filter_args) \
+            if recipes.has_prev else None
+    else:
+        next_url = url_for('index_recipes', page=recipes.next_num, **filter_args) \
+            if recipes.has_next else None
+        prev_url = url_for('index_recipes', page=recipes.prev_num, **filter_args) \
+            if recipes.has_prev else None
+    return recipes, page, next_url, prev_url, facet_counts
+
 @app.route('/recipes')
 def index_recipes():
     """
     Show paginated index of recipes in database.
     Recipes can be filtered by protein category, prep time, difficulty,
     spice level and whether favorited by current user.
+    With RECIPE_GRID_SHARED the recipe cards are rendered without any
+    per-user state and cached by filters, page and catalog version, and
+    app.js fetches the cart and favorites state from /api/overlay.
+    Pages served to anonymous users are then publicly cacheable.
     """
-    recipes_query = Recipe.query
     page = request.args.get('page', 1, type=int)
     category = request.args.get('category')
-    if category not in [None, '']:
-        recipes_query = recipes_query.filter_by(category=category)
     time = request.args.get('time',60)
-    if not time == None:
-        recipes_query = recipes_query.filter(Recipe.prep_time <= time)
     difficulty = request.args.get('difficulty')
-    if difficulty not in [None, '']:
-        recipes_query = recipes_query.filter_by(difficulty=difficulty)
     spice = request.args.get('spice')
-    if spice not in [None, '']:
-        recipes_query = recipes_query.filter_by(spice_level=spice)
-
     favorites_only = request.args.get('faves')
-    if g.user:
-        favorites = [recipe.id for recipe in g.user.favorites]
-        if favorites_only:
-            recipes_query = recipes_query.filter(Recipe.id.in_(favorites))
-    else:
-        favorites = []
-    recipes_query = recipes_query.order_by(Recipe.id)
-    recipes = recipes_query.paginate(page,app.config['RECIPES_PER_PAGE'], False)
-
-    next_url = url_for('index_recipes', 
-                        category=category,
-                        time=time,
-                        difficulty=difficulty,
-                        spice=spice,
-                        faves=favorites_only,
-                        page=recipes.next_num) \
-        if recipes.has_next else None
-    prev_url = url_for('index_recipes', 
-                        category=category,
-                        time=time,
-                        difficulty=difficulty,
-                        spice=spice,
-                        faves=favorites_only,
-                        page=recipes.prev_num) \
-        if recipes.has_prev else None
-    if g.cart:
-        recipes_in_cart = RecipeCart.query.filter(RecipeCart.cart_id == g.cart.id).all()
-        recipes_in_cart = [entry.recipe_id for entry in recipes_in_cart]
-    else:
-        recipes_in_cart = []
-
-    return render_template('recipes/index.html', 
-                            recipes=recipes.items,
-                            recipes_in_cart=recipes_in_cart,
-                            favorites=favorites, 
-                            category=category, 
-                            difficulty=difficulty, 
-                            spice=spice, 
-                            time=time,
-                            faves=favorites_only,
-                            page=page,
-                            next_url=next_url,
-                            prev_url=prev_url)
+    filter_args = dict(category=category,
+                       time=time,
+                       difficulty=difficulty,
+                       spice=spice,
+                       faves=favorites_only)
+
+    # A user's favorites only page is personal and never shared
+    shared = app.config['RECIPE_GRID_SHARED'] and not (g.user and favorites_only)
+    version = current_catalog_version(app.config['CATALOG_VERSION_CHECK_SECONDS']) if shared else None
+    entry = None
+    if version is not None:
+        keyset = app.config['RECIPES_PAGINATION'] == 'keyset'
+        cache_key = json.dumps([version,
+                                [app.config[name] for name in ('RECIPES_PAGINATION', 'RECIPES_PER_PAGE',
+                                                               'RECIPES_FACET_INDEX', 'IMAGE_SRCSET')],
+                                filter_args, request.args.get('cursor') if keyset else page], sort_keys=True)
+        entry = recipe_grid_cache.get(cache_key)
+    if entry is None:
+        recipes, page, next_url, prev_url, facet_counts = find_recipes(filter_args, page)
+        # Cart icons and hearts are only needed for the recipes on this page
+        if g.user and not shared:
+            recipes_in_cart, favorites = recipe_overlay(g.user.id, g.cart.id if g.cart else None,
+                                                        [recipe.id for recipe in recipes.items])
+        else:
+            recipes_in_cart, favorites = set(), set()
+        grid = render_template('recipes/grid.html',
+                               recipes=recipes.items,
+                               recipes_in_cart=recipes_in_cart,
+                               favorites=favorites,
+                               hydrate=shared,
+                               page=page,
+                               next_url=next_url,
+                               prev_url=prev_url)
+        entry = {'grid': grid, 'facet_counts': facet_counts}
+        if version is not None:
+            recipe_grid_cache.set(cache_key, entry)
+
+    response = make_response(render_template('recipes/index.html',
+                                             grid=entry['grid'],
+                                             category=category,
+                                             difficulty=difficulty,
+                                             spice=spice,
+                                             time=time,
+                                             faves=favorites_only,
+                                             facet_counts=entry['facet_counts']))
+    # Anything written to the session would leak through a shared cache
+    if shared and not g.user and not session.modified and '_flashes' not in session:
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['RECIPE_GRID_MAX_AGE']
+        response.add_etag()
+        response = response.make_conditional(request)
+    return response
+
+def prepare_recipe_detail(recipe_id):
+    """
+    Loads everything the recipe detail page needs as plain,
+    JSON serializable data so it can be cached.
+    Returns None if the recipe does not exist.
+    """
+    recipe = Recipe.query.get(recipe_id)
+    if not recipe:
+        return None
+    steps = Step.query.filter_by(recipe_id=recipe_id).order_by(Step.step_number).all()
+    ingredients = recipe.contents().all()
+    return {'recipe': dict(recipe.serialize(), servings=recipe.servings, image=recipe.image),
+            'steps': [{'description': step.description} for step in steps],
+            'ingredients': [(floatToString(qty), ingr.unit.lower(), ingr.food_name.lower()) for qty, ingr in ingredients]}
 
 @app.route('/recipes/<int:recipe_id>')
 def show_recipe(recipe_id):
@@ -229,12 +458,59 @@ def show_recipe(recipe_id):
     Show detailed information on recipe.
     Includes recipe ingredients and directions not seen
     in recipe index thumbnail.
+    Prepared details are cached per recipe and catalog version, and
+    rendered uncached when the version cannot be read.
     """
-    recipe = Recipe.query.get_or_404(recipe_id)
-    steps = Step.query.filter_by(recipe_id=recipe_id).order_by(Step.step_number).all()
-    ingredients = recipe.contents().all()
-    ingredients = [(floatToString(qty), ingr.unit.lower(), ingr.food_name.lower()) for qty, ingr in ingredients]
-    return render_template('recipes/show.html', recipe=recipe, steps=steps, ingredients=ingredients)
+    version = current_catalog_version(app.config['CATALOG_VERSION_CHECK_SECONDS'])
+    cache_key = f'{recipe_id}:{version}'
+    detail = recipe_detail_cache.get(cache_key) if version is not None else None
+    if detail is None:
+        detail = prepare_recipe_detail(recipe_id)
+        if detail is None:
+            abort(404)
+        if version is not None:
+            recipe_detail_cache.set(cache_key, detail)
+    return render_template('recipes/show.html', **detail)
+
+@app.route('/api/cache/stats')
+def cache_stats():
+    """
+    API route reporting hit/miss counters of this worker's caches.
+    Requires the METRICS_TOKEN, like /admin/metrics.
+    """
+    if not metrics_authorized():
+        abort(404)
+    return jsonify({"recipe_detail": recipe_detail_cache.stats(),
+                    "recipe_grid": recipe_grid_cache.stats()})
+
+@app.route('/api/overlay')
+def overlay():
+    """
+    API route returning the current user's per-recipe state: which
+    recipes are in the active cart and which are favorited. Pass ids
+    as a comma separated list to only ask about those recipes.
+    Anonymous users get empty lists, so pages can be shared by everyone
+    and personalized afterwards.
+    """
+    ids = request.args.get('ids')
+    try:
+        recipe_ids = None if ids is None else [int(recipe_id) for recipe_id in ids.split(',') if recipe_id]
+    except ValueError:
+        return jsonify({"message": "ids must be a comma separated list of recipe ids."}), 400
+    if recipe_ids is not None and len(recipe_ids) > app.config['OVERLAY_MAX_RECIPES']:
+        return jsonify({"message": f"At most {app.config['OVERLAY_MAX_RECIPES']} ids can be requested."}), 400
+
+    if g.user:
+        in_cart, favorites = recipe_overlay(g.user.id, g.cart.id if g.cart else None, recipe_ids)
+    else:
+        in_cart, favorites = set(), set()
+    response = jsonify({"user": g.user.id if g.user else None,
+                        "cart_id": g.cart.id if g.cart else None,
+                        "cart": sorted(in_cart),
+                        "favorites": sorted(favorites)})
+    response.cache_control.private = True
+    response.cache_control.no_store = True
+    return response
 
 @app.route('/api/recipes/<int:recipe_id>/add-to-cart', methods=['POST'])
 def add_to_cart(recipe_id):
@@ -247,16 +523,53 @@ def add_to_cart(recipe_id):
     recipe = Recipe.query.get_or_404(recipe_id)
     if not g.cart:
         create_cart()
-    recipe_cart = RecipeCart.query.filter(RecipeCart.recipe_id == recipe_id, RecipeCart.cart_id == g.cart.id).first()
-    if recipe_cart:
-        recipe_cart.quantity = recipe_cart.quantity + 1
-    else:
-        recipe_cart = RecipeCart(recipe_id=recipe_id, cart_id=g.cart.id, quantity=1)
-    db.session.add(recipe_cart)
+    quantities = RecipeCart.apply_deltas(g.cart.id, {recipe_id: 1})
+    Cart.bump_revision(g.cart.id)
     db.session.commit()
+    recipe_cart = RecipeCart(recipe_id=recipe_id, cart_id=g.cart.id, quantity=quantities[recipe_id])
     return jsonify({"message": f'Recipe {recipe.id} added to cart',
         "data":recipe_cart.serialize()}), 202
 
+@app.route('/api/carts/batch', methods=['POST'])
+def batch_update_cart():
+    """
+    API route applying several quantity changes to the current user cart
+    in one transaction. Expects JSON of the form
+    {"operations": [{"recipe_id": 1, "delta": 2}, ...]}.
+    Recipes whose quantity drops to zero are removed from the cart.
+    Will return an error if user is not logged in, the operations are
+    malformed or any recipe does not exist.
+    """
+    if not g.user:
+        return jsonify({"message": "Access Unauthorized: You must be logged in."}), 401
+    operations = (request.get_json(silent=True) or {}).get('operations')
+    if not isinstance(operations, list) or not 0 < len(operations) <= app.config['CART_BATCH_MAX_OPERATIONS']:
+        return jsonify({"message": "Expected a non-empty list of operations."}), 400
+    deltas = defaultdict(int)
+    for operation in operations:
+        recipe_id = operation.get('recipe_id') if isinstance(operation, dict) else None
+        delta = operation.get('delta', 1) if isinstance(operation, dict) else None
+        if type(recipe_id) is not int or type(delta) is not int:
+            return jsonify({"message": "Each operation needs an integer recipe_id and delta."}), 400
+        deltas[recipe_id] += delta
+    deltas = {recipe_id: delta for recipe_id, delta in deltas.items() if delta}
+    # Nothing changes when the operations cancel out or only take recipes out of a missing cart
+    if not deltas or (not g.cart and all(delta < 0 for delta in deltas.values())):
+        return jsonify({"message": "0 cart item(s) updated", "data": []}), 200
+
+    found = {recipe_id for recipe_id, in db.session.query(Recipe.id).filter(Recipe.id.in_(list(deltas)))}
+    missing = sorted(set(deltas) - found)
+    if missing:
+        return jsonify({"message": f'Recipes not found: {missing}'}), 404
+    if not g.cart:
+        create_cart()
+    quantities = RecipeCart.apply_deltas(g.cart.id, deltas)
+    Cart.bump_revision(g.cart.id)
+    db.session.commit()
+    return jsonify({"message": f'{len(quantities)} cart item(s) updated',
+        "data":[RecipeCart(recipe_id=recipe_id, cart_id=g.cart.id, quantity=quantity).serialize()
+                for recipe_id, quantity in quantities.items()]}), 202
+
 @app.route('/api/recipes/<int:recipe_id>/favorite', methods=['POST'])
 def favorite_recipe(recipe_id):
     """
@@ -267,8 +580,7 @@ def favorite_recipe(recipe_id):
     if not g.user:
         return jsonify({"message": "Access Unauthorized: You must be logged in."}), 401
     recipe = Recipe.query.get_or_404(recipe_id)
-    if not recipe in g.user.favorites:
-        db.session.add(Favorite(user_id=g.user.id, recipe_id=recipe_id))
+    if Favorite.add(g.user.id, recipe_id):
         db.session.commit()
         return jsonify({"message": f'Recipe {recipe_id} favorited.',
         "data":recipe.serialize()}), 202
@@ -284,9 +596,7 @@ def unfavorite_recipe(recipe_id):
     """
     if not g.user:
         return jsonify({"message": "Access Unauthorized: You must be logged in."}), 401
-    favorite = Favorite.query.filter(Favorite.user_id == g.user.id, Favorite.recipe_id == recipe_id).first()
-    if favorite:
-        db.session.delete(favorite)
+    if Favorite.remove(g.user.id, recipe_id):
         db.session.commit()
         return jsonify({"message": f'Recipe {recipe_id} unfavorited.'}), 202
     else:
@@ -308,13 +618,33 @@ def index_carts():
     if g.cart:
         carts_query = carts_query.filter(Cart.id != g.cart.id)
 
-        curr_cart_recipes = g.cart.query_contents().all()
-    else:
-        curr_cart_recipes = []
-
-    complete_carts = [(cart, cart.query_contents().all()) for cart in carts_query.filter(Cart.is_complete == True).all()]
-    incomplete_carts = [(cart, cart.query_contents().all()) for cart in carts_query.filter(Cart.is_complete == False).all()]
-    return render_template('carts/index.html', complete_carts=complete_carts, incomplete_carts=incomplete_carts, curr_cart_recipes=curr_cart_recipes)
+    history_page = max(request.args.get('history_page', 1, type=int), 1)
+    per_page = app.config['CART_HISTORY_PER_PAGE']
+    incomplete = carts_query.filter(Cart.is_complete == False).order_by(Cart.id).all()
+    complete = carts_query.filter(Cart.is_complete == True) \
+                          .order_by(Cart.id.desc()) \
+                          .offset((history_page - 1) * per_page) \
+                          .limit(per_page + 1) \
+                          .all()
+    has_older_history = len(complete) > per_page
+    complete = complete[:per_page]
+
+    cart_ids = [cart.id for cart in incomplete + complete]
+    if g.cart:
+        cart_ids.append(g.cart.id)
+    contents = Cart.contents_by_cart(cart_ids)
+
+    curr_cart_recipes = contents[g.cart.id] if g.cart else []
+    complete_carts = [(cart, contents[cart.id]) for cart in complete]
+    incomplete_carts = [(cart, contents[cart.id]) for cart in incomplete]
+    older_history_url = url_for('index_carts', history_page=history_page + 1) if has_older_history else None
+    newer_history_url = url_for('index_carts', history_page=history_page - 1) if history_page > 1 else None
+    return render_template('carts/index.html',
+                            complete_carts=complete_carts,
+                            incomplete_carts=incomplete_carts,
+                            curr_cart_recipes=curr_cart_recipes,
+                            older_history_url=older_history_url,
+                            newer_history_url=newer_history_url)
 
 @app.route('/carts/new', methods=['GET', 'POST'])
 @login_required
@@ -348,6 +678,7 @@ def edit_cart(cart_id):
         cart.name = name
         db.session.add(cart)
         db.session.commit()
+        invalidate_session_state(g.user.id)
         flash(f'Active cart name changed to {cart.name}', 'success')
     else:
         flash('Carts must have a name', 'danger')
@@ -360,20 +691,44 @@ def copy_cart(cart_id):
     Copies content of specified cart.
     Creates a new cart with name "<old_cart_name> (Copy)" and
     sets recipes and associated quantities to match those of the
-    old cart.
+    old cart, in a single transaction.
     The new cart is set to g.cart. User must be logged in.
     Redirects to cart index.
     """
     cart = Cart.query.get_or_404(cart_id)
-    recipe_cart = RecipeCart.query.filter(RecipeCart.cart_id == cart_id)
-    recipe_qtys = [(item.recipe_id, item.quantity) for item in recipe_cart]
-    create_cart(name=f'{cart.name}(copy)')
-    for recipe_id, qty in recipe_qtys:
-        db.session.add(RecipeCart(recipe_id=recipe_id, quantity=qty, cart_id=g.cart.id))
+    if not cart.user_id == g.user.id:
+        flash('Access unauthorized', 'danger')
+        return redirect(url_for('index_carts'))
+    new_cart = Cart.copy(cart.id, name=f'{cart.name}(copy)', user_id=g.user.id)
     db.session.commit()
+    make_cart_active(new_cart)
+    invalidate_session_state(g.user.id)
     flash(f'Cart "{cart.name}" successfully copied.', 'success')
     return redirect(url_for('index_carts'))
-    
+
+@app.route('/carts/<int:cart_id>/merge', methods=['POST'])
+@login_required
+def merge_cart(cart_id):
+    """
+    Adds the recipes and quantities of specified cart to the
+    current cart (g.cart) in a single INSERT ... SELECT.
+    Both carts must belong to current user. User must be logged in.
+    Redirects to cart index.
+    """
+    cart = Cart.query.get_or_404(cart_id)
+    if not cart.user_id == g.user.id:
+        flash('Access unauthorized', 'danger')
+    elif not g.cart:
+        flash('Activate a cart to merge recipes into', 'danger')
+    elif cart.id == g.cart.id:
+        flash('A cart cannot be merged into itself', 'danger')
+    else:
+        RecipeCart.copy_contents(cart.id, g.cart.id)
+        Cart.bump_revision(g.cart.id)
+        db.session.commit()
+        flash(f'Recipes from "{cart.name}" added to "{g.cart.name}".', 'success')
+    return redirect(url_for('index_carts'))
+
 @app.route('/carts/<int:cart_id>/activate', methods=['POST'])
 @login_required
 def activate_cart(cart_id):
@@ -407,6 +762,7 @@ def delete_cart(cart_id):
             clear_active_cart()
         db.session.delete(cart)
         db.session.commit()
+        invalidate_session_state(g.user.id)
         flash(f'Cart "{cart_name}" deleted.', 'success')
     else:
         flash('Access unauthorized', 'danger')
@@ -426,23 +782,129 @@ def checkout(cart_id):
     if not cart.user_id == g.user.id:
         flash('Forbidden Resource: Cart does not belong to user.')
         return redirect(url_for('index_carts'))
-    totals = cart.query_ingredient_quantities().all()
-
-    ingr_grouped_by_category = defaultdict(list)
-    for name,unit,qty,label in totals:
-        ingr_grouped_by_category[label].append((name.lower(), unit.lower(), floatToString(qty)))
-    
-    ingr_by_category = [{'category':k, 'ingredients':v} for k,v in ingr_grouped_by_category.items()]
+    ingr_by_category = group_by_category(ingredient_totals([cart.id]))
 
     cart.is_complete = True;
     db.session.add(cart)
     db.session.commit()
+    invalidate_session_state(g.user.id)
 
     if g.cart and (cart_id == g.cart.id):
         clear_active_cart()
     
     return render_template('carts/checkout.html', ingr_by_category=ingr_by_category, cart=cart)
 
+def ingredient_totals(cart_ids):
+    """
+    Returns the (food_name, unit, quantity, category) grocery list rows
+    for the recipes of the given carts, from the CHECKOUT_ENGINE.
+    """
+    matrix = get_ingredient_matrix(app.config['CATALOG_VERSION_CHECK_SECONDS']) \
+        if app.config['CHECKOUT_ENGINE'] == 'matrix' else None
+    if matrix is not None:
+        return matrix.totals(Cart.combined_recipe_quantities(cart_ids))
+    with statement_timeout(app.config['GROCERY_LIST_STATEMENT_TIMEOUT']):
+        return Cart.query_combined_ingredient_quantities(cart_ids).all()
+
+def grocery_list_response(cart_id, respond):
+    """
+    Builds a side-effect free, conditionally cacheable grocery list
+    response for one of the current user's carts.
+    The ETag combines the cart revision and catalog version, so
+    repeat views answer 304 before aggregating or rendering. When the
+    catalog version cannot be read the response is not conditional.
+    respond(cart, ingr_by_category) produces the response body.
+    """
+    cart = db.session.query(Cart.id, Cart.name, Cart.user_id, Cart.revision, Cart.updated_at) \
+            .filter(Cart.id == cart_id) \
+            .first_or_404()
+    if not cart.user_id == g.user.id:
+        return None
+    version = current_catalog_version(app.config['CATALOG_VERSION_CHECK_SECONDS'])
+    if version is None:
+        response = make_response(respond(cart, group_by_category(ingredient_totals([cart.id]))))
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+    etag = f'cart-{cart.id}-{cart.revision}-{version}'
+    last_modified = cart.updated_at.replace(microsecond=0)
+
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        not_modified = request.if_modified_since is not None and last_modified <= request.if_modified_since
+    if not_modified:
+        response = make_response('', 304)
+    else:
+        response = make_response(respond(cart, group_by_category(ingredient_totals([cart.id]))))
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/carts/<int:cart_id>/preview')
+@login_required
+def preview_checkout(cart_id):
+    """
+    Displays the grocery list of a cart without changing it.
+    Cart's user_id must match current user's. User must be logged in.
+    """
+    response = grocery_list_response(cart_id,
+        lambda cart, ingr_by_category: render_template('carts/checkout.html', ingr_by_category=ingr_by_category, cart=cart))
+    if response is None:
+        flash('Forbidden Resource: Cart does not belong to user.')
+        return redirect(url_for('index_carts'))
+    return response
+
+@app.route('/api/carts/<int:cart_id>/grocery-list')
+def grocery_list(cart_id):
+    """
+    API route returning a cart's aggregated grocery list as JSON
+    without changing the cart. Supports ETag/Last-Modified validation.
+    Will return an error if user is not logged in or does not own the cart.
+    """
+    if not g.user:
+        return jsonify({"message": "Access Unauthorized: You must be logged in."}), 401
+    response = grocery_list_response(cart_id,
+        lambda cart, ingr_by_category: jsonify({"cart": {"id": cart.id, "name": cart.name, "revision": cart.revision},
+                                                "ingr_by_category": ingr_by_category}))
+    if response is None:
+        return jsonify({"message": "Forbidden Resource: Cart does not belong to user."}), 403
+    return response
+
+@app.route('/carts/combined', methods=['GET', 'POST'])
+@login_required
+def combined_checkout():
+    """
+    Aggregates quantities of ingredients across several of the
+    current user's carts (cart_id may be repeated) into a single
+    grocery list, in one aggregation pass.
+    Carts are left as they are unless submitted via POST with
+    mark_complete set, which moves them all to completed (historical).
+    User must be logged in.
+    """
+    cart_ids = set(request.values.getlist('cart_id', type=int))
+    if not cart_ids:
+        flash('Select at least one cart', 'danger')
+        return redirect(url_for('index_carts'))
+    carts = Cart.query.filter(Cart.id.in_(cart_ids), Cart.user_id == g.user.id).order_by(Cart.id).all()
+    if len(carts) != len(cart_ids):
+        flash('Forbidden Resource: Cart does not belong to user.')
+        return redirect(url_for('index_carts'))
+
+    ingr_by_category = group_by_category(ingredient_totals(cart_ids))
+
+    if request.method == 'POST' and request.form.get('mark_complete'):
+        Cart.query.filter(Cart.id.in_(cart_ids)).update({Cart.is_complete: True}, synchronize_session=False)
+        db.session.commit()
+        invalidate_session_state(g.user.id)
+        if g.cart and g.cart.id in cart_ids:
+            clear_active_cart()
+
+    combined_cart = {'name': ' + '.join(cart.name for cart in carts)}
+    return render_template('carts/checkout.html', ingr_by_category=ingr_by_category, cart=combined_cart)
+
 @app.route('/carts/recipe/<int:recipe_id>', methods=['POST'])
 @login_required
 def edit_cart_item(recipe_id):
@@ -459,6 +921,7 @@ def edit_cart_item(recipe_id):
             quantity = int(request.form.get('quantity'))
             recipe_cart.quantity = quantity
             db.session.add(recipe_cart)
+            Cart.bump_revision(g.cart.id)
             db.session.commit()
             flash(f'Cart Recipe "{recipe_cart.recipe.title}" updated', 'success')
     else:
@@ -480,6 +943,7 @@ def delete_cart_item(recipe_id):
         else:
             recipe_title = recipe_cart.recipe.title
             db.session.delete(recipe_cart)
+            Cart.bump_revision(g.cart.id)
             db.session.commit()
             flash(f'Cart Recipe "{recipe_title}" removed.', 'success')
     else:
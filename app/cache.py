@@ -0,0 +1,172 @@
+"""Small in-process caches shared by the app."""
+
+from collections import OrderedDict
+from threading import Lock
+import sqlite3
+import os
+import json
+import time
+
+
+class TTLCache():
+    """
+    Dictionary-backed cache whose entries expire ttl seconds
+    after they were set. A ttl of 0 disables caching entirely.
+    Safe to share between threads of a single worker process.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class MemoryBackend():
+    """In-process LRU storage bounded to maxsize entries."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SqliteBackend():
+    """
+    LRU storage in a local sqlite file, so entries survive restarts
+    and are shared by every worker on the host.
+    Values must be JSON serializable.
+    """
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.maxsize = maxsize
+        self._lock = Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connection(self):
+        """
+        Returns the connection of the current process, opened on first
+        use. sqlite connections must not be carried across a fork, so a
+        forked worker opens its own rather than using the parent's.
+        Callers must hold the lock, which is what makes sharing the
+        connection between threads safe.
+        """
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS entries '
+                               '(key TEXT PRIMARY KEY, value TEXT NOT NULL, used INTEGER NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS ix_entries_used ON entries (used)')
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key):
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE entries SET used = (SELECT MAX(used) + 1 FROM entries) '
+                         'WHERE key = ?', (key,))
+            return json.loads(row[0])
+
+    def set(self, key, value):
+        with self._lock:
+            conn = self._connection()
+            conn.execute('INSERT OR REPLACE INTO entries (key, value, used) '
+                         'VALUES (?, ?, (SELECT COALESCE(MAX(used), 0) + 1 FROM entries))',
+                         (key, json.dumps(value)))
+            conn.execute('DELETE FROM entries WHERE key NOT IN '
+                         '(SELECT key FROM entries ORDER BY used DESC LIMIT ?)', (self.maxsize,))
+
+    def clear(self):
+        with self._lock:
+            self._connection().execute('DELETE FROM entries')
+
+    def __len__(self):
+        with self._lock:
+            return self._connection().execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+
+class LRUCache():
+    """
+    Size-bounded cache over a pluggable backend
+    that counts hits and misses.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls, backend, maxsize, path=None):
+        if backend == 'sqlite':
+            return cls(SqliteBackend(path, maxsize))
+        return cls(MemoryBackend(maxsize))
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"backend": type(self.backend).__name__,
+                "size": len(self.backend),
+                "maxsize": self.backend.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None}
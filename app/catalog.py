@@ -0,0 +1,196 @@
+"""In-process copy of the recipe catalog with a bitmap facet index."""
+
+from models import db, Recipe, CatalogVersion
+from sqlalchemy.exc import SQLAlchemyError
+from collections import namedtuple, defaultdict
+from bisect import bisect_right
+from threading import Lock
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+RecipeCard = namedtuple('RecipeCard', ['id', 'title', 'category', 'prep_time',
+                                       'difficulty', 'spice_level', 'servings', 'image'])
+
+# Maps the /recipes query parameter of each facet to its Recipe column.
+FACETS = {'category': 'category', 'difficulty': 'difficulty', 'spice': 'spice_level'}
+
+
+def popcount(mask):
+    return bin(mask).count('1')
+
+
+class FacetIndex():
+    """
+    Recipe cards ordered by id, with one bitmap per facet value.
+    Bit i of every mask refers to cards[i], so combining filters
+    is a bitwise AND of Python ints.
+    """
+    def __init__(self, cards, version):
+        self.version = version
+        self.cards = cards
+        self.ids = [card.id for card in cards]
+        self.positions = {card.id: i for i, card in enumerate(cards)}
+        self.all = (1 << len(cards)) - 1
+        self.masks = {param: defaultdict(int) for param in FACETS}
+        by_time = defaultdict(int)
+        for i, card in enumerate(cards):
+            for param, column in FACETS.items():
+                self.masks[param][getattr(card, column)] |= 1 << i
+            if card.prep_time is not None:
+                by_time[card.prep_time] |= 1 << i
+
+        # Prep time buckets hold cumulative masks, so that
+        # time_masks[j] covers every card with prep_time <= times[j].
+        self.times = sorted(by_time)
+        self.time_masks = []
+        cumulative = 0
+        for prep_time in self.times:
+            cumulative |= by_time[prep_time]
+            self.time_masks.append(cumulative)
+
+    @classmethod
+    def build(cls, version):
+        recipes = db.session.query(*[getattr(Recipe, field) for field in RecipeCard._fields]) \
+                    .order_by(Recipe.id).all()
+        return cls([RecipeCard(*recipe) for recipe in recipes], version)
+
+    @staticmethod
+    def parse_filters(category, time, difficulty, spice):
+        """
+        Converts the raw query parameters into facet values.
+        Returns None if a parameter cannot be answered from the index,
+        in which case the caller should fall back to SQL.
+        """
+        try:
+            return {'category': category or None,
+                    'difficulty': int(difficulty) if difficulty not in [None, ''] else None,
+                    'spice': int(spice) if spice not in [None, ''] else None,
+                    'time': int(time) if time is not None else None}
+        except ValueError:
+            return None
+
+    def mask_for_ids(self, ids):
+        mask = 0
+        for recipe_id in ids:
+            if recipe_id in self.positions:
+                mask |= 1 << self.positions[recipe_id]
+        return mask
+
+    def _time_mask(self, max_time):
+        if max_time is None:
+            return self.all
+        j = bisect_right(self.times, max_time)
+        return self.time_masks[j - 1] if j else 0
+
+    def filter(self, filters, within=None, skip=None):
+        """
+        Returns the mask of cards matching every filter.
+        within restricts the result to another mask (e.g. favorites),
+        skip leaves one facet unfiltered for facet counts.
+        """
+        mask = self.all if within is None else within
+        mask &= self._time_mask(filters['time'])
+        for param in FACETS:
+            if param != skip and filters[param] is not None:
+                mask &= self.masks[param].get(filters[param], 0)
+        return mask
+
+    def counts(self, filters, within=None):
+        """
+        Number of matching cards for each value of each facet,
+        given the filters on the other facets. '' holds the total.
+        """
+        counts = {}
+        for param in FACETS:
+            base = self.filter(filters, within, skip=param)
+            counts[param] = {str(value): popcount(base & mask)
+                             for value, mask in self.masks[param].items() if value is not None}
+            counts[param][''] = popcount(base)
+        return counts
+
+    def select(self, mask):
+        """Returns the cards in mask, ordered by id."""
+        cards = []
+        while mask:
+            low_bit = mask & -mask
+            cards.append(self.cards[low_bit.bit_length() - 1])
+            mask ^= low_bit
+        return cards
+
+
+_index = None
+_version = None
+_version_error = None
+_checked_at = None
+_lock = Lock()
+
+
+class CatalogVersionUnavailable(Exception):
+    """Raised when the catalog version stamp cannot be read."""
+
+
+def catalog_version(check_interval):
+    """
+    Returns the catalog version stamp, re-reading it from the
+    database at most every check_interval seconds. A failed read is
+    logged and remembered for the same interval, during which
+    CatalogVersionUnavailable is raised without retrying.
+    """
+    global _version, _version_error, _checked_at
+    now = time.monotonic()
+    if _checked_at is None or now - _checked_at >= check_interval:
+        try:
+            _version = CatalogVersion.current()
+            _version_error = None
+        except SQLAlchemyError as e:
+            logger.exception('Could not read the catalog version')
+            db.session.rollback()
+            _version_error = e
+        _checked_at = now
+    if _version_error is not None:
+        raise CatalogVersionUnavailable() from _version_error
+    return _version
+
+
+def current_catalog_version(check_interval):
+    """
+    Like catalog_version, but returns None if the stamp cannot be
+    read, so that callers skip their caches instead of failing.
+    """
+    try:
+        return catalog_version(check_interval)
+    except CatalogVersionUnavailable:
+        return None
+
+
+def get_facet_index(check_interval):
+    """
+    Returns the current FacetIndex, building it on first use and
+    rebuilding it when the catalog version stamp has been bumped.
+    Returns None if the index cannot be built, so that callers
+    fall back to querying the database.
+    """
+    global _index
+    version = current_catalog_version(check_interval)
+    if version is None:
+        return None
+    if _index is not None and _index.version == version:
+        return _index
+    try:
+        with _lock:
+            if _index is None or _index.version != version:
+                _index = FacetIndex.build(version)
+                logger.info('Built recipe facet index v%s (%s recipes)', version, len(_index.cards))
+            return _index
+    except SQLAlchemyError:
+        logger.exception('Could not build recipe facet index')
+        db.session.rollback()
+        return None
+
+
+def invalidate_catalog_version():
+    """Forces the next catalog_version call to re-read the stamp."""
+    global _checked_at
+    _checked_at = None
@@ -0,0 +1,206 @@
+"""Flask CLI commands for database maintenance."""
+
+from models import db, Recipe, RecipeIngredient, RecipeCart, Step, Favorite, Cart, CatalogVersion
+from sqlalchemy import inspect
+from aggregation import IngredientMatrix
+from seed import BACKUP_PATH, CATALOG_TABLES, read_source, load, export_snapshot
+import time
+import click
+
+
+def hot_queries():
+    """
+    Representative versions of the queries the views run most often.
+    Used to compare EXPLAIN plans before and after index changes.
+    """
+    return [
+        ('recipe index filter', Recipe.query
+            .filter_by(category='beef', difficulty=2, spice_level=0)
+            .filter(Recipe.prep_time <= 60)
+            .order_by(Recipe.id)
+            .limit(40)),
+        ('recipe steps', Step.query.filter_by(recipe_id=1).order_by(Step.step_number)),
+        ('recipes using ingredient', RecipeIngredient.query.filter_by(ingredient_id=1)),
+        ('cart contents', RecipeCart.query.filter_by(cart_id=1)),
+        ('user favorites', Favorite.query.filter_by(user_id=1)),
+        ('user carts', Cart.query.filter_by(user_id=1, is_complete=True)),
+    ]
+
+
+def explain(query):
+    """Returns the lines of the EXPLAIN plan for a query."""
+    sql = query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})
+    return [row[0] for row in db.session.execute(f'EXPLAIN {sql}')]
+
+
+def missing_indexes():
+    """Returns indexes declared on the models that do not exist in the database."""
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        missing.extend(index for index in table.indexes if index.name not in existing)
+    return missing
+
+
+def missing_columns():
+    """Returns columns declared on the models that do not exist in the database."""
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        missing.extend(column for column in table.columns if column.name not in existing)
+    return missing
+
+
+def add_column(column):
+    """
+    Adds a column to an existing table. Non-nullable columns
+    must declare a server_default to backfill existing rows.
+    """
+    column_type = column.type.compile(dialect=db.engine.dialect)
+    ddl = f'ALTER TABLE {column.table.name} ADD COLUMN {column.name} {column_type}'
+    if column.server_default is not None:
+        default = column.server_default.arg
+        default = default.text if hasattr(default, 'text') else f"'{default}'"
+        ddl += f' DEFAULT {default}'
+    if not column.nullable:
+        ddl += ' NOT NULL'
+    db.session.execute(ddl)
+
+
+def upgrade_schema():
+    """
+    Brings an existing database up to date with the models: creates
+    new tables, adds missing columns and builds missing indexes.
+    Returns (columns added, indexes created).
+    """
+    db.create_all()
+    columns = missing_columns()
+    for column in columns:
+        add_column(column)
+    db.session.commit()
+    indexes = missing_indexes()
+    for index in indexes:
+        index.create(db.engine)
+    return columns, indexes
+
+
+def print_plans(title):
+    click.echo(f'==== {title} ====')
+    for name, query in hot_queries():
+        click.echo(f'-- {name}')
+        for line in explain(query):
+            click.echo(f'   {line}')
+
+
+def register_commands(app):
+    @app.cli.command('create-db')
+    def create_db():
+        """Creates the tables and indexes for the models that do not exist yet."""
+        db.create_all()
+        click.echo('Database tables created.')
+
+    @app.cli.command('create-indexes')
+    @click.option('--dry-run', is_flag=True, help='Only list the missing indexes.')
+    @click.option('--no-explain', is_flag=True, help='Skip the before/after EXPLAIN plans.')
+    def create_indexes(dry_run, no_explain):
+        """
+        Creates indexes declared on the models that are missing
+        from an existing database, e.g. one restored from
+        data/db_backup.psql, and reports EXPLAIN plans before/after.
+        """
+        missing = missing_indexes()
+        if not missing:
+            click.echo('All model indexes already exist.')
+            return
+        for index in missing:
+            columns = ', '.join(column.name for column in index.columns)
+            click.echo(f'missing: {index.name} ON {index.table.name} ({columns})')
+        if dry_run:
+            return
+
+        if not no_explain:
+            print_plans('BEFORE')
+        for index in missing:
+            index.create(db.engine)
+            click.echo(f'created: {index.name}')
+        for table in {index.table.name for index in missing}:
+            db.session.execute(f'ANALYZE {table}')
+        db.session.commit()
+        if not no_explain:
+            print_plans('AFTER')
+
+    @app.cli.command('bump-catalog-version')
+    def bump_catalog_version():
+        """
+        Marks the recipe catalog as changed, e.g. after restoring
+        data/db_backup.psql, so workers rebuild their facet index.
+        """
+        CatalogVersion.bump()
+        db.session.commit()
+        click.echo(f'Catalog version is now {CatalogVersion.current()}')
+
+    @app.cli.command('verify-aggregation')
+    def verify_aggregation():
+        """
+        Checks the in-memory ingredient matrix against the SQL
+        aggregation for every cart in the database.
+        """
+        matrix = IngredientMatrix.build(CatalogVersion.current())
+        mismatches = 0
+        carts = Cart.query.order_by(Cart.id).all()
+        for cart in carts:
+            expected = [(name, unit, round(float(qty), 4), label)
+                        for name, unit, qty, label in cart.query_ingredient_quantities()]
+            actual = [(name, unit, round(qty, 4), label)
+                      for name, unit, qty, label in matrix.totals(cart.recipe_quantities())]
+            if sorted(expected) != sorted(actual):
+                mismatches += 1
+                click.echo(f'cart {cart.id}: expected {expected}, got {actual}')
+        click.echo(f'{len(carts)} carts checked, {mismatches} mismatches')
+
+    @app.cli.command('upgrade-db')
+    def upgrade_db():
+        """
+        Brings an existing database up to date with the models:
+        creates new tables, adds missing columns and missing indexes.
+        """
+        columns, indexes = upgrade_schema()
+        for column in columns:
+            click.echo(f'added column: {column.table.name}.{column.name}')
+        for index in indexes:
+            click.echo(f'created index: {index.name}')
+        click.echo('Database is up to date.')
+
+    @app.cli.command('seed-db')
+    @click.argument('source', default=BACKUP_PATH)
+    @click.option('--all', 'all_tables', is_flag=True, help='Also load users, carts and favorites.')
+    @click.confirmation_option(prompt='This replaces the recipe catalog in the database. Continue?')
+    def seed_db(source, all_tables):
+        """
+        Loads the recipe catalog from data/db_backup.psql or from a
+        snapshot written by export-snapshot, in one transaction.
+        Existing rows in the loaded tables are replaced; favorites and
+        cart contents are kept unless --all is given.
+        """
+        upgrade_schema()
+        start = time.monotonic()
+        counts = load(read_source(source), None if all_tables else CATALOG_TABLES)
+        for table, rows in counts.items():
+            click.echo(f'{table}: {rows} rows')
+        click.echo(f'Loaded {source} in {time.monotonic() - start:.2f}s')
+
+    @app.cli.command('export-snapshot')
+    @click.argument('path')
+    def export_snapshot_command(path):
+        """Writes the recipe catalog to a gzip snapshot for seed-db."""
+        for table, rows in export_snapshot(path).items():
+            click.echo(f'{table}: {rows} rows')
+        click.echo(f'Wrote {path}')
@@ -0,0 +1,189 @@
+"""
+Per-request instrumentation.
+
+SQL statements are counted and timed with cursor events, template
+rendering through Flask's template signals (which need blinker), and
+any other block wrapped in timed(), such as bcrypt hashing. Each
+response reports its timings in a Server-Timing header, and every
+measurement is added to per-endpoint histograms kept by the process.
+Requests that issue more statements than QUERY_BUDGET are logged with
+their most repeated statement, the usual sign of an N+1 query.
+"""
+
+from flask import g, request, has_request_context, template_rendered, before_render_template, signals_available
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from threading import Lock
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in milliseconds; a final bucket holds everything slower.
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class Histogram:
+    """Bucketed counts of observed values, plus their count, sum and max."""
+
+    def __init__(self, buckets=BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def serialize(self):
+        bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+        return {'count': self.count, 'sum': round(self.total, 3), 'max': round(self.max, 3),
+                'buckets': dict(zip(bounds, self.counts))}
+
+
+class Metrics:
+    """Histograms per endpoint and measurement, shared by the threads of a process."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._histograms = defaultdict(lambda: defaultdict(Histogram))
+        self._slowest = {}
+        self._over_budget = Counter()
+
+    def record(self, endpoint, timings, total_ms, over_budget):
+        with self._lock:
+            histograms = self._histograms[endpoint]
+            histograms['total_ms'].observe(total_ms)
+            histograms['queries'].observe(timings.queries)
+            histograms['db_ms'].observe(timings.db_ms)
+            for name, duration in timings.durations.items():
+                histograms[f'{name}_ms'].observe(duration)
+            if timings.slowest and timings.slowest[0] > self._slowest.get(endpoint, (0,))[0]:
+                self._slowest[endpoint] = timings.slowest
+            if over_budget:
+                self._over_budget[endpoint] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {endpoint: {'histograms': {name: histogram.serialize() for name, histogram in histograms.items()},
+                               'slowest_statement': dict(zip(('ms', 'statement'), self._slowest[endpoint]))
+                                                    if endpoint in self._slowest else None,
+                               'over_query_budget': self._over_budget[endpoint]}
+                    for endpoint, histograms in self._histograms.items()}
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._slowest.clear()
+            self._over_budget.clear()
+
+
+class RequestTimings:
+    """Measurements of a single request, kept on flask.g."""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_ms = 0.0
+        self.slowest = None
+        self.statements = Counter()
+        self.durations = defaultdict(float)
+
+    def add_statement(self, statement, duration):
+        self.queries += 1
+        self.db_ms += duration
+        self.statements[statement] += 1
+        if self.slowest is None or duration > self.slowest[0]:
+            self.slowest = (round(duration, 3), statement[:500])
+
+    def server_timing(self, total_ms):
+        entries = [f'db;dur={self.db_ms:.1f};desc="{self.queries} queries"']
+        if self.slowest:
+            entries.append(f'db-slowest;dur={self.slowest[0]:.1f}')
+        entries += [f'{name};dur={duration:.1f}' for name, duration in self.durations.items()]
+        entries.append(f'total;dur={total_ms:.1f}')
+        return ', '.join(entries)
+
+
+def current_timings():
+    return getattr(g, 'timings', None) if has_request_context() else None
+
+
+@contextmanager
+def timed(name):
+    """Adds the time spent in the block to the current request's name timing."""
+    timings = current_timings()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.durations[name] += (time.perf_counter() - start) * 1000
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['query_start'].pop()
+    timings = current_timings()
+    if timings is not None:
+        timings.add_statement(statement, (time.perf_counter() - start) * 1000)
+
+
+def init_instrumentation(app, metrics):
+    """
+    Installs the request hooks on app, recording into metrics.
+    Reads INSTRUMENTATION, SERVER_TIMING and QUERY_BUDGET from app.config.
+    """
+    if not app.config['INSTRUMENTATION']:
+        return
+
+    @app.before_request
+    def start_timings():
+        g.timings = RequestTimings()
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_timings(response):
+        timings = current_timings()
+        if timings is None:
+            return response
+        total_ms = (time.perf_counter() - g.request_start) * 1000
+        endpoint = request.endpoint or 'unmatched'
+        budget = app.config['QUERY_BUDGET']
+        over_budget = bool(budget) and timings.queries > budget
+        if over_budget:
+            statement, repeats = timings.statements.most_common(1)[0]
+            logger.warning('%s issued %s SQL statements (budget %s); most repeated (%sx): %s',
+                           endpoint, timings.queries, budget, repeats, statement)
+        metrics.record(endpoint, timings, total_ms, over_budget)
+        if app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = timings.server_timing(total_ms)
+        return response
+
+    if signals_available:
+        def render_started(sender, template, context, **extra):
+            if current_timings() is not None:
+                g.setdefault('render_starts', []).append(time.perf_counter())
+
+        def render_finished(sender, template, context, **extra):
+            timings = current_timings()
+            if timings is not None and g.get('render_starts'):
+                timings.durations['render'] += (time.perf_counter() - g.render_starts.pop()) * 1000
+
+        before_render_template.connect(render_started, app, weak=False)
+        template_rendered.connect(render_finished, app, weak=False)
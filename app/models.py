@@ -1,6 +1,11 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
-from sqlalchemy import func
+from sqlalchemy import func, text, literal
+from sqlalchemy.dialects.postgresql import insert
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from instrumentation import timed
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
@@ -8,9 +13,29 @@ def connect_db(app):
     db.app = app
     db.init_app(app)
 
+@contextmanager
+def statement_timeout(milliseconds):
+    """
+    Cancels statements run inside the block after milliseconds (0 for no
+    limit). The setting is local to the current transaction, so it never
+    leaks to other requests through the pool or pgbouncer.
+    """
+    if not milliseconds:
+        yield
+        return
+    previous = db.session.execute(
+        text("SELECT current_setting('statement_timeout'), set_config('statement_timeout', :value, true)"),
+        {'value': str(int(milliseconds))}).first()[0]
+    yield
+    # Not reached on errors: the caller's rollback discards the setting
+    db.session.execute(text("SELECT set_config('statement_timeout', :value, true)"), {'value': previous})
+
 
 class RecipeIngredient(db.Model):
     __tablename__ = "recipes_ingredients"
+    __table_args__ = (
+        db.Index('ix_recipes_ingredients_ingredient_id', 'ingredient_id'),
+    )
     recipe_id = db.Column(db.Integer, db.ForeignKey('recipes.id', ondelete='CASCADE'), primary_key=True, nullable=False)
     ingredient_id = db.Column(db.Integer, db.ForeignKey('ingredients.id', ondelete='CASCADE'), primary_key=True, nullable=False)
     quantity = db.Column(db.Numeric, nullable = False)
@@ -18,6 +43,10 @@ class RecipeIngredient(db.Model):
 class Recipe(db.Model):
 
     __tablename__ = 'recipes'
+    __table_args__ = (
+        db.Index('ix_recipes_filters', 'category', 'difficulty', 'spice_level', 'prep_time'),
+        db.Index('ix_recipes_prep_time', 'prep_time'),
+    )
 
     id = db.Column(db.Integer, primary_key = True, autoincrement = True)
     title = db.Column(db.Text, nullable=False)
@@ -42,6 +71,32 @@ class Recipe(db.Model):
         "difficulty":self.difficulty,
         "spice_level":self.spice_level}
 
+class CatalogVersion(db.Model):
+    """
+    Single-row version stamp for the recipe catalog.
+    Bumped whenever recipes are added or changed so that
+    in-process copies of the catalog know to rebuild.
+    """
+    __tablename__ = 'catalog_version'
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def current(cls):
+        version = db.session.query(cls.version).filter(cls.id == 1).scalar()
+        return version or 0
+
+    @classmethod
+    def bump(cls):
+        """
+        Increments the catalog version.
+        Like User.signup, the caller is responsible for committing.
+        """
+        updated = cls.query.filter(cls.id == 1).update({cls.version: cls.version + 1})
+        if not updated:
+            db.session.add(cls(id=1, version=1))
+
 class Ingredient(db.Model):
 
     __tablename__ = 'ingredients'
@@ -79,6 +134,9 @@ class Category(db.Model):
 
 class Step(db.Model):
     __tablename__ = 'steps'
+    __table_args__ = (
+        db.Index('ix_steps_recipe_id_step_number', 'recipe_id', 'step_number'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     recipe_id = db.Column(db.Integer, db.ForeignKey('recipes.id', ondelete='CASCADE'), nullable=False)
@@ -105,7 +163,8 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        with timed('bcrypt'):
+            hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
 
         user = User(
             username=username,
@@ -130,7 +189,8 @@ class User(db.Model):
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            with timed('bcrypt'):
+                is_auth = bcrypt.check_password_hash(user.password, password)
             if is_auth:
                 return user
 
@@ -140,25 +200,119 @@ class Favorite(db.Model):
     __tablename__ = 'favorites'
     __table_args__ = (
         db.UniqueConstraint('recipe_id', 'user_id', name='unique_recipe_user'),
+        db.Index('ix_favorites_user_id', 'user_id'),
     )
     recipe_id = db.Column(db.Integer, db.ForeignKey('recipes.id', ondelete='CASCADE'), primary_key=True, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True, nullable=False)
+    @staticmethod
+    def recipe_ids(user_id):
+        """Returns the set of ids of the recipes a user favorited, without loading any Recipe objects."""
+        return {recipe_id for recipe_id, in db.session.query(Favorite.recipe_id).filter(Favorite.user_id == user_id)}
+    @staticmethod
+    def favorited_by(user_id):
+        """EXISTS clause matching the recipes a user favorited, for filtering Recipe queries."""
+        return db.exists().where(db.and_(Favorite.recipe_id == Recipe.id, Favorite.user_id == user_id))
+    @staticmethod
+    def add(user_id, recipe_id):
+        """
+        Favorites a recipe with one INSERT ... ON CONFLICT DO NOTHING.
+        Returns False if it already was a favorite.
+        The caller is responsible for committing.
+        """
+        table = Favorite.__table__
+        stmt = insert(table).values(recipe_id=recipe_id, user_id=user_id) \
+                 .on_conflict_do_nothing(index_elements=[table.c.recipe_id, table.c.user_id])
+        return db.session.execute(stmt).rowcount > 0
+    @staticmethod
+    def remove(user_id, recipe_id):
+        """
+        Unfavorites a recipe with a single DELETE.
+        Returns False if it was not a favorite.
+        The caller is responsible for committing.
+        """
+        return Favorite.query.filter(Favorite.user_id == user_id, Favorite.recipe_id == recipe_id) \
+                             .delete(synchronize_session=False) > 0
 
 class Cart(db.Model):
     __tablename__ = 'carts'
+    __table_args__ = (
+        db.Index('ix_carts_user_id_is_complete', 'user_id', 'is_complete'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.Text, nullable=False, default='Untitled Cart')
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'))
     is_complete = db.Column(db.Boolean, nullable=False, default=False)
+    # Bumped on every change to the cart's recipes; used for HTTP caching.
+    revision = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow,
+                           server_default=text("(now() at time zone 'utc')"))
     user = db.relationship('User')
+    @staticmethod
+    def bump_revision(cart_id):
+        """
+        Records that a cart's contents changed.
+        The caller is responsible for committing.
+        """
+        Cart.query.filter(Cart.id == cart_id) \
+            .update({Cart.revision: Cart.revision + 1, Cart.updated_at: datetime.utcnow()},
+                    synchronize_session=False)
+    @classmethod
+    def copy(cls, source_cart_id, name, user_id):
+        """
+        Creates a new cart holding the same recipes and quantities
+        as an existing one. The new row is flushed to obtain its id,
+        so the caller commits both the cart and its contents at once.
+        """
+        new_cart = cls(name=name, user_id=user_id)
+        db.session.add(new_cart)
+        db.session.flush()
+        RecipeCart.copy_contents(source_cart_id, new_cart.id)
+        return new_cart
     def query_contents(self):
         return db.session \
                 .query(RecipeCart.quantity, Recipe) \
                 .join(Recipe) \
                 .filter(RecipeCart.cart_id == self.id) \
                 .order_by(Recipe.title)
+    @staticmethod
+    def contents_by_cart(cart_ids):
+        """
+        Loads the contents of several carts in a single query.
+        Returns a dict of cart id to [(quantity, recipe), ...]
+        ordered by recipe title, like query_contents.
+        """
+        contents = defaultdict(list)
+        if not cart_ids:
+            return contents
+        rows = db.session \
+                .query(RecipeCart.cart_id, RecipeCart.quantity, Recipe) \
+                .join(Recipe) \
+                .filter(RecipeCart.cart_id.in_(cart_ids)) \
+                .order_by(Recipe.title) \
+                .all()
+        for cart_id, quantity, recipe in rows:
+            contents[cart_id].append((quantity, recipe))
+        return contents
+    def recipe_quantities(self):
+        """Returns {recipe_id: quantity} for the recipes in this cart."""
+        return Cart.combined_recipe_quantities([self.id])
+    @staticmethod
+    def combined_recipe_quantities(cart_ids):
+        """Returns {recipe_id: total quantity} across several carts."""
+        return dict(db.session
+                    .query(RecipeCart.recipe_id, func.sum(RecipeCart.quantity))
+                    .filter(RecipeCart.cart_id.in_(cart_ids))
+                    .group_by(RecipeCart.recipe_id)
+                    .all())
     def query_ingredient_quantities(self):
+        return Cart.query_combined_ingredient_quantities([self.id])
+    @staticmethod
+    def query_combined_ingredient_quantities(cart_ids):
+        """
+        Aggregates converted ingredient quantities over the recipes
+        of several carts in one grouped query.
+        """
         return db.session \
                .query(Ingredient.food_name, Conversion.unit_to, func.sum(RecipeIngredient.quantity*RecipeCart.quantity*Conversion.conversion_factor), Category.category_label) \
                .select_from(RecipeCart) \
@@ -166,7 +320,7 @@ class Cart(db.Model):
                .join(Ingredient, RecipeIngredient.ingredient_id == Ingredient.id) \
                .join(Conversion, Ingredient.conversion_id == Conversion.id) \
                .join(Category, Ingredient.category_id == Category.id) \
-               .filter(RecipeCart.cart_id == self.id) \
+               .filter(RecipeCart.cart_id.in_(cart_ids)) \
                .group_by(Ingredient.food_name, Conversion.unit_to, Category.category_label) \
                .order_by(Category.category_label, func.lower(Ingredient.food_name))
     def serialize(self):
@@ -174,10 +328,73 @@ class Cart(db.Model):
 
 class RecipeCart(db.Model):
     __tablename__ = 'recipes_carts'
+    __table_args__ = (
+        db.Index('ix_recipes_carts_cart_id', 'cart_id'),
+    )
     recipe_id = db.Column(db.Integer, db.ForeignKey('recipes.id', ondelete='CASCADE'), primary_key=True, nullable=False)
     cart_id = db.Column(db.Integer, db.ForeignKey('carts.id', ondelete='CASCADE'), primary_key=True, nullable=False)
     quantity = db.Column(db.Numeric, nullable = False)
     recipe = db.relationship('Recipe')
     cart = db.relationship('Cart')
+    @staticmethod
+    def apply_deltas(cart_id, deltas):
+        """
+        Adds each {recipe_id: delta} to the recipe's quantity in a cart
+        with one INSERT ... ON CONFLICT DO UPDATE, so concurrent additions
+        cannot overwrite each other. Rows whose quantity drops to zero or
+        below are removed. Returns {recipe_id: new quantity}.
+        The caller is responsible for committing.
+        """
+        if not deltas:
+            return {}
+        table = RecipeCart.__table__
+        stmt = insert(table).values([{'recipe_id': recipe_id, 'cart_id': cart_id, 'quantity': delta}
+                                     for recipe_id, delta in deltas.items()])
+        stmt = stmt.on_conflict_do_update(index_elements=[table.c.recipe_id, table.c.cart_id],
+                                          set_={'quantity': table.c.quantity + stmt.excluded.quantity}) \
+                   .returning(table.c.recipe_id, table.c.quantity)
+        quantities = dict(db.session.execute(stmt).fetchall())
+        emptied = [recipe_id for recipe_id, quantity in quantities.items() if quantity <= 0]
+        if emptied:
+            RecipeCart.query.filter(RecipeCart.cart_id == cart_id, RecipeCart.recipe_id.in_(emptied)) \
+                .delete(synchronize_session=False)
+        return {recipe_id: max(quantity, 0) for recipe_id, quantity in quantities.items()}
+    @staticmethod
+    def copy_contents(source_cart_id, target_cart_id):
+        """
+        Copies every recipe of one cart into another with a single
+        INSERT ... SELECT. Recipes already in the target cart have
+        the source quantity added. Returns the number of rows written.
+        The caller is responsible for committing.
+        """
+        table = RecipeCart.__table__
+        source = db.select([table.c.recipe_id, literal(target_cart_id, db.Integer), table.c.quantity]) \
+                   .where(table.c.cart_id == source_cart_id)
+        stmt = insert(table).from_select(['recipe_id', 'cart_id', 'quantity'], source)
+        stmt = stmt.on_conflict_do_update(index_elements=[table.c.recipe_id, table.c.cart_id],
+                                          set_={'quantity': table.c.quantity + stmt.excluded.quantity})
+        return db.session.execute(stmt).rowcount
     def serialize(self):
-        return {"recipe_id":self.recipe_id, "cart_id":self.cart_id, "quantity":str(self.quantity)}
\ No newline at end of file
+        return {"recipe_id":self.recipe_id, "cart_id":self.cart_id, "quantity":str(self.quantity)}
+
+def recipe_overlay(user_id, cart_id, recipe_ids=None):
+    """
+    Returns (ids of recipes in the cart, ids of recipes the user favorited)
+    as sets, optionally only among recipe_ids, with a single UNION query.
+    cart_id may be None for a user without an active cart.
+    """
+    if recipe_ids is not None and not recipe_ids:
+        return set(), set()
+    query = db.session.query(literal('favorite').label('kind'), Favorite.recipe_id) \
+              .filter(Favorite.user_id == user_id)
+    if recipe_ids is not None:
+        query = query.filter(Favorite.recipe_id.in_(recipe_ids))
+    if cart_id is not None:
+        in_cart = db.session.query(literal('cart'), RecipeCart.recipe_id).filter(RecipeCart.cart_id == cart_id)
+        if recipe_ids is not None:
+            in_cart = in_cart.filter(RecipeCart.recipe_id.in_(recipe_ids))
+        query = query.union_all(in_cart)
+    overlay = {'cart': set(), 'favorite': set()}
+    for kind, recipe_id in query:
+        overlay[kind].add(recipe_id)
+    return overlay['cart'], overlay['favorite']
\ No newline at end of file
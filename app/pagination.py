@@ -0,0 +1,99 @@
+"""Keyset (seek) pagination helpers."""
+
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from bisect import bisect_left, bisect_right
+import json
+
+
+def encode_cursor(key, direction, page):
+    """
+    Encodes a position in an ordered result set as an opaque token.
+    direction is 'next' (rows after key) or 'prev' (rows before key).
+    """
+    payload = json.dumps({'k': key, 'd': direction, 'p': page}, separators=(',', ':'))
+    return urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Returns (key, direction, page) for a cursor token,
+    or None if the token is missing or malformed.
+    """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(urlsafe_b64decode(padded.encode()))
+        if payload['d'] not in ('next', 'prev'):
+            return None
+        return int(payload['k']), payload['d'], int(payload['p'])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+class KeysetPage():
+    """
+    One page of a keyset-paginated query.
+    Mirrors the attributes of a Flask-SQLAlchemy Pagination
+    that the views use, with cursors in place of page numbers.
+    """
+    def __init__(self, items, page, has_next, has_prev, first_key=None, last_key=None):
+        self.items = items
+        self.page = page
+        self.has_next = has_next
+        self.has_prev = has_prev
+        self.next_cursor = encode_cursor(last_key, 'next', page + 1) if has_next else None
+        self.prev_cursor = encode_cursor(first_key, 'prev', page - 1) if has_prev else None
+
+
+def keyset_paginate(query, column, cursor, per_page):
+    """
+    Paginates query on a unique, ascending column without OFFSET or COUNT.
+    Fetches one extra row to learn whether another page exists
+    in the direction of travel.
+    """
+    position = decode_cursor(cursor)
+    if position is None:
+        rows = query.order_by(column).limit(per_page + 1).all()
+        has_next = len(rows) > per_page
+        rows = rows[:per_page]
+        return KeysetPage(rows, 1, has_next, False,
+                          last_key=getattr(rows[-1], column.key) if rows else None)
+
+    key, direction, page = position
+    if direction == 'next':
+        rows = query.filter(column > key).order_by(column).limit(per_page + 1).all()
+        has_next, has_prev = len(rows) > per_page, True
+        rows = rows[:per_page]
+    else:
+        rows = query.filter(column < key).order_by(column.desc()).limit(per_page + 1).all()
+        has_next, has_prev = True, len(rows) > per_page
+        rows = list(reversed(rows[:per_page]))
+    if not rows:
+        return KeysetPage(rows, max(page, 1), False, False)
+    return KeysetPage(rows, max(page, 1), has_next, has_prev,
+                      first_key=getattr(rows[0], column.key),
+                      last_key=getattr(rows[-1], column.key))
+
+
+def keyset_paginate_list(items, keys, cursor, per_page):
+    """
+    Keyset pagination over an already ordered in-memory list.
+    keys holds the ascending sort key of each item.
+    """
+    position = decode_cursor(cursor)
+    if position is None:
+        start, end, page = 0, per_page, 1
+    else:
+        key, direction, page = position
+        if direction == 'next':
+            start = bisect_right(keys, key)
+            end = start + per_page
+        else:
+            end = bisect_left(keys, key)
+            start = max(end - per_page, 0)
+    rows = items[start:end]
+    if not rows:
+        return KeysetPage(rows, max(page, 1), False, False)
+    return KeysetPage(rows, max(page, 1), end < len(items), start > 0,
+                      first_key=keys[start], last_key=keys[start + len(rows) - 1])
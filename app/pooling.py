@@ -0,0 +1,48 @@
+"""Database engine and connection pool settings read from the environment."""
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool
+
+
+def engine_options(environ):
+    """
+    Returns SQLALCHEMY_ENGINE_OPTIONS for the given environment.
+
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT (seconds to wait for a
+    free connection), DB_POOL_RECYCLE (seconds) and DB_POOL_PRE_PING size
+    the per-process pool. DB_STATEMENT_TIMEOUT_MS caps every statement.
+
+    DATABASE_POOLER=pgbouncer is for pgbouncer in transaction mode: the
+    app keeps no pool of its own and sets nothing that outlives a
+    transaction, since consecutive transactions may run on different
+    server connections. psycopg2 interpolates parameters client-side and
+    never creates server-side prepared statements, so no driver setting
+    needs to change.
+    """
+    timeout = int(environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+    if environ.get('DATABASE_POOLER') == 'pgbouncer':
+        if timeout:
+            use_transaction_statement_timeout(timeout)
+        return {'poolclass': NullPool}
+
+    options = {'pool_size': int(environ.get('DB_POOL_SIZE', 5)),
+               'max_overflow': int(environ.get('DB_MAX_OVERFLOW', 10)),
+               'pool_timeout': float(environ.get('DB_POOL_TIMEOUT', 10)),
+               'pool_recycle': int(environ.get('DB_POOL_RECYCLE', 1800)),
+               'pool_pre_ping': environ.get('DB_POOL_PRE_PING', '1') == '1'}
+    if timeout:
+        # Sent as a startup parameter, so it costs no extra round trip
+        options['connect_args'] = {'options': f'-c statement_timeout={timeout}'}
+    return options
+
+
+def use_transaction_statement_timeout(milliseconds):
+    """
+    Sets statement_timeout at the start of every transaction instead of
+    per connection, because pgbouncer rejects startup parameters and
+    does not keep session settings.
+    """
+    @event.listens_for(Engine, 'begin')
+    def set_statement_timeout(connection):
+        connection.execute(f'SET LOCAL statement_timeout = {int(milliseconds)}')
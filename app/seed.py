@@ -0,0 +1,188 @@
+"""
+Bulk loading of the recipe catalog.
+
+Loads the COPY blocks of data/db_backup.psql, or a snapshot written by
+export_snapshot, through psycopg2's copy_expert in a single transaction.
+Secondary indexes are dropped before the load and rebuilt after it,
+and id sequences are moved past the loaded rows. Rows of other tables
+that reference the loaded tables, such as favorites and cart contents
+when only the catalog is loaded, are kept.
+
+A snapshot is a gzip file holding one JSON header line followed by
+each table's rows in COPY text format, terminated by a \\. line.
+"""
+
+from models import db, CatalogVersion
+from sqlalchemy import inspect
+import psycopg2
+import gzip
+import json
+import io
+import os
+
+BACKUP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'db_backup.psql')
+
+SNAPSHOT_FORMAT = 'groceryhelper-snapshot'
+SNAPSHOT_VERSION = 1
+
+# Tables holding the recipe catalog itself, as opposed to user data.
+CATALOG_TABLES = ['categories', 'conversions', 'ingredients', 'recipes', 'recipes_ingredients', 'steps']
+
+
+class SeedError(Exception):
+    """Raised when a backup or snapshot cannot be loaded."""
+
+
+def read_backup(path):
+    """
+    Yields (table, columns, data) for each COPY block of a pg_dump
+    plain-text backup. data holds the rows in COPY text format.
+    """
+    with open(path, encoding='utf-8', newline='\n') as f:
+        block = None
+        for line in f:
+            if block is None:
+                if line.startswith('COPY '):
+                    name, columns = line[len('COPY '):].split(' (', 1)
+                    columns = [column.strip() for column in columns.split(')', 1)[0].split(',')]
+                    block = (name.split('.')[-1], columns, [])
+            elif line == '\\.\n':
+                yield block[0], block[1], ''.join(block[2])
+                block = None
+            else:
+                block[2].append(line)
+
+
+def read_snapshot(path):
+    """Yields (table, columns, data) for each table of a snapshot."""
+    with gzip.open(path, 'rt', encoding='utf-8', newline='\n') as f:
+        header = json.loads(f.readline())
+        if header.get('format') != SNAPSHOT_FORMAT or header.get('version') != SNAPSHOT_VERSION:
+            raise SeedError(f'{path} is not a version {SNAPSHOT_VERSION} snapshot')
+        for table in header['tables']:
+            lines = []
+            for line in f:
+                if line == '\\.\n':
+                    break
+                lines.append(line)
+            yield table['name'], table['columns'], ''.join(lines)
+
+
+def read_source(path):
+    with open(path, 'rb') as f:
+        is_gzip = f.read(2) == b'\x1f\x8b'
+    return read_snapshot(path) if is_gzip else read_backup(path)
+
+
+def project(data, columns, keep):
+    """Drops the columns of COPY text rows that the models do not have."""
+    positions = [columns.index(column) for column in keep]
+    return ''.join('\t'.join(line.split('\t')[i] for i in positions) + '\n'
+                   for line in data.split('\n')[:-1])
+
+
+def reset_sequences(connection, tables):
+    """Moves each table's id sequence past its largest id."""
+    for table in tables:
+        if 'id' in table.c and table.c.id.primary_key:
+            connection.execute(f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                               f"COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) FROM {table.name}")
+
+
+def dependent_tables(tables):
+    """
+    Returns the model tables outside tables that reference them through
+    a foreign key, directly or through another dependent table.
+    """
+    names = {table.name for table in tables}
+    dependents = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in names and any(key.column.table.name in names for key in table.foreign_keys):
+            names.add(table.name)
+            dependents.append(table)
+    return dependents
+
+
+def load(blocks, tables=None):
+    """
+    Replaces the contents of the given tables (default: every table in
+    the source) with the rows in blocks, in one transaction.
+    Rows of dependent tables are copied aside and restored after the
+    load; SeedError is raised if they reference rows the source lacks.
+    Returns {table name: rows loaded}.
+    """
+    blocks = {name: (columns, data) for name, columns, data in blocks}
+    tables = set(tables or blocks)
+    model_tables = [table for table in db.metadata.sorted_tables if table.name in tables]
+    missing = tables - {table.name for table in model_tables}
+    if missing:
+        raise SeedError(f'unknown tables: {", ".join(sorted(missing))}')
+
+    connection = db.session.connection()
+    cursor = connection.connection.cursor()
+    counts = {}
+    try:
+        existing = set(inspect(connection).get_table_names())
+        dependents = [table for table in dependent_tables(model_tables) if table.name in existing]
+        saved = {}
+        for table in dependents:
+            saved[table.name] = io.StringIO()
+            cursor.copy_expert(f'COPY {table.name} TO STDOUT', saved[table.name])
+        names = ', '.join(table.name for table in model_tables + dependents)
+        connection.execute(f'TRUNCATE {names}')
+        indexes = [index for table in model_tables if table.name in existing for index in table.indexes]
+        for index in indexes:
+            connection.execute(f'DROP INDEX IF EXISTS {index.name}')
+
+        for table in model_tables:
+            if table.name not in blocks:
+                continue
+            columns, data = blocks[table.name]
+            keep = [column for column in columns if column in table.c]
+            if keep != columns:
+                data = project(data, columns, keep)
+            cursor.copy_expert(f'COPY {table.name} ({", ".join(keep)}) FROM STDIN', io.StringIO(data))
+            counts[table.name] = cursor.rowcount
+
+        for table in dependents:
+            saved[table.name].seek(0)
+            try:
+                cursor.copy_expert(f'COPY {table.name} FROM STDIN', saved[table.name])
+            except psycopg2.IntegrityError as error:
+                raise SeedError(f'{table.name} rows reference rows missing from the source, '
+                                f'use seed-db --all to replace them too: {error}') from error
+
+        for index in indexes:
+            index.create(bind=connection)
+        reset_sequences(connection, model_tables)
+        for table in model_tables:
+            connection.execute(f'ANALYZE {table.name}')
+        CatalogVersion.bump()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return counts
+
+
+def export_snapshot(path, tables=CATALOG_TABLES):
+    """Writes the given tables to a gzip snapshot. Returns {table name: rows}."""
+    model_tables = [table for table in db.metadata.sorted_tables if table.name in tables]
+    cursor = db.session.connection().connection.cursor()
+    header = {'format': SNAPSHOT_FORMAT, 'version': SNAPSHOT_VERSION,
+              'catalog_version': CatalogVersion.current(),
+              'tables': [{'name': table.name, 'columns': [column.name for column in table.columns]}
+                         for table in model_tables]}
+    counts = {}
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        f.write(json.dumps(header) + '\n')
+        for table, entry in zip(model_tables, header['tables']):
+            order = ', '.join(column.name for column in table.primary_key.columns)
+            buffer = io.StringIO()
+            cursor.copy_expert(f'COPY (SELECT {", ".join(entry["columns"])} FROM {table.name} '
+                               f'ORDER BY {order}) TO STDOUT', buffer)
+            counts[table.name] = cursor.rowcount
+            f.write(buffer.getvalue())
+            f.write('\\.\n')
+    db.session.rollback()
+    return counts
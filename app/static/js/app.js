@@ -12,31 +12,125 @@ const findCorrectElement = (classIdentifier, startingElement, maxDepth=4) => {
     }
 }
 
-$(document.body).on('click', '.add-to-cart', async (e) => {
+// Add-to-cart clicks are collected for a short while and sent
+// to the server as a single batch request.
+const CART_BATCH_DELAY_MS = 400;
+let pendingCartDeltas = {};
+let cartBatchTimer = null;
+
+const showToast = (message, success) => {
+    $toastBody.text(message);
+    if (success){
+        $('.toast').addClass('bg-success');
+        $('.toast').removeClass('bg-danger');
+    } else {
+        $('.toast').removeClass('bg-success');
+        $('.toast').addClass('bg-danger');
+    }
+    $('.toast').removeClass('hidden');
+    $('.toast').toast('show');
+}
+
+const markInCart = (recipeId, inCart=true) => {
+    document.querySelectorAll(`.add-to-cart[data-recipe-id="${recipeId}"]`).forEach((button) => {
+        const targetCard = findCorrectElement('card', button);
+        const shoppingCartIcon = targetCard && targetCard.querySelector('.fa-shopping-cart');
+        if (shoppingCartIcon){
+            shoppingCartIcon.classList.toggle('text-secondary', inCart);
+            shoppingCartIcon.classList.toggle('text-light', !inCart);
+        }
+    });
+}
+
+// Shared recipe grids (RECIPE_GRID_SHARED) are rendered without the
+// visitor's state, so cart icons and hearts are filled in from /api/overlay.
+const hydrateRecipeGrid = async () => {
+    const grid = document.querySelector('.recipe-grid[data-hydrate-overlay]');
+    if (!grid){
+        return;
+    }
+    const ids = [...new Set([...grid.querySelectorAll('.add-to-cart[data-recipe-id]')]
+        .map((button) => button.dataset.recipeId))];
+    if (!ids.length){
+        return;
+    }
+    try{
+        const res = await axios.get('/api/overlay', {params: {ids: ids.join(',')}});
+        if (!res.data.user){
+            return;
+        }
+        res.data.cart.forEach((recipeId) => markInCart(recipeId));
+        const favorites = new Set(res.data.favorites);
+        grid.querySelectorAll('.favorite[data-recipe-id]').forEach((heart) => {
+            if (favorites.has(Number(heart.dataset.recipeId))){
+                heart.setAttribute('class', 'unfavorite fas fa-heart text-danger');
+            } else {
+                heart.classList.remove('d-none');
+            }
+        });
+    } catch (error) {
+        // The page stays usable without the overlay
+    }
+}
+
+const takePendingCartOperations = () => {
+    const operations = Object.entries(pendingCartDeltas).map(([recipeId, delta]) => (
+        {recipe_id: Number(recipeId), delta}
+    ));
+    pendingCartDeltas = {};
+    return operations;
+}
+
+const flushCartBatch = async () => {
+    cartBatchTimer = null;
+    const operations = takePendingCartOperations();
+    if (!operations.length){
+        return;
+    }
+    try{
+        const res = await axios.post('/api/carts/batch', {operations});
+        // Recipes whose quantity dropped to zero left the cart
+        res.data.data.forEach((item) => markInCart(item.recipe_id, Number(item.quantity) > 0));
+        showToast(`${res.data.message}`, true);
+    } catch (error) {
+        showToast(`${error.response.data.message}`, false);
+    }
+}
+
+// Sends clicks still waiting for the batch timer when the page is left.
+// keepalive lets the request outlive the page, like sendBeacon, while
+// keeping the JSON content type the endpoint expects.
+const flushCartBatchOnExit = () => {
+    clearTimeout(cartBatchTimer);
+    cartBatchTimer = null;
+    const operations = takePendingCartOperations();
+    if (!operations.length){
+        return;
+    }
+    fetch('/api/carts/batch', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({operations}),
+        credentials: 'same-origin',
+        keepalive: true,
+    });
+}
+
+window.addEventListener('pagehide', flushCartBatchOnExit);
+document.addEventListener('visibilitychange', () => {
+    if (document.visibilityState === 'hidden'){
+        flushCartBatchOnExit();
+    }
+});
+
+$(document.body).on('click', '.add-to-cart', (e) => {
     e.preventDefault();
     const target = findCorrectElement('add-to-cart', e.target);
     if (target){
         const recipeId = target.dataset.recipeId;
-        try{
-            const res = await axios.post(`/api/recipes/${recipeId}/add-to-cart`);
-            $toastBody.text(`${res.data.message}`);
-            const targetCard = findCorrectElement('card', target);
-            shoppingCartIcon = targetCard.querySelector('.fa-shopping-cart');
-            shoppingCartIcon.classList.add('text-secondary');
-            shoppingCartIcon.classList.remove('text-light');
-            $('.toast').addClass('bg-success');
-            $('.toast').removeClass('bg-danger');
-            $('.toast').removeClass('hidden');
-            $('.toast').toast('show');
-        } catch (error) {
-            $toastBody.text(`${error.response.data.message}`);
-            $('.toast').removeClass('bg-success');
-            $('.toast').addClass('bg-danger');
-
-        }
-        $('.toast').removeClass('hidden');
-        $('.toast').toast('show');
-
+        pendingCartDeltas[recipeId] = (pendingCartDeltas[recipeId] || 0) + 1;
+        clearTimeout(cartBatchTimer);
+        cartBatchTimer = setTimeout(flushCartBatch, CART_BATCH_DELAY_MS);
     }
 });
 
@@ -88,4 +182,6 @@ $(document.body).on('click', '.unfavorite', async (e) => {
         $('.toast').toast('show');
 
     }
-});
\ No newline at end of file
+});
+
+hydrateRecipeGrid();
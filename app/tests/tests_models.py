@@ -2,15 +2,27 @@
 
 import os
 from unittest import TestCase
+from unittest.mock import patch
 from decimal import Decimal
-from models import db, User, Cart, RecipeCart, Recipe, Ingredient, RecipeIngredient, Category, Conversion
+from models import db, statement_timeout, recipe_overlay, Favorite, User, Cart, RecipeCart, Recipe, Ingredient, RecipeIngredient, Category, Conversion, CatalogVersion
 
 
 os.environ['DATABASE_URL'] = "postgresql:///recipe-blank"
 
 from app import app
+from catalog import FacetIndex, RecipeCard, current_catalog_version, get_facet_index, invalidate_catalog_version
+from cache import LRUCache
+from aggregation import IngredientMatrix
+from seed import read_backup, read_source, load, export_snapshot, project, SeedError, BACKUP_PATH, CATALOG_TABLES
+from pooling import engine_options
+from commands import upgrade_schema
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.pool import NullPool
+import tempfile
+import gzip
 
-db.create_all()
+# Adds what the models gained since the test database was restored
+upgrade_schema()
 
 
 class UserModelTestCase(TestCase):
@@ -216,6 +228,44 @@ class CartModelTestCase(TestCase):
         self.assertEqual(len(cart.query_contents().all()), 1)
         self.assertEqual(cart.query_contents().all(), [(Decimal(2), recipe)])
     
+    def test_cart_contents_by_cart(self):
+        """Test batched loading of several carts' contents"""
+        cart1 = Cart(user_id=self.user_id)
+        cart2 = Cart(user_id=self.user_id)
+        cart3 = Cart(user_id=self.user_id)
+        recipe1 = Recipe(title='b_title', category='beef', prep_time=50, difficulty=2, spice_level=3)
+        recipe2 = Recipe(title='a_title', category='pork', prep_time=40, difficulty=1, spice_level=2)
+        db.session.add_all([cart1, cart2, cart3, recipe1, recipe2])
+        db.session.commit()
+        db.session.add(RecipeCart(recipe_id=recipe1.id, cart_id=cart1.id, quantity=1))
+        db.session.add(RecipeCart(recipe_id=recipe2.id, cart_id=cart1.id, quantity=3))
+        db.session.add(RecipeCart(recipe_id=recipe1.id, cart_id=cart2.id, quantity=2))
+        db.session.commit()
+        contents = Cart.contents_by_cart([cart1.id, cart2.id, cart3.id])
+        self.assertEqual(contents[cart1.id], [(Decimal(3), recipe2), (Decimal(1), recipe1)])
+        self.assertEqual(contents[cart2.id], [(Decimal(2), recipe1)])
+        self.assertEqual(contents[cart3.id], [])
+        self.assertEqual(Cart.contents_by_cart([]), {})
+
+    def test_recipe_overlay(self):
+        """Test cart and favorite ids are returned together, limited to the requested recipes"""
+        cart = Cart(user_id=self.user_id)
+        recipes = [Recipe(title=f'title{i}', category='beef', prep_time=50, difficulty=2, spice_level=3) for i in range(3)]
+        db.session.add_all([cart] + recipes)
+        db.session.commit()
+        r1, r2, r3 = [recipe.id for recipe in recipes]
+        db.session.add(RecipeCart(recipe_id=r1, cart_id=cart.id, quantity=1))
+        db.session.add(RecipeCart(recipe_id=r2, cart_id=cart.id, quantity=1))
+        self.assertTrue(Favorite.add(self.user_id, r2))
+        self.assertTrue(Favorite.add(self.user_id, r3))
+        self.assertFalse(Favorite.add(self.user_id, r3))
+        db.session.commit()
+
+        self.assertEqual(recipe_overlay(self.user_id, cart.id), ({r1, r2}, {r2, r3}))
+        self.assertEqual(recipe_overlay(self.user_id, cart.id, [r2, r3]), ({r2}, {r2, r3}))
+        self.assertEqual(recipe_overlay(self.user_id, None, [r1, r2]), (set(), {r2}))
+        self.assertEqual(recipe_overlay(self.user_id, cart.id, []), (set(), set()))
+
     def test_cart_ingredient_quantities(self):
         cart = Cart(user_id=self.user_id)
         recipe1 = Recipe(
@@ -258,4 +308,213 @@ class CartModelTestCase(TestCase):
         db.session.add(RecipeCart(recipe_id=recipe2.id, cart_id=cart.id, quantity=2))
         db.session.commit()
         total_ingredients = cart.query_ingredient_quantities().all()
-        self.assertEqual(total_ingredients, [('test_ingredient1', 'unit1', Decimal(23), 'test_grouping')])
\ No newline at end of file
+        self.assertEqual(total_ingredients, [('test_ingredient1', 'unit1', Decimal(23), 'test_grouping')])
+
+        matrix = IngredientMatrix.build(version=0)
+        self.assertEqual(matrix.totals(cart.recipe_quantities()),
+                         [(name, unit, float(qty), label) for name, unit, qty, label in total_ingredients])
+        self.assertEqual(matrix.totals({recipe1.id: 2}), [('test_ingredient1', 'unit1', 6.0, 'test_grouping')])
+
+
+class FacetIndexTestCase(TestCase):
+    """Test in-memory recipe facet index."""
+
+    def setUp(self):
+        self.index = FacetIndex([
+            RecipeCard(1, 'a', 'beef', 30, 1, 0, 2, None),
+            RecipeCard(2, 'b', 'pork', 45, 2, 1, 2, None),
+            RecipeCard(3, 'c', 'beef', 60, 2, 0, 2, None),
+            RecipeCard(4, 'd', 'seafood', 20, 3, 3, 2, None),
+        ], version=1)
+
+    def select_ids(self, filters, within=None):
+        return [card.id for card in self.index.select(self.index.filter(filters, within))]
+
+    def test_facet_filters(self):
+        filters = FacetIndex.parse_filters('beef', '60', '', '0')
+        self.assertEqual(self.select_ids(filters), [1, 3])
+        filters = FacetIndex.parse_filters('', '45', '2', None)
+        self.assertEqual(self.select_ids(filters), [2])
+        filters = FacetIndex.parse_filters(None, '10', None, None)
+        self.assertEqual(self.select_ids(filters), [])
+        self.assertIsNone(FacetIndex.parse_filters(None, 'abc', None, None))
+
+    def test_facet_within(self):
+        filters = FacetIndex.parse_filters(None, '60', None, None)
+        within = self.index.mask_for_ids([3, 4, 99])
+        self.assertEqual(self.select_ids(filters, within), [3, 4])
+
+    def test_facet_counts(self):
+        filters = FacetIndex.parse_filters('beef', '60', None, None)
+        counts = self.index.counts(filters)
+        self.assertEqual(counts['category'], {'beef': 2, 'pork': 1, 'seafood': 1, '': 4})
+        self.assertEqual(counts['difficulty'], {'1': 1, '2': 1, '3': 0, '': 2})
+
+    def test_catalog_version_bump(self):
+        CatalogVersion.query.delete()
+        db.session.commit()
+        self.assertEqual(CatalogVersion.current(), 0)
+        CatalogVersion.bump()
+        CatalogVersion.bump()
+        db.session.commit()
+        self.assertEqual(CatalogVersion.current(), 2)
+
+    def test_catalog_version_unavailable(self):
+        missing = ProgrammingError('SELECT', {}, Exception('relation "catalog_version" does not exist'))
+        invalidate_catalog_version()
+        try:
+            with patch('models.CatalogVersion.current', side_effect=missing) as current, \
+                    self.assertLogs('catalog', 'ERROR') as logs:
+                self.assertIsNone(current_catalog_version(60))
+                self.assertIsNone(current_catalog_version(60))
+                self.assertIsNone(get_facet_index(60))
+            # The failure is remembered for the check interval
+            self.assertEqual(current.call_count, 1)
+            self.assertEqual(len(logs.records), 1)
+        finally:
+            invalidate_catalog_version()
+        self.assertEqual(current_catalog_version(60), CatalogVersion.current())
+
+
+class LRUCacheTestCase(TestCase):
+    """Test size-bounded cache backends."""
+
+    def check_backend(self, cache):
+        cache.set('a', {'value': 1})
+        cache.set('b', {'value': 2})
+        self.assertEqual(cache.get('a'), {'value': 1})
+        cache.set('c', {'value': 3})
+        # 'b' was least recently used
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), {'value': 3})
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (2, 1, 2))
+
+    def test_memory_backend(self):
+        self.check_backend(LRUCache.from_config('memory', 2))
+
+    def test_sqlite_backend(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.check_backend(LRUCache.from_config('sqlite', 2, f'{tmp}/cache.sqlite'))
+
+    def test_sqlite_backend_after_fork(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = LRUCache.from_config('sqlite', 2, f'{tmp}/cache.sqlite')
+            # Nothing is opened until the cache is used, e.g. in a preloading master
+            self.assertIsNone(cache.backend._conn)
+            cache.set('a', {'value': 1})
+            inherited = cache.backend._conn
+
+            pid = os.fork()
+            if pid == 0:
+                ok = cache.backend._connection() is not inherited and cache.get('a') == {'value': 1}
+                os._exit(0 if ok else 1)
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(status, 0)
+            self.assertIs(cache.backend._connection(), inherited)
+
+
+class PoolingTestCase(TestCase):
+    """Test engine options and statement timeouts."""
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_engine_options(self):
+        options = engine_options({'DB_POOL_SIZE': '3', 'DB_POOL_PRE_PING': '0', 'DB_STATEMENT_TIMEOUT_MS': '2000'})
+        self.assertEqual(options['pool_size'], 3)
+        self.assertFalse(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'], {'options': '-c statement_timeout=2000'})
+        self.assertEqual(engine_options({'DATABASE_POOLER': 'pgbouncer'}), {'poolclass': NullPool})
+
+    def test_statement_timeout(self):
+        setting = "SELECT current_setting('statement_timeout')"
+        with statement_timeout(1500):
+            self.assertEqual(db.session.execute(setting).scalar(), '1500ms')
+        self.assertEqual(db.session.execute(setting).scalar(), '0')
+
+        with self.assertRaises(OperationalError) as cm:
+            with statement_timeout(50):
+                db.session.execute('SELECT pg_sleep(1)')
+        self.assertEqual(cm.exception.orig.pgcode, '57014')
+        db.session.rollback()
+        self.assertEqual(db.session.execute(setting).scalar(), '0')
+
+
+class SeedTestCase(TestCase):
+    """Test bulk loading the catalog from the backup and snapshots."""
+
+    def setUp(self):
+        Favorite.query.delete()
+        RecipeCart.query.delete()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_read_backup(self):
+        blocks = {name: (columns, data) for name, columns, data in read_backup(BACKUP_PATH)}
+        self.assertIn('recipes', blocks)
+        self.assertEqual(blocks['favorites'][0], ['id', 'recipe_id', 'user_id'])
+        self.assertEqual(project('1\t2\t3\n4\t5\t6\n', ['id', 'recipe_id', 'user_id'], ['recipe_id', 'user_id']),
+                         '2\t3\n5\t6\n')
+
+    def test_load_and_snapshot(self):
+        version = CatalogVersion.current()
+        counts = load(read_backup(BACKUP_PATH), CATALOG_TABLES)
+
+        self.assertEqual(set(counts), set(CATALOG_TABLES))
+        self.assertEqual(Recipe.query.count(), counts['recipes'])
+        self.assertEqual(RecipeIngredient.query.count(), counts['recipes_ingredients'])
+        self.assertEqual(CatalogVersion.current(), version + 1)
+        recipe = Recipe(title='Fresh Recipe')
+        db.session.add(recipe)
+        db.session.commit()
+        self.assertEqual(recipe.id, db.session.query(db.func.max(Recipe.id)).scalar())
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = f'{tmp}/catalog.snapshot.gz'
+            exported = export_snapshot(path)
+            self.assertEqual(exported['recipes'], counts['recipes'] + 1)
+            Recipe.query.delete()
+            db.session.commit()
+
+            self.assertEqual(load(read_source(path)), exported)
+            self.assertIsNotNone(Recipe.query.filter_by(title='Fresh Recipe').first())
+
+            with gzip.open(path, 'wt') as f:
+                f.write('{"format": "groceryhelper-snapshot", "version": 99, "tables": []}\n')
+            with self.assertRaises(SeedError):
+                load(read_source(path))
+
+    def test_load_keeps_user_data(self):
+        load(read_backup(BACKUP_PATH), CATALOG_TABLES)
+        recipe_id = db.session.query(db.func.min(Recipe.id)).scalar()
+        user = User(email='seed@test.com', username='seeduser', password='HASHED_PASSWORD')
+        db.session.add(user)
+        db.session.commit()
+        cart = Cart(name='Seed Cart', user_id=user.id)
+        db.session.add(cart)
+        db.session.commit()
+        user_id, cart_id = user.id, cart.id
+        db.session.add_all([Favorite(recipe_id=recipe_id, user_id=user_id),
+                            RecipeCart(recipe_id=recipe_id, cart_id=cart_id, quantity=2)])
+        db.session.commit()
+
+        try:
+            load(read_backup(BACKUP_PATH), CATALOG_TABLES)
+            self.assertEqual(Favorite.recipe_ids(user_id), {recipe_id})
+            self.assertEqual(RecipeCart.query.get((recipe_id, cart_id)).quantity, 2)
+
+            recipe = Recipe(title='Unsaved Recipe')
+            db.session.add(recipe)
+            db.session.commit()
+            db.session.add(Favorite(recipe_id=recipe.id, user_id=user_id))
+            db.session.commit()
+            with self.assertRaises(SeedError):
+                load(read_backup(BACKUP_PATH), CATALOG_TABLES)
+            self.assertEqual(Favorite.recipe_ids(user_id), {recipe_id, recipe.id})
+        finally:
+            db.session.rollback()
+            User.query.filter_by(id=user_id).delete()
+            db.session.commit()
@@ -3,16 +3,23 @@
 import os
 from unittest import TestCase
 from decimal import Decimal
+from unittest.mock import patch
 
 os.environ['DATABASE_URL'] = "postgresql:///recipe-test"
 
 
-from app import app, CURR_USER_KEY, CURR_CART_KEY
+from app import app, recipe_detail_cache, recipe_grid_cache, CURR_USER_KEY, CURR_CART_KEY
 from models import User, Cart, RecipeCart, db
+from commands import upgrade_schema
+from catalog import invalidate_catalog_version
+from sqlalchemy.exc import ProgrammingError
 
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Adds what the models gained since the test database was restored
+upgrade_schema()
+
 
 class RecipesViewTestCase(TestCase):
     """Test views for messages."""
@@ -67,6 +74,137 @@ class RecipesViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('No recipes found.', html)
 
+    def test_index_recipes_keyset(self):
+        """
+        Test index recipes route paginates with cursors in keyset mode
+        """
+        app.config['RECIPES_PAGINATION'] = 'keyset'
+        try:
+            with self.client as c:
+                resp = c.get('/recipes')
+                html = resp.get_data(as_text=True)
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn('Shumai Meatballs', html)
+                self.assertIn('cursor=', html)
+                self.assertNotIn('page=2', html)
+
+                resp = c.get('/recipes?cursor=not-a-cursor')
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn('Shumai Meatballs', resp.get_data(as_text=True))
+        finally:
+            app.config['RECIPES_PAGINATION'] = 'offset'
+
+    def test_index_recipes_image_srcset(self):
+        """
+        Test recipe cards only reference resized derivatives
+        when IMAGE_SRCSET is enabled
+        """
+        with self.client as c:
+            html = c.get('/recipes').get_data(as_text=True)
+            self.assertIn('.jpg', html)
+            self.assertNotIn('srcset', html)
+
+        app.config['IMAGE_SRCSET'] = True
+        try:
+            with self.client as c:
+                html = c.get('/recipes').get_data(as_text=True)
+                self.assertIn('-card.webp 400w', html)
+                self.assertIn('-hero.jpg 1200w', html)
+                self.assertIn('loading="lazy"', html)
+        finally:
+            app.config['IMAGE_SRCSET'] = False
+
+    def test_index_recipes_shared_grid(self):
+        """
+        Test shared grid mode renders cards without user state, caches
+        them, and makes anonymous pages publicly cacheable.
+        """
+        user_id, username = self.testuser.id, self.testuser.username
+        app.config['RECIPE_GRID_SHARED'] = True
+        try:
+            with self.client as c:
+                resp = c.get('/recipes?difficulty=2')
+                html = resp.get_data(as_text=True)
+                self.assertIn('Shumai Meatballs', html)
+                self.assertIn('data-hydrate-overlay', html)
+                self.assertIn('public', resp.headers['Cache-Control'])
+                hits = recipe_grid_cache.hits
+
+                resp = c.get('/recipes?difficulty=2', headers={'If-None-Match': resp.headers['ETag']})
+                self.assertEqual(resp.status_code, 304)
+                self.assertEqual(recipe_grid_cache.hits, hits + 1)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+                resp = c.get('/recipes?difficulty=2')
+                html = resp.get_data(as_text=True)
+                self.assertNotIn('public', resp.headers.get('Cache-Control', ''))
+                self.assertIn('favorite far fa-heart text-secondary d-none', html)
+                self.assertIn(username, html)
+                self.assertEqual(recipe_grid_cache.hits, hits + 2)
+
+                resp = c.get('/recipes?faves=on')
+                self.assertNotIn('data-hydrate-overlay', resp.get_data(as_text=True))
+        finally:
+            app.config['RECIPE_GRID_SHARED'] = False
+
+    def test_show_recipe_cached(self):
+        """
+        Test recipe detail route renders recipe and serves
+        repeat views from the recipe detail cache.
+        """
+        with self.client as c:
+            resp = c.get('/recipes/4')
+            self.assertEqual(resp.status_code, 200)
+            html = resp.get_data(as_text=True)
+            self.assertIn('chicken breast', html)
+
+            hits = recipe_detail_cache.hits
+            resp = c.get('/recipes/4')
+            self.assertEqual(resp.get_data(as_text=True), html)
+            self.assertEqual(recipe_detail_cache.hits, hits + 1)
+
+            resp = c.get('/recipes/999999')
+            self.assertEqual(resp.status_code, 404)
+
+    def test_show_recipe_without_catalog_version(self):
+        """
+        Test recipe detail route renders uncached when the
+        catalog version cannot be read.
+        """
+        with patch('models.CatalogVersion.current', side_effect=ProgrammingError('SELECT', {}, Exception())):
+            invalidate_catalog_version()
+            with self.client as c:
+                hits, misses = recipe_detail_cache.hits, recipe_detail_cache.misses
+                resp = c.get('/recipes/4')
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn('chicken breast', resp.get_data(as_text=True))
+                self.assertEqual((recipe_detail_cache.hits, recipe_detail_cache.misses), (hits, misses))
+        invalidate_catalog_version()
+
+    def test_request_metrics(self):
+        """
+        Test responses carry Server-Timing and the metrics route
+        aggregates them, only for requests bearing the token.
+        """
+        app.config['METRICS_TOKEN'] = 'test-token'
+        try:
+            with self.client as c:
+                self.assertEqual(c.get('/admin/metrics?reset=1', headers={'Authorization': 'Bearer test-token'}).status_code, 200)
+                resp = c.get('/recipes/4')
+                self.assertRegex(resp.headers['Server-Timing'], r'db;dur=[\d.]+;desc="\d+ queries"')
+                self.assertIn('render;dur=', resp.headers['Server-Timing'])
+
+                self.assertEqual(c.get('/admin/metrics').status_code, 404)
+                self.assertEqual(c.get('/api/cache/stats').status_code, 404)
+                stats = c.get('/api/cache/stats', headers={'Authorization': 'Bearer test-token'}).json
+                self.assertIn('hits', stats['recipe_detail'])
+                metrics = c.get('/admin/metrics', headers={'Authorization': 'Bearer test-token'}).json
+                self.assertEqual(metrics['show_recipe']['histograms']['total_ms']['count'], 1)
+                self.assertIn('render_ms', metrics['show_recipe']['histograms'])
+        finally:
+            app.config['METRICS_TOKEN'] = None
+
     def test_add_to_cart_no_user(self):
         """
         Test add to cart route requires active user.
@@ -88,6 +226,87 @@ class RecipesViewTestCase(TestCase):
             html = resp.get_data(as_text=True)
             self.assertEqual(resp.status_code, 202)
             self.assertIn("Recipe 1 added to cart", html)
+
+    def test_batch_update_cart(self):
+        """
+        Test batch cart route applies all operations in one request.
+        """
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            resp = c.post('/api/carts/batch', json={'operations': [
+                {'recipe_id': 1, 'delta': 2},
+                {'recipe_id': 4, 'delta': 1},
+                {'recipe_id': 1, 'delta': 1}]})
+            self.assertEqual(resp.status_code, 202)
+            cart = Cart.query.filter_by(user_id=self.testuser.id).one()
+            self.assertEqual(cart.recipe_quantities(), {1: Decimal(3), 4: Decimal(1)})
+
+            resp = c.post('/api/carts/batch', json={'operations': [{'recipe_id': 4, 'delta': -1}]})
+            self.assertEqual(resp.status_code, 202)
+            self.assertEqual(cart.recipe_quantities(), {1: Decimal(3)})
+
+            revision = db.session.query(Cart.revision).filter(Cart.id == cart.id).scalar()
+            resp = c.post('/api/carts/batch', json={'operations': [
+                {'recipe_id': 4, 'delta': 1},
+                {'recipe_id': 4, 'delta': -1}]})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json['data'], [])
+            self.assertEqual(db.session.query(Cart.revision).filter(Cart.id == cart.id).scalar(), revision)
+
+            resp = c.post('/api/carts/batch', json={'operations': [{'recipe_id': 999999, 'delta': 1}]})
+            self.assertEqual(resp.status_code, 404)
+            resp = c.post('/api/carts/batch', json={'operations': [{'recipe_id': 'x'}]})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_favorite_recipe(self):
+        """
+        Test favorite routes toggle a favorite once and the
+        favorites only filter lists it, from the index and from SQL.
+        """
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            try:
+                self.assertEqual(c.post('/api/recipes/4/favorite').status_code, 202)
+                self.assertEqual(c.post('/api/recipes/4/favorite').status_code, 405)
+
+                for facet_index in (True, False):
+                    app.config['RECIPES_FACET_INDEX'] = facet_index
+                    html = c.get('/recipes?faves=on').get_data(as_text=True)
+                    self.assertIn('Classic Chicken Piccata', html)
+                    self.assertNotIn('Shumai Meatballs', html)
+                    self.assertIn('unfavorite fas fa-heart text-danger" data-recipe-id="4"', html)
+            finally:
+                app.config['RECIPES_FACET_INDEX'] = True
+                self.assertEqual(c.post('/api/recipes/4/unfavorite').status_code, 202)
+            self.assertEqual(c.post('/api/recipes/4/unfavorite').status_code, 405)
+
+    def test_overlay(self):
+        """
+        Test overlay route reports cart and favorite state of the
+        requested recipes, and nothing for anonymous users.
+        """
+        user_id = self.testuser.id
+        with self.client as c:
+            resp = c.get('/api/overlay?ids=1,4')
+            self.assertEqual(resp.json, {'user': None, 'cart_id': None, 'cart': [], 'favorites': []})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            c.post('/api/recipes/1/add-to-cart')
+            c.post('/api/recipes/4/favorite')
+            try:
+                resp = c.get('/api/overlay?ids=1,4,24')
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual((resp.json['cart'], resp.json['favorites']), ([1], [4]))
+                self.assertIn('no-store', resp.headers['Cache-Control'])
+                self.assertEqual(c.get('/api/overlay?ids=24').json['cart'], [])
+                self.assertEqual(c.get('/api/overlay').json['favorites'], [4])
+                self.assertEqual(c.get('/api/overlay?ids=a,b').status_code, 400)
+            finally:
+                c.post('/api/recipes/4/unfavorite')
+
     def delete_carts_by_user(self, user_id):
         """
         Utility function for deleting all carts associated with user
@@ -229,6 +448,26 @@ class RecipesViewTestCase(TestCase):
             self.assertIn(f'Cart &#34;test_cart&#34; deleted.', html)
             self.assertEqual(len(Cart.query.filter_by(name='test_cart').all()), 0)
 
+    def test_delete_active_cart(self):
+        """
+        Test deleting the active cart clears it from the
+        cached session state.
+        """
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            cart = Cart(name='test_cart', user_id = self.testuser.id)
+            db.session.add(cart)
+            db.session.commit()
+            resp = c.post(f"/carts/{cart.id}/activate", follow_redirects=True)
+            html = resp.get_data(as_text=True)
+            self.assertNotIn("No Active Cart", html)
+
+            resp = c.post(f"/carts/{cart.id}/delete", follow_redirects=True)
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("No Active Cart", html)
+
     def test_checkout_no_user(self):
         """
         Test checkout route requires active user.
@@ -258,3 +497,109 @@ class RecipesViewTestCase(TestCase):
             html = resp.get_data(as_text=True)
             self.assertEqual(resp.status_code, 200)
             self.assertIn('39 ounce chicken breast', html)
+
+    def test_combined_checkout(self):
+        """
+        Test combined checkout aggregates several carts
+        without marking them complete.
+        """
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            cart1 = Cart(name='test_cart1', user_id = self.testuser.id)
+            cart2 = Cart(name='test_cart2', user_id = self.testuser.id)
+            db.session.add_all([cart1, cart2])
+            db.session.commit()
+            # 13oz chicken breast + 2 x 2 whole chicken breast (1 whole = 6.5oz)
+            db.session.add(RecipeCart(recipe_id=4, cart_id=cart1.id, quantity=1))
+            db.session.add(RecipeCart(recipe_id=24, cart_id=cart2.id, quantity=2))
+            db.session.commit()
+            cart1_id, cart2_id = cart1.id, cart2.id
+            resp = c.get(f"/carts/combined?cart_id={cart1_id}&cart_id={cart2_id}")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('39 ounce chicken breast', html)
+            self.assertIn('test_cart1 + test_cart2', html)
+            self.assertFalse(Cart.query.get(cart1_id).is_complete)
+
+            resp = c.post("/carts/combined", data={'cart_id': [cart1_id, cart2_id], 'mark_complete': '1'})
+            self.assertEqual(resp.status_code, 200)
+            db.session.expire_all()
+            self.assertTrue(Cart.query.get(cart1_id).is_complete)
+            self.assertTrue(Cart.query.get(cart2_id).is_complete)
+
+            resp = c.get("/carts/combined?cart_id=999999", follow_redirects=True)
+            self.assertIn('Forbidden Resource', resp.get_data(as_text=True))
+
+    def test_preview_checkout_conditional(self):
+        """
+        Test checkout preview leaves cart incomplete and answers
+        304 until the cart's revision changes.
+        """
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            cart = Cart(name='test_cart', user_id = self.testuser.id)
+            db.session.add(cart)
+            db.session.commit()
+            db.session.add(RecipeCart(recipe_id=4, cart_id=cart.id, quantity=1))
+            db.session.commit()
+            cart_id = cart.id
+            with c.session_transaction() as sess:
+                sess[CURR_CART_KEY] = cart_id
+
+            resp = c.get(f"/carts/{cart_id}/preview")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('13 ounce chicken breast', resp.get_data(as_text=True))
+            etag = resp.headers['ETag']
+            self.assertFalse(Cart.query.get(cart_id).is_complete)
+
+            resp = c.get(f"/api/carts/{cart_id}/grocery-list", headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+
+            c.post('/api/recipes/24/add-to-cart')
+            resp = c.get(f"/api/carts/{cart_id}/grocery-list", headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+            self.assertEqual(resp.json['cart']['revision'], 1)
+
+            # Without a readable catalog version the list is still served, unconditionally
+            try:
+                with patch('models.CatalogVersion.current', side_effect=ProgrammingError('SELECT', {}, Exception())):
+                    invalidate_catalog_version()
+                    resp = c.get(f"/api/carts/{cart_id}/grocery-list", headers={'If-None-Match': etag})
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertNotIn('ETag', resp.headers)
+
+                    # The matrix engine falls back to the SQL aggregation
+                    app.config['CHECKOUT_ENGINE'] = 'matrix'
+                    resp = c.get(f"/carts/{cart_id}/preview")
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertIn('26 ounce chicken breast', resp.get_data(as_text=True))
+            finally:
+                app.config['CHECKOUT_ENGINE'] = 'sql'
+                invalidate_catalog_version()
+
+    def test_copy_and_merge_cart_contents(self):
+        """
+        Test copied carts receive the source cart's recipes and
+        merging adds quantities into the active cart.
+        """
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            cart = Cart(name='test_cart', user_id=self.testuser.id, is_complete=True)
+            db.session.add(cart)
+            db.session.commit()
+            db.session.add(RecipeCart(recipe_id=4, cart_id=cart.id, quantity=1))
+            db.session.add(RecipeCart(recipe_id=24, cart_id=cart.id, quantity=2))
+            db.session.commit()
+            cart_id = cart.id
+
+            c.post(f"/carts/{cart_id}/copy")
+            copy = Cart.query.filter_by(name='test_cart(copy)').one()
+            self.assertEqual(copy.recipe_quantities(), {4: Decimal(1), 24: Decimal(2)})
+
+            resp = c.post(f"/carts/{cart_id}/merge", follow_redirects=True)
+            self.assertIn('added to &#34;test_cart(copy)&#34;', resp.get_data(as_text=True))
+            self.assertEqual(copy.recipe_quantities(), {4: Decimal(2), 24: Decimal(4)})
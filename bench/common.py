@@ -0,0 +1,33 @@
+"""Helpers shared by the benchmark scripts."""
+
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'app'))
+
+SERVER_TIMING_QUERIES = re.compile(r'db;[^,]*desc="(\d+) queries"')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0
+
+
+def query_count(response):
+    """Returns the SQL statement count reported in the Server-Timing header, or None."""
+    match = SERVER_TIMING_QUERIES.search(response.headers.get('Server-Timing', ''))
+    return int(match.group(1)) if match else None
+
+
+def git_commit():
+    """Returns (commit sha, whether the working tree has changes), or (None, None) outside git."""
+    try:
+        sha = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return sha, bool(status.strip())
@@ -0,0 +1,75 @@
+"""
+Compares two benchmark results files written by run.py.
+
+Flags a scenario as a regression when its p95 latency grew by more
+than --threshold percent or it issues at least half a SQL statement
+more per request.
+Exits with status 1 when any scenario regressed.
+
+Usage: python bench/compare.py bench/results/<base>.json bench/results/<new>.json [--threshold 10]
+"""
+
+import argparse
+import json
+import sys
+
+METRICS = ['p50_ms', 'p95_ms', 'p99_ms', 'req_per_s', 'queries_per_request']
+
+
+def change(old, new):
+    if old is None or new is None:
+        return '-'
+    if not old:
+        return 'n/a'
+    return f'{(new - old) / old * 100:+.0f}%'
+
+
+def regressions(base, new, threshold):
+    """Returns {scenario: [reasons]} for the scenarios of new that regressed against base."""
+    found = {}
+    for name, after in new['scenarios'].items():
+        before = base['scenarios'].get(name)
+        if before is None:
+            continue
+        reasons = []
+        if before['p95_ms'] and (after['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100 > threshold:
+            reasons.append(f'p95 {before["p95_ms"]} -> {after["p95_ms"]} ms')
+        if None not in (before['queries_per_request'], after['queries_per_request']) \
+                and after['queries_per_request'] >= before['queries_per_request'] + 0.5:
+            reasons.append(f'queries {before["queries_per_request"]} -> {after["queries_per_request"]}')
+        if reasons:
+            found[name] = reasons
+    return found
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('base')
+    argparser.add_argument('new')
+    argparser.add_argument('--threshold', type=float, default=10, help='Allowed p95 growth in percent')
+    args = argparser.parse_args()
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if any(base['scale'].get(table) != new['scale'].get(table) for table in ('recipes', 'users')):
+        print(f'WARNING - datasets differ: {base["scale"]} vs {new["scale"]}')
+
+    print(f'{(base["commit"] or "?")[:12]} -> {(new["commit"] or "?")[:12]}')
+    print(f'{"scenario":<14} ' + ' '.join(f'{metric:>20}' for metric in METRICS))
+    for name, after in new['scenarios'].items():
+        before = base['scenarios'].get(name)
+        if before is None:
+            print(f'{name:<14} (new)')
+            continue
+        print(f'{name:<14} ' + ' '.join(f'{f"{before[m]} -> {after[m]} {change(before[m], after[m])}":>20}' for m in METRICS))
+
+    found = regressions(base, new, args.threshold)
+    for name, reasons in found.items():
+        print(f'REGRESSION - {name}: {", ".join(reasons)}')
+    sys.exit(1 if found else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Connection pool saturation test.
+
+Drives one route from an increasing number of client threads against a
+single app process and reports throughput, latency percentiles and
+status codes for each level. Once the threads outnumber
+DB_POOL_SIZE + DB_MAX_OVERFLOW, requests queue for a connection and
+those that wait longer than DB_POOL_TIMEOUT are answered with 503.
+
+Pool settings are read from the environment like the app does, e.g.
+
+    DATABASE_URL=postgresql:///recipe DB_POOL_SIZE=4 DB_MAX_OVERFLOW=0 DB_POOL_TIMEOUT=1 \\
+        python bench/pool_saturation.py --threads 2,4,8,16 --query-ms 50
+
+--query-ms holds each request's connection with pg_sleep to stand in
+for a slow query, so saturation shows up on a small dataset.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+import argparse
+import os
+import time
+
+from common import percentile
+
+# Every request must reach the database for the pool to matter
+os.environ.setdefault('RECIPES_FACET_INDEX', '0')
+
+from app import app
+from models import db
+
+
+def run_level(path, threads, requests_per_thread):
+    """Returns (status counts, latencies in ms, elapsed seconds, peak connections checked out)."""
+    statuses = Counter()
+    latencies = []
+    peak = 0
+
+    def client():
+        nonlocal peak
+        test_client = app.test_client()
+        for _ in range(requests_per_thread):
+            start = time.perf_counter()
+            resp = test_client.get(path)
+            latencies.append((time.perf_counter() - start) * 1000)
+            statuses[resp.status_code] += 1
+            peak = max(peak, getattr(db.engine.pool, 'checkedout', lambda: 0)())
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for future in [executor.submit(client) for _ in range(threads)]:
+            future.result()
+    return statuses, latencies, time.perf_counter() - start, peak
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--path', default='/recipes?page=2')
+    argparser.add_argument('--threads', default='1,2,4,8,16,32', help='Comma separated client thread counts')
+    argparser.add_argument('--requests', type=int, default=20, help='Requests per thread at each level')
+    argparser.add_argument('--query-ms', type=int, default=0)
+    args = argparser.parse_args()
+
+    if args.query_ms:
+        @app.before_request
+        def hold_connection():
+            db.session.execute('SELECT pg_sleep(:seconds)', {'seconds': args.query_ms / 1000})
+
+    print(f'pool: {app.config["SQLALCHEMY_ENGINE_OPTIONS"]}')
+    print(f'{"threads":>7} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"peak conn":>9}  statuses')
+    for threads in [int(n) for n in args.threads.split(',')]:
+        db.engine.dispose()
+        statuses, latencies, elapsed, peak = run_level(args.path, threads, args.requests)
+        print(f'{threads:>7} {len(latencies) / elapsed:>8.1f} {percentile(latencies, 50):>8.1f} '
+              f'{percentile(latencies, 95):>8.1f} {percentile(latencies, 99):>8.1f} {peak:>9}  '
+              f'{dict(sorted(statuses.items()))}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""
+Benchmarks the hot routes through the WSGI app.
+
+Each scenario sends --requests requests, after --warmup unmeasured ones,
+through Flask's test client from --concurrency threads, against the
+database in DATABASE_URL (see synthetic.py). Reports p50/p95/p99
+latency, requests per second and SQL statements per request (read from
+the Server-Timing header), and writes them with the commit and dataset
+scale to bench/results/<commit>.json for compare.py.
+
+Usage: DATABASE_URL=postgresql:///recipe-bench python bench/run.py [--scenarios recipes,checkout]
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, defaultdict, namedtuple
+from datetime import datetime
+from urllib.parse import urlencode
+import argparse
+import json
+import os
+import random
+import time
+
+from common import ROOT, percentile, query_count, git_commit
+
+os.environ.setdefault('SERVER_TIMING', '1')
+# Statements per request are reported in the results instead
+os.environ.setdefault('QUERY_BUDGET', '0')
+
+from app import app, CURR_USER_KEY, CURR_CART_KEY
+from models import db, Recipe, User, Cart, RecipeCart, Favorite
+from sqlalchemy import func
+
+Request = namedtuple('Request', 'method path user_id cart_id json', defaults=(None, None, None))
+
+FILTERS = [{}, {'category': 'beef'}, {'difficulty': 2, 'spice': 0}, {'category': 'poultry', 'time': 30},
+           {'spice': 3, 'time': 45}, {'category': 'vegetarian', 'difficulty': 1}]
+
+
+class Sample:
+    """Ids drawn from the benchmark database that scenarios build requests from."""
+
+    def __init__(self, rng, size=1000, heavy_users=10):
+        self.min_recipe, self.max_recipe = db.session.query(func.min(Recipe.id), func.max(Recipe.id)).one()
+        min_user, max_user = db.session.query(func.min(User.id), func.max(User.id)).one()
+        if self.min_recipe is None or min_user is None:
+            raise SystemExit('The benchmark database has no recipes or users, run synthetic.py first')
+        user_ids = {rng.randint(min_user, max_user) for _ in range(size)}
+        # (user id, id of the user's newest cart). Completion is ignored to
+        # draw the same carts even if a checkout run was interrupted.
+        self.shoppers = sorted(db.session.query(Cart.user_id, func.max(Cart.id))
+                               .filter(Cart.user_id.in_(user_ids))
+                               .group_by(Cart.user_id))
+        self.open_carts = [cart_id for cart_id, in db.session.query(Cart.id)
+                           .filter(Cart.id.in_([cart_id for _, cart_id in self.shoppers]), Cart.is_complete.is_(False))]
+        self.favorites = defaultdict(set)
+        for user_id, recipe_id in db.session.query(Favorite.user_id, Favorite.recipe_id) \
+                .filter(Favorite.user_id.in_(user_ids)):
+            self.favorites[user_id].add(recipe_id)
+        self.heavy_users = [user_id for user_id, in db.session.query(Cart.user_id)
+                            .group_by(Cart.user_id)
+                            .order_by(func.count().desc(), Cart.user_id)
+                            .limit(heavy_users)]
+
+    def recipe_id(self, rng):
+        return rng.randint(self.min_recipe, self.max_recipe)
+
+    def shopper(self, rng):
+        return rng.choice(self.shoppers)
+
+
+def recipes_url(rng, **args):
+    return '/recipes?' + urlencode(dict(rng.choice(FILTERS), page=rng.randint(1, 3), **args))
+
+
+def checkout(sample, rng):
+    """Checks out a cart; reopen_carts undoes the completion after the run."""
+    user_id, cart_id = sample.shopper(rng)
+    return [Request('GET', f'/carts/{cart_id}/checkout', user_id, cart_id)]
+
+
+def reopen_carts(sample):
+    """Marks the sampled carts that were open before the run as open again."""
+    Cart.query.filter(Cart.id.in_(sample.open_carts)).update({Cart.is_complete: False}, synchronize_session=False)
+    db.session.commit()
+
+
+def add_to_cart(sample, rng):
+    """Adds a recipe, then takes it out again so repeated runs see the same carts."""
+    user_id, cart_id = sample.shopper(rng)
+    recipe_id = sample.recipe_id(rng)
+    return [Request('POST', f'/api/recipes/{recipe_id}/add-to-cart', user_id, cart_id),
+            Request('POST', '/api/carts/batch', user_id, cart_id, {'operations': [{'recipe_id': recipe_id, 'delta': -1}]})]
+
+
+def favorite(sample, rng):
+    """
+    Favorites a recipe the shopper has not favorited, then unfavorites
+    it so repeated runs see the same favorites.
+    """
+    user_id, cart_id = sample.shopper(rng)
+    recipe_id = sample.recipe_id(rng)
+    while recipe_id in sample.favorites[user_id]:
+        recipe_id = sample.recipe_id(rng)
+    return [Request('POST', f'/api/recipes/{recipe_id}/favorite', user_id, cart_id),
+            Request('POST', f'/api/recipes/{recipe_id}/unfavorite', user_id, cart_id)]
+
+
+# Each scenario returns the requests of one iteration; all of them are measured.
+SCENARIOS = {
+    'recipes': lambda sample, rng: [Request('GET', recipes_url(rng))],
+    'recipes_user': lambda sample, rng: [Request('GET', recipes_url(rng), *sample.shopper(rng))],
+    'recipes_faves': lambda sample, rng: [Request('GET', recipes_url(rng, faves='on'), *sample.shopper(rng))],
+    'recipe': lambda sample, rng: [Request('GET', f'/recipes/{sample.recipe_id(rng)}')],
+    'carts': lambda sample, rng: [Request('GET', '/carts', rng.choice(sample.heavy_users))],
+    'checkout': checkout,
+    'add_to_cart': add_to_cart,
+    'favorite': favorite,
+}
+
+# Undo the changes a scenario leaves behind, run after it.
+RESTORE = {
+    'checkout': reopen_carts,
+}
+
+
+def send(client, request):
+    """Sends request as its user. Returns (latency in ms, status code, SQL statements or None)."""
+    with client.session_transaction() as sess:
+        sess.clear()
+        if request.user_id is not None:
+            sess[CURR_USER_KEY] = request.user_id
+        if request.cart_id is not None:
+            sess[CURR_CART_KEY] = request.cart_id
+    start = time.perf_counter()
+    resp = client.open(request.path, method=request.method, json=request.json)
+    latency = (time.perf_counter() - start) * 1000
+    return latency, resp.status_code, query_count(resp)
+
+
+def run_scenario(name, sample, requests, warmup, concurrency, seed):
+    build = SCENARIOS[name]
+
+    def worker(index, count):
+        rng = random.Random(f'{seed}-{name}-{index}')
+        client = app.test_client()
+        results = []
+        while len(results) < count:
+            results += [send(client, request) for request in build(sample, rng)]
+        return results
+
+    worker('warmup', warmup)
+    counts = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = [result for future in [executor.submit(worker, i, count) for i, count in enumerate(counts)]
+                   for result in future.result()]
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for latency, _, _ in results]
+    queries = [count for _, _, count in results if count is not None]
+    return {'requests': len(results),
+            'statuses': {str(status): count for status, count in sorted(Counter(status for _, status, _ in results).items())},
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'mean_ms': round(sum(latencies) / len(latencies), 3) if latencies else 0,
+            'req_per_s': round(len(results) / elapsed, 1) if elapsed else 0,
+            'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None}
+
+
+def scale():
+    return {model.__tablename__: db.session.query(func.count()).select_from(model).scalar()
+            for model in (Recipe, User, Cart, RecipeCart, Favorite)}
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma separated, from: ' + ', '.join(SCENARIOS))
+    argparser.add_argument('--requests', type=int, default=200, help='Measured requests per scenario')
+    argparser.add_argument('--warmup', type=int, default=20)
+    argparser.add_argument('--concurrency', type=int, default=1)
+    argparser.add_argument('--seed', type=int, default=0)
+    argparser.add_argument('--output', help='Results file (default: bench/results/<commit>.json)')
+    args = argparser.parse_args()
+
+    names = args.scenarios.split(',')
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        argparser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+    with app.app_context():
+        sample = Sample(random.Random(args.seed))
+        dataset = scale()
+        db.session.remove()
+
+    commit, dirty = git_commit()
+    results = {'commit': commit, 'dirty': dirty, 'created': datetime.utcnow().isoformat(timespec='seconds'),
+               'scale': dataset,
+               'settings': {'requests': args.requests, 'warmup': args.warmup, 'concurrency': args.concurrency,
+                            'seed': args.seed,
+                            **{key: app.config[key] for key in ('CHECKOUT_ENGINE', 'RECIPES_PAGINATION', 'RECIPES_FACET_INDEX')}},
+               'scenarios': {}}
+    print(f'{"scenario":<14} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"queries":>8}  statuses')
+    for name in names:
+        summary = run_scenario(name, sample, args.requests, args.warmup, args.concurrency, args.seed)
+        if name in RESTORE:
+            with app.app_context():
+                RESTORE[name](sample)
+        results['scenarios'][name] = summary
+        print(f'{name:<14} {summary["req_per_s"]:>8} {summary["p50_ms"]:>8.1f} {summary["p95_ms"]:>8.1f} '
+              f'{summary["p99_ms"]:>8.1f} {"-" if summary["queries_per_request"] is None else summary["queries_per_request"]:>8}  '
+              f'{summary["statuses"]}')
+
+    output = args.output or os.path.join(ROOT, 'bench', 'results',
+                                         f'{(commit or "unknown")[:12]}{"-dirty" if dirty else ""}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {os.path.normpath(output)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Synthetic catalog and user base for benchmarks.
+
+Replaces every table of the database in DATABASE_URL with generated
+rows, loaded with COPY through seed.load. Generation is deterministic
+for a given --seed, so runs at the same scale are comparable.
+
+Most users get a few carts, and the first --heavy-users users get
+--heavy-carts carts each, to exercise cart history pagination.
+Every user's password is 'benchmark'.
+
+Usage: DATABASE_URL=postgresql:///recipe-bench python bench/synthetic.py --recipes 10000 --users 100000 --yes
+"""
+
+import argparse
+import random
+
+import common  # noqa: F401 (puts app/ on sys.path)
+from app import app
+from models import db, bcrypt
+from seed import load
+
+PROTEINS = ['beef', 'pork', 'poultry', 'seafood', 'vegetarian']
+LABELS = ['Baked Goods', 'Beverages', 'Dairy and Eggs', 'Fruits', 'Grains and Pasta', 'Legumes', 'Meat',
+          'Nuts and Seeds', 'Oils', 'Seafood', 'Seasonings', 'Soups, Sauces, and Gravies', 'Sugars and Jellies',
+          'Vegetables']
+UNITS = ['ounce', 'pound', 'cup', 'tablespoon', 'teaspoon', 'whole', 'clove', 'pinch']
+UPDATED_AT = '2020-01-01 00:00:00'
+
+
+def block(table, columns, rows):
+    """Returns a (table, columns, data) block with rows in COPY text format."""
+    return table, columns, ''.join('\t'.join(str(value) for value in row) + '\n' for row in rows)
+
+
+def generate(recipes, users, carts_per_user=2, recipes_per_cart=4, favorites_per_user=5,
+             heavy_users=10, heavy_carts=500, ingredients=2000, ingredients_per_recipe=8,
+             steps_per_recipe=6, seed=0):
+    """Yields the (table, columns, data) blocks of a synthetic database."""
+    rng = random.Random(seed)
+    password = bcrypt.generate_password_hash('benchmark').decode('UTF-8')
+
+    yield block('categories', ['id', 'category_label'], enumerate(LABELS, 1))
+    yield block('conversions', ['id', 'unit_from', 'unit_to', 'food_type', 'conversion_factor'],
+                [(i, unit, unit, 'General', 1) for i, unit in enumerate(UNITS, 1)])
+    units = [rng.randrange(len(UNITS)) for _ in range(ingredients)]
+    yield block('ingredients', ['id', 'food_name', 'unit', 'category_id', 'conversion_id'],
+                [(i, f'ingredient {i}', UNITS[unit], rng.randint(1, len(LABELS)), unit + 1)
+                 for i, unit in enumerate(units, 1)])
+    yield block('recipes', ['id', 'title', 'category', 'prep_time', 'difficulty', 'spice_level', 'servings', 'image'],
+                [(i, f'Synthetic Recipe {i}', rng.choice(PROTEINS), rng.randrange(10, 65, 5),
+                  rng.randint(1, 3), rng.randint(0, 3), rng.choice([2, 4, 6]), f'{i:010x}')
+                 for i in range(1, recipes + 1)])
+    yield block('recipes_ingredients', ['recipe_id', 'ingredient_id', 'quantity'],
+                [(recipe_id, ingredient_id, rng.randint(1, 16) / 4)
+                 for recipe_id in range(1, recipes + 1)
+                 for ingredient_id in rng.sample(range(1, ingredients + 1), ingredients_per_recipe)])
+    yield block('steps', ['id', 'recipe_id', 'step_number', 'description'],
+                [((recipe_id - 1) * steps_per_recipe + number, recipe_id, number, f'Step {number} of recipe {recipe_id}.')
+                 for recipe_id in range(1, recipes + 1) for number in range(1, steps_per_recipe + 1)])
+    yield block('users', ['id', 'username', 'email', 'password'],
+                [(i, f'bench-user-{i}', f'bench-user-{i}@example.com', password) for i in range(1, users + 1)])
+
+    carts, contents = [], []
+    for user_id in range(1, users + 1):
+        count = heavy_carts if user_id <= heavy_users else carts_per_user
+        for n in range(count):
+            cart_id = len(carts) + 1
+            # The newest cart is still being filled, older ones were checked out
+            is_complete = 'f' if n == count - 1 else 't'
+            carts.append((cart_id, f'Cart {n + 1}', user_id, is_complete, 0, UPDATED_AT))
+            contents += [(recipe_id, cart_id, rng.randint(1, 3))
+                         for recipe_id in rng.sample(range(1, recipes + 1), recipes_per_cart)]
+    yield block('carts', ['id', 'name', 'user_id', 'is_complete', 'revision', 'updated_at'], carts)
+    yield block('recipes_carts', ['recipe_id', 'cart_id', 'quantity'], contents)
+    yield block('favorites', ['recipe_id', 'user_id'],
+                [(recipe_id, user_id) for user_id in range(1, users + 1)
+                 for recipe_id in rng.sample(range(1, recipes + 1), favorites_per_user)])
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--recipes', type=int, default=10000)
+    argparser.add_argument('--users', type=int, default=100000)
+    argparser.add_argument('--carts-per-user', type=int, default=2)
+    argparser.add_argument('--recipes-per-cart', type=int, default=4)
+    argparser.add_argument('--favorites-per-user', type=int, default=5)
+    argparser.add_argument('--heavy-users', type=int, default=10)
+    argparser.add_argument('--heavy-carts', type=int, default=500)
+    argparser.add_argument('--seed', type=int, default=0)
+    argparser.add_argument('--yes', action='store_true', help='Confirm replacing every table of the database')
+    args = argparser.parse_args()
+
+    if not args.yes:
+        argparser.error(f'this replaces every table of {app.config["SQLALCHEMY_DATABASE_URI"]}; pass --yes to continue')
+    with app.app_context():
+        db.create_all()
+        counts = load(generate(args.recipes, args.users, args.carts_per_user, args.recipes_per_cart,
+                               args.favorites_per_user, args.heavy_users, args.heavy_carts, seed=args.seed))
+    for table, count in counts.items():
+        print(f'{table}: {count} rows')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Persistent cache for Edamam and USDA lookups.
+
+Ingredient strings and food names repeat across hundreds of recipes,
+so lookups are stored in a local sqlite file keyed by namespace and
+normalized key. Negative results (no match) are cached too, with a
+shorter lifetime, so unparseable ingredients are not re-queried.
+
+Usage: python api_cache.py [--path api_cache.sqlite] {stats,purge}
+"""
+
+from threading import Lock
+import argparse
+import sqlite3
+import json
+import time
+import re
+
+DAY = 24 * 60 * 60
+
+
+class NoResult(LookupError):
+    """Raised when an API answered but had no match for the lookup."""
+
+
+def normalize(key):
+    return re.sub(r'\s+', ' ', key).strip().lower()
+
+
+class ApiCache():
+    """
+    sqlite-backed lookup cache with per-entry expiry.
+    ttl and negative_ttl are in seconds; None keeps entries forever.
+    Hit and miss counters cover the lifetime of this object.
+    """
+    def __init__(self, path, ttl=90 * DAY, negative_ttl=7 * DAY):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS lookups '
+                           '(namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT, '
+                           'fetched_at REAL NOT NULL, PRIMARY KEY (namespace, key))')
+
+    def _expired(self, value, fetched_at):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        return ttl is not None and fetched_at + ttl < time.time()
+
+    def get(self, namespace, key):
+        """
+        Returns (found, value). value is None for a cached negative result.
+        Expired entries count as not found.
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT value, fetched_at FROM lookups WHERE namespace = ? AND key = ?',
+                                     (namespace, normalize(key))).fetchone()
+            value = json.loads(row[0]) if row and row[0] is not None else None
+            if row is None or self._expired(value, row[1]):
+                self.misses += 1
+                return False, None
+            if value is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return True, value
+
+    def set(self, namespace, key, value):
+        """Stores value for key; None records a negative result."""
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO lookups (namespace, key, value, fetched_at) '
+                               'VALUES (?, ?, ?, ?)',
+                               (namespace, normalize(key),
+                                json.dumps(value) if value is not None else None, time.time()))
+
+    def lookup(self, namespace, key, fetch):
+        """
+        Returns the cached value for key, calling fetch(key) on a miss.
+        NoResult raised by fetch is cached and re-raised on later hits.
+        """
+        found, value = self.get(namespace, key)
+        if found:
+            if value is None:
+                raise NoResult(key)
+            return value
+        try:
+            value = fetch(key)
+        except NoResult:
+            self.set(namespace, key, None)
+            raise
+        self.set(namespace, key, value)
+        return value
+
+    def purge_expired(self):
+        """Deletes expired entries. Returns the number deleted."""
+        now = time.time()
+        with self._lock:
+            deleted = 0
+            if self.ttl is not None:
+                deleted += self._conn.execute('DELETE FROM lookups WHERE value IS NOT NULL AND fetched_at < ?',
+                                              (now - self.ttl,)).rowcount
+            if self.negative_ttl is not None:
+                deleted += self._conn.execute('DELETE FROM lookups WHERE value IS NULL AND fetched_at < ?',
+                                              (now - self.negative_ttl,)).rowcount
+            return deleted
+
+    def stats(self):
+        with self._lock:
+            entries = dict(self._conn.execute('SELECT namespace, COUNT(*) FROM lookups GROUP BY namespace'))
+        lookups = self.hits + self.negative_hits + self.misses
+        return {"entries": entries,
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.negative_hits) / lookups if lookups else None}
+
+    def close(self):
+        self._conn.close()
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--path', default='api_cache.sqlite')
+    argparser.add_argument('action', choices=['stats', 'purge'])
+    args = argparser.parse_args()
+
+    cache = ApiCache(args.path)
+    if args.action == 'purge':
+        print(f'Deleted {cache.purge_expired()} expired entries')
+    print(json.dumps(cache.stats(), indent=4))
+    cache.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Crawl state store.
+
+Replaces the visited_urls.txt / unparseable_urls.txt JSON lists with a
+sqlite table holding one row per recipe url: its status, the content
+hash, ETag and Last-Modified of the page and when it was last fetched.
+Statuses are also kept in memory, so membership checks are O(1), and
+each update writes a single row instead of rewriting a whole file.
+
+Usage: python crawl_state.py [--path crawl_state.sqlite] stats
+       python crawl_state.py [--path crawl_state.sqlite] import visited_urls.txt unparseable_urls.txt
+"""
+
+from threading import Lock
+import argparse
+import hashlib
+import sqlite3
+import json
+import time
+import os
+
+DONE = 'done'
+UNPARSEABLE = 'unparseable'
+FAILED = 'failed'
+# A refetched page that differs from the one already committed
+CHANGED = 'changed'
+
+# Statuses that are not crawled again unless a refetch is requested
+FINISHED = {DONE, UNPARSEABLE, CHANGED}
+
+
+def content_hash(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+class CrawlState():
+    """Per-url crawl status backed by a sqlite file."""
+    def __init__(self, path):
+        self._lock = Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS urls '
+                           '(url TEXT PRIMARY KEY, category TEXT, status TEXT NOT NULL, '
+                           'content_hash TEXT, etag TEXT, last_modified TEXT, '
+                           'fetched_at REAL, error TEXT)')
+        self._status = dict(self._conn.execute('SELECT url, status FROM urls'))
+
+    def status(self, url):
+        return self._status.get(url)
+
+    def __contains__(self, url):
+        return url in self._status
+
+    def pending(self, targets, refetch=False):
+        """
+        Returns the (url, category) targets that still need crawling.
+        With refetch, finished pages are included to check for changes.
+        """
+        if refetch:
+            return [(url, category) for url, category in targets if self._status.get(url) != UNPARSEABLE]
+        return [(url, category) for url, category in targets if self._status.get(url) not in FINISHED]
+
+    def entry(self, url):
+        with self._lock:
+            row = self._conn.execute('SELECT url, category, status, content_hash, etag, last_modified, '
+                                     'fetched_at, error FROM urls WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(['url', 'category', 'status', 'content_hash', 'etag',
+                         'last_modified', 'fetched_at', 'error'], row))
+
+    def conditional_headers(self, url):
+        """If-None-Match / If-Modified-Since headers for refetching a finished page."""
+        entry = self.entry(url)
+        headers = {}
+        if entry and entry['status'] in FINISHED:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def mark(self, url, category, status, response=None, error=None):
+        """
+        Records the outcome for url. response is the requests.Response
+        of the page, if it was fetched, and supplies the hash and
+        validators used for change detection.
+        """
+        previous = self.entry(url) or {}
+        values = {'content_hash': previous.get('content_hash'), 'etag': previous.get('etag'),
+                  'last_modified': previous.get('last_modified'), 'fetched_at': previous.get('fetched_at')}
+        if response is not None:
+            values = {'content_hash': content_hash(response.content),
+                      'etag': response.headers.get('ETag'),
+                      'last_modified': response.headers.get('Last-Modified'),
+                      'fetched_at': time.time()}
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO urls (url, category, status, content_hash, etag, '
+                               'last_modified, fetched_at, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (url, category, status, values['content_hash'], values['etag'],
+                                values['last_modified'], values['fetched_at'],
+                                repr(error) if error is not None else None))
+            self._status[url] = status
+
+    def touch(self, url):
+        """Records that a refetch found the page unchanged."""
+        with self._lock:
+            self._conn.execute('UPDATE urls SET fetched_at = ? WHERE url = ?', (time.time(), url))
+
+    def import_legacy(self, visited_path, unparseable_path):
+        """
+        Imports the JSON list files written by older versions of
+        scrape.py. Urls already in the store are left as they are.
+        Returns the number of urls imported.
+        """
+        imported = 0
+        for path, status in [(visited_path, DONE), (unparseable_path, UNPARSEABLE)]:
+            if not os.path.exists(path):
+                continue
+            with open(path) as f:
+                entries = json.load(f)
+            with self._lock:
+                for url, category in entries:
+                    if url not in self._status:
+                        self._conn.execute('INSERT INTO urls (url, category, status) VALUES (?, ?, ?)',
+                                           (url, category, status))
+                        self._status[url] = status
+                        imported += 1
+        return imported
+
+    def counts(self):
+        counts = {}
+        for status in self._status.values():
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    def close(self):
+        self._conn.close()
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--path', default='crawl_state.sqlite')
+    subparsers = argparser.add_subparsers(dest='action', required=True)
+    subparsers.add_parser('stats')
+    import_parser = subparsers.add_parser('import')
+    import_parser.add_argument('visited')
+    import_parser.add_argument('unparseable')
+    args = argparser.parse_args()
+
+    state = CrawlState(args.path)
+    if args.action == 'import':
+        print(f'Imported {state.import_legacy(args.visited, args.unparseable)} urls')
+    print(json.dumps(state.counts(), indent=4))
+    state.close()
+
+
+if __name__ == '__main__':
+    main()
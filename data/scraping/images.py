@@ -0,0 +1,145 @@
+"""
+Recipe image pipeline.
+
+Downloads recipe images concurrently and, in a process pool, saves
+the full-size JPEG plus smaller derivatives for the recipe cards and
+the recipe page, each as JPEG and WebP. Files are named after the
+first 10 hex digits of the sha1 of the downloaded image, so
+re-downloading the same image is a no-op:
+
+    <name>.jpg  <name>-card.jpg  <name>-card.webp  <name>-hero.jpg  <name>-hero.webp
+
+The widths must match the srcset emitted by generate_image_srcset in
+app/templates/macros.html. The recipe pages always offer the WebP
+derivatives, so Pillow must be built with WebP support.
+
+Usage: python images.py records.jsonl static/images [--workers N]
+       python images.py --derive-existing static/images
+"""
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import argparse
+import hashlib
+import json
+import io
+import os
+
+from PIL import Image, features
+import requests
+
+SIZES = {'card': 400, 'hero': 1200}
+QUALITY = 85
+
+
+def image_name(content):
+    return hashlib.sha1(content).hexdigest()[:10]
+
+
+def resized(image, width):
+    """Scales image down to width, keeping its aspect ratio. Never upscales."""
+    if image.width <= width:
+        return image
+    height = round(image.height * width / image.width)
+    return image.resize((width, height), Image.LANCZOS)
+
+
+def require_webp():
+    """Raises RuntimeError if Pillow cannot write the WebP derivatives."""
+    if not features.check('webp'):
+        raise RuntimeError('Pillow was built without WebP support, which the recipe image srcset needs')
+
+
+def save_derivatives(content, folder_path, file_name=None):
+    """
+    Decodes the image bytes and writes the full-size JPEG and every
+    derivative that does not exist yet. Returns the file name stem.
+    Runs in worker processes, so it only takes picklable arguments.
+    """
+    require_webp()
+    file_name = file_name or image_name(content)
+    image = Image.open(io.BytesIO(content)).convert('RGB')
+    outputs = [(os.path.join(folder_path, file_name + '.jpg'), image, 'JPEG')]
+    for size, width in SIZES.items():
+        derivative = resized(image, width)
+        outputs.append((os.path.join(folder_path, f'{file_name}-{size}.jpg'), derivative, 'JPEG'))
+        outputs.append((os.path.join(folder_path, f'{file_name}-{size}.webp'), derivative, 'WEBP'))
+    for path, output, image_format in outputs:
+        if not os.path.exists(path):
+            # Write to a temporary name so readers never see half-written files
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            output.save(tmp_path, image_format, quality=QUALITY)
+            os.replace(tmp_path, path)
+    return file_name
+
+
+def download(session, url):
+    res = session.get(url, timeout=30)
+    res.raise_for_status()
+    return res.content
+
+
+def persist_images(urls, folder_path, workers=None, download_workers=8):
+    """
+    Downloads urls concurrently and saves their derivatives in a process pool.
+    Returns {url: file name, or None if it could not be downloaded or decoded}.
+    """
+    require_webp()
+    results = {}
+    session = requests.Session()
+    with ThreadPoolExecutor(max_workers=download_workers) as downloads, \
+            ProcessPoolExecutor(max_workers=workers) as processes:
+        contents = {url: downloads.submit(download, session, url) for url in urls}
+        saved = {}
+        for url, future in contents.items():
+            try:
+                saved[url] = processes.submit(save_derivatives, future.result(), folder_path)
+            except requests.RequestException as e:
+                print(f'ERROR - Could not download {url} - {e}')
+                results[url] = None
+        for url, future in saved.items():
+            try:
+                results[url] = future.result()
+            except (OSError, ValueError) as e:
+                print(f'ERROR - Could not save {url} - {e}')
+                results[url] = None
+    session.close()
+    return results
+
+
+def derive_existing(folder_path, workers=None):
+    """
+    Creates the missing derivatives for full-size images saved before
+    derivatives existed. Returns the number of images processed.
+    """
+    names = [name[:-len('.jpg')] for name in os.listdir(folder_path)
+             if name.endswith('.jpg') and '-' not in name]
+    contents = []
+    for name in names:
+        with open(os.path.join(folder_path, name + '.jpg'), 'rb') as f:
+            contents.append(f.read())
+    with ProcessPoolExecutor(max_workers=workers) as processes:
+        list(processes.map(save_derivatives, contents, [folder_path] * len(names), names))
+    return len(names)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('records', nargs='?', help='JSONL records with an image_url, e.g. from offline.py')
+    argparser.add_argument('folder')
+    argparser.add_argument('--workers', type=int, default=os.cpu_count())
+    argparser.add_argument('--derive-existing', action='store_true',
+                           help='Only add derivatives for the full-size images already in folder')
+    args = argparser.parse_args()
+
+    if args.derive_existing:
+        print(f'{derive_existing(args.folder, args.workers)} images processed')
+        return
+    with open(args.records) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    urls = sorted({record['image_url'] for record in records if record.get('image_url')})
+    results = persist_images(urls, args.folder, args.workers)
+    print(f'{sum(1 for name in results.values() if name)} of {len(urls)} images saved')
+
+
+if __name__ == '__main__':
+    main()
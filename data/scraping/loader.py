@@ -0,0 +1,166 @@
+"""
+Bulk loader for parsed recipes.
+
+Writes a batch of parsed recipes (recipe, steps, categories, ingredients
+and recipe/ingredient links) in a single transaction, with one
+multi-row statement per table instead of one commit per row.
+
+Records are dicts as returned by RecipeParser.as_record(), with
+ingredients_parsed filled in and image set to the saved file name.
+
+Usage: python loader.py records.jsonl [--batch-size N]
+"""
+
+from collections import defaultdict
+from decimal import Decimal
+import argparse
+import json
+
+from sqlalchemy import text, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, Recipe, Step, Category, Ingredient, Conversion, RecipeIngredient, CatalogVersion
+
+
+def reserve_recipe_ids(count):
+    """Draws count ids from the recipes sequence in one round trip."""
+    rows = db.session.execute(text("SELECT nextval(pg_get_serial_sequence('recipes', 'id')) "
+                                   "FROM generate_series(1, :count)"), {'count': count})
+    return [row[0] for row in rows]
+
+
+def upsert_categories(records):
+    categories = {ingr['food_category']['id']: ingr['food_category']['description']
+                  for record in records for ingr in record['ingredients_parsed']}
+    if categories:
+        db.session.execute(insert(Category.__table__)
+                           .values([{'id': cat_id, 'category_label': label} for cat_id, label in categories.items()])
+                           .on_conflict_do_nothing(index_elements=['id']))
+
+
+def identity_conversions(units):
+    """
+    Returns {unit: conversion_id} for the 'General' identity conversion
+    of each unit, creating the ones that do not exist yet.
+    """
+    conversions = dict(db.session.query(Conversion.unit_from, Conversion.id)
+                       .filter(Conversion.unit_from.in_(sorted(units)),
+                               Conversion.unit_to == Conversion.unit_from,
+                               Conversion.food_type == 'General')
+                       .order_by(Conversion.id.desc()))
+    missing = sorted(set(units) - set(conversions))
+    if missing:
+        rows = db.session.execute(insert(Conversion.__table__)
+                                  .values([{'unit_from': unit, 'unit_to': unit, 'food_type': 'General',
+                                            'conversion_factor': 1} for unit in missing])
+                                  .returning(Conversion.__table__.c.unit_from, Conversion.__table__.c.id))
+        conversions.update({unit: conversion_id for unit, conversion_id in rows})
+    return conversions
+
+
+def ingredient_ids(records):
+    """
+    Returns {(food_name, unit): ingredient_id} for every parsed ingredient,
+    inserting the new ones. Existing ingredients keep their category
+    and conversion; new ones get the identity conversion for their unit.
+    """
+    categories = {}
+    for record in records:
+        for ingr in record['ingredients_parsed']:
+            categories.setdefault((ingr['food_name'], ingr['unit']), ingr['food_category']['id'])
+    if not categories:
+        return {}
+
+    ids = {(food_name, unit): ingredient_id for ingredient_id, food_name, unit in
+           db.session.query(Ingredient.id, Ingredient.food_name, Ingredient.unit)
+           .filter(tuple_(Ingredient.food_name, Ingredient.unit).in_(list(categories)))}
+    missing = [key for key in categories if key not in ids]
+    if missing:
+        conversions = identity_conversions({unit for food_name, unit in missing})
+        table = Ingredient.__table__
+        stmt = insert(table).values([{'food_name': food_name, 'unit': unit,
+                                      'category_id': categories[(food_name, unit)],
+                                      'conversion_id': conversions[unit]}
+                                     for food_name, unit in missing])
+        # The no-op update makes RETURNING include rows inserted concurrently
+        stmt = stmt.on_conflict_do_update(constraint='unique_name_unit',
+                                          set_={'food_name': stmt.excluded.food_name}) \
+                   .returning(table.c.id, table.c.food_name, table.c.unit)
+        ids.update({(food_name, unit): ingredient_id
+                    for ingredient_id, food_name, unit in db.session.execute(stmt)})
+    return ids
+
+
+def load_recipes(records):
+    """
+    Inserts the parsed recipes and everything they reference in one
+    transaction. Returns the new recipe ids, in the order of records.
+    Nothing is written if any statement fails.
+    """
+    records = list(records)
+    if not records:
+        return []
+    try:
+        recipe_ids = reserve_recipe_ids(len(records))
+        upsert_categories(records)
+        ingredients = ingredient_ids(records)
+
+        db.session.execute(insert(Recipe.__table__).values([
+            {'id': recipe_id, 'title': record['title'], 'prep_time': record['total_time'],
+             'difficulty': record['difficulty'], 'spice_level': record['spice'],
+             'category': record['category'], 'image': record.get('image')}
+            for recipe_id, record in zip(recipe_ids, records)]))
+
+        steps = [{'recipe_id': recipe_id, 'step_number': i, 'description': description}
+                 for recipe_id, record in zip(recipe_ids, records)
+                 for i, description in enumerate(record['steps'])]
+        if steps:
+            db.session.execute(insert(Step.__table__).values(steps))
+
+        # The same ingredient can appear on several lines of a recipe
+        quantities = defaultdict(Decimal)
+        for recipe_id, record in zip(recipe_ids, records):
+            for ingr in record['ingredients_parsed']:
+                key = (recipe_id, ingredients[(ingr['food_name'], ingr['unit'])])
+                quantities[key] += Decimal(str(ingr['quantity']))
+        if quantities:
+            db.session.execute(insert(RecipeIngredient.__table__).values([
+                {'recipe_id': recipe_id, 'ingredient_id': ingredient_id, 'quantity': quantity}
+                for (recipe_id, ingredient_id), quantity in quantities.items()]))
+
+        CatalogVersion.bump()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return recipe_ids
+
+
+def read_records(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def main():
+    import scrape
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('records')
+    argparser.add_argument('--batch-size', type=int, default=100)
+    args = argparser.parse_args()
+
+    scrape.init_db()
+    batch = []
+    loaded = 0
+    for record in read_records(args.records):
+        batch.append(record)
+        if len(batch) == args.batch_size:
+            loaded += len(load_recipes(batch))
+            batch = []
+    loaded += len(load_recipes(batch))
+    print(f'Loaded {loaded} recipes')
+
+
+if __name__ == '__main__':
+    main()
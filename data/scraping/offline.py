@@ -0,0 +1,83 @@
+"""
+Offline parse-only mode.
+
+Runs RecipeParser extraction over a directory of saved recipe pages,
+without network access, and writes one JSON record per line.
+Pages are parsed in a process pool, one worker per core by default,
+using only the page sections RecipeParser reads.
+
+Files are expected to be named after the meal slug, e.g.
+garlic-butter-steak.html for https://www.homechef.com/meals/garlic-butter-steak,
+so that categories can be looked up in urls.txt.
+
+Usage: python offline.py html_dir records.jsonl [--urls urls.txt] [--parser lxml] [--workers N]
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from urllib.parse import urlsplit
+import argparse
+import json
+import os
+
+from scrape import RecipeParser, default_html_parser
+
+
+def categories_by_slug(urls_path):
+    """Maps the meal slug of each url in urls.txt to its category."""
+    with open(urls_path) as f:
+        return {urlsplit(url).path.rstrip('/').split('/')[-1]: category for url, category in json.load(f)}
+
+
+def parse_file(path, categories, features):
+    """
+    Extracts one saved page. Returns a record, or a dict
+    holding the error if the page does not parse.
+    """
+    slug = os.path.splitext(os.path.basename(path))[0]
+    try:
+        with open(path, encoding='utf-8') as f:
+            html = f.read()
+        parser = RecipeParser()
+        parser.set_html(html, categories.get(slug), features=features, strained=True)
+        parser.parseRecipe()
+    except (AttributeError, IndexError, KeyError, TypeError, UnicodeDecodeError) as e:
+        return {'source': slug, 'error': repr(e)}
+    return dict(parser.as_record(), source=slug)
+
+
+def parse_directory(html_dir, out_path, categories=None, features=None, workers=None):
+    """
+    Parses every .html file in html_dir into out_path as JSONL.
+    Returns (parsed, failed) counts; failures are written as
+    records with an error key so they can be inspected.
+    """
+    paths = sorted(os.path.join(html_dir, name) for name in os.listdir(html_dir) if name.endswith('.html'))
+    worker = partial(parse_file, categories=categories or {}, features=features or default_html_parser())
+    parsed = failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor, open(out_path, 'w') as out:
+        for record in executor.map(worker, paths, chunksize=8):
+            out.write(json.dumps(record) + '\n')
+            if 'error' in record:
+                failed += 1
+            else:
+                parsed += 1
+    return parsed, failed
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('html_dir')
+    argparser.add_argument('out')
+    argparser.add_argument('--urls', help='urls.txt used to look up each page category')
+    argparser.add_argument('--parser', choices=['lxml', 'html.parser', 'html5lib'], default=default_html_parser())
+    argparser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = argparser.parse_args()
+
+    categories = categories_by_slug(args.urls) if args.urls else {}
+    parsed, failed = parse_directory(args.html_dir, args.out, categories, args.parser, args.workers)
+    print(f'{parsed} pages parsed, {failed} failed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+"""
+Asynchronous crawl pipeline for Home Chef recipes.
+
+Each recipe URL flows through fetch -> RecipeParser extraction ->
+Edamam ingredient parsing -> USDA category lookup -> commit.
+Many recipes are in flight at once; HTTP calls are bounded per host,
+rate limited per API with token buckets and retried with backoff.
+
+Usage: python pipeline.py [--concurrency N] [--urls urls.txt] [--refetch]
+"""
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from urllib.parse import urlsplit
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import requests
+
+import scrape
+from scrape import RecipeParser
+from api_cache import ApiCache, NoResult, DAY
+from images import save_derivatives
+from crawl_state import CrawlState, DONE, UNPARSEABLE, FAILED, CHANGED, content_hash
+
+
+class FetchError(Exception):
+    """Raised when a request still fails after all retries."""
+
+
+class TokenBucket():
+    """
+    Allows bursts of up to capacity requests and refills
+    at rate tokens per second. Replaces fixed sleeps between calls.
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Fetcher():
+    """
+    Runs blocking requests calls on a thread pool so they can be awaited.
+    At most per_host requests are in flight to any one host, hosts listed
+    in rate_limits wait for a token first, and connection errors, 429s
+    and 5xx responses are retried with exponential backoff and jitter.
+    """
+    def __init__(self, per_host=4, rate_limits=None, retries=3, backoff=1.0, timeout=30, max_workers=16):
+        self.per_host = per_host
+        self.rate_limits = rate_limits or {}
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._host_limits = {}
+
+    def _host_limit(self, host):
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self.per_host)
+        return self._host_limits[host]
+
+    async def get(self, url, params=None, headers=None):
+        host = urlsplit(url).netloc
+        loop = asyncio.get_event_loop()
+        request = partial(self.session.get, url, params=params, headers=headers, timeout=self.timeout)
+        for attempt in range(self.retries + 1):
+            if host in self.rate_limits:
+                await self.rate_limits[host].acquire()
+            retry_after = None
+            async with self._host_limit(host):
+                try:
+                    res = await loop.run_in_executor(self.executor, request)
+                except requests.RequestException as e:
+                    error = e
+                else:
+                    if res.status_code != 429 and res.status_code < 500:
+                        return res
+                    error = f'HTTP {res.status_code}'
+                    retry_after = res.headers.get('Retry-After')
+            if attempt == self.retries:
+                raise FetchError(f'{url}: {error}')
+            delay = self.backoff * (2 ** attempt) * (1 + random.random())
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            await asyncio.sleep(delay)
+
+    def close(self):
+        self.session.close()
+        self.executor.shutdown(wait=False)
+
+
+class CrawlPipeline():
+    """
+    Crawls recipe pages concurrently.
+    commit(parser) is called with each fully parsed RecipeParser on a
+    single dedicated thread, so database writes stay serialized.
+    on_done(url, category, error) is called after every URL;
+    error is None on success and a LookupError for unparseable recipes.
+    API lookups go through cache, an ApiCache, when one is given.
+    With a CrawlState, outcomes are recorded per url and pages crawled
+    before are fetched conditionally; unchanged pages are skipped and
+    changed ones are marked for review rather than committed twice.
+    With an image_folder, recipe images are downloaded alongside the
+    pages and their derivatives are saved in a process pool.
+    """
+    def __init__(self, fetcher, commit, on_done=None, concurrency=8, cache=None, state=None, image_folder=None):
+        self.fetcher = fetcher
+        self.commit = commit
+        self.on_done = on_done
+        self.concurrency = concurrency
+        self.cache = cache
+        self.state = state
+        self.image_folder = image_folder
+        self.commit_executor = ThreadPoolExecutor(max_workers=1)
+        self.image_executor = ProcessPoolExecutor() if image_folder else None
+
+    async def cached(self, namespace, key, fetch):
+        """Async counterpart of ApiCache.lookup."""
+        if self.cache is None:
+            return await fetch(key)
+        found, value = self.cache.get(namespace, key)
+        if found:
+            if value is None:
+                raise NoResult(key)
+            return value
+        try:
+            value = await fetch(key)
+        except NoResult:
+            self.cache.set(namespace, key, None)
+            raise
+        self.cache.set(namespace, key, value)
+        return value
+
+    async def parse_ingredient(self, ingredient):
+        food_name, quantity, unit = await self.cached('edamam', ingredient, self.request_edamam)
+        food_category = await self.cached('usda', food_name, self.request_food_category)
+        return {'food_name': food_name, 'quantity': quantity, 'unit': unit, 'food_category': food_category}
+
+    async def request_edamam(self, ingredient):
+        res = await self.fetcher.get(scrape.EDAMAM_PARSER_URL, params=RecipeParser.edamam_params(ingredient))
+        return RecipeParser.read_edamam_response(res.json())
+
+    async def request_food_category(self, food_name):
+        res = await self.fetcher.get(scrape.USDA_SEARCH_URL, params=RecipeParser.usda_search_params(food_name))
+        fdc_id = RecipeParser.read_usda_search_response(res.json())
+        res = await self.fetcher.get(scrape.USDA_FOOD_URL.format(fdc_id=fdc_id), params={'api_key': scrape.USDA_API_KEY})
+        return res.json()['foodCategory']
+
+    async def process(self, url, category):
+        """
+        Crawls one page. Returns the committed RecipeParser,
+        or None if the page was already crawled.
+        """
+        headers = self.state.conditional_headers(url) if self.state else None
+        res = await self.fetcher.get(url, headers=headers)
+        if res.status_code == 304:
+            self.state.touch(url)
+            return None
+        res.raise_for_status()
+        if self.state and self.state.status(url) in (DONE, CHANGED):
+            entry = self.state.entry(url)
+            if entry['content_hash'] is None:
+                # Imported from the legacy lists, so there is nothing to compare against yet
+                self.state.mark(url, category, entry['status'], response=res)
+            elif entry['content_hash'] == content_hash(res.content):
+                self.state.touch(url)
+            else:
+                self.state.mark(url, category, CHANGED, response=res)
+            return None
+        parser = RecipeParser()
+        parser.set_html(res.text, category)
+        parser.parseRecipe()
+        parser.ingredients_parsed = list(await asyncio.gather(
+            *[self.parse_ingredient(ingredient) for ingredient in parser.ingredients]))
+        loop = asyncio.get_event_loop()
+        if self.image_folder:
+            image = await self.fetcher.get(parser.image_url)
+            image.raise_for_status()
+            parser.image = await loop.run_in_executor(self.image_executor, save_derivatives,
+                                                      image.content, self.image_folder)
+        await loop.run_in_executor(self.commit_executor, self.commit, parser)
+        if self.state:
+            self.state.mark(url, category, DONE, response=res)
+        return parser
+
+    async def _run_one(self, limit, url, category):
+        async with limit:
+            try:
+                await self.process(url, category)
+                error = None
+            except (FetchError, requests.HTTPError) as e:
+                error = e
+                if self.state:
+                    self.state.mark(url, category, FAILED, error=e)
+            except (LookupError, AttributeError) as e:
+                error = e
+                if self.state:
+                    self.state.mark(url, category, UNPARSEABLE, error=e)
+            except Exception as e:
+                # A bad API body, record or commit must not stop the other pages
+                error = e
+                if self.state:
+                    self.state.mark(url, category, FAILED, error=e)
+            if self.on_done:
+                self.on_done(url, category, error)
+            return url, error
+
+    async def run(self, targets):
+        """
+        Crawls every (url, category) in targets.
+        Returns {url: None or the exception that stopped it}.
+        """
+        limit = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*[self._run_one(limit, url, category) for url, category in targets])
+        return dict(results)
+
+    def close(self):
+        self.commit_executor.shutdown()
+        if self.image_executor:
+            self.image_executor.shutdown()
+
+
+def default_rate_limits():
+    """
+    Token buckets for the external APIs, replacing the fixed
+    time.sleep(8) per ingredient of the sequential scraper.
+    """
+    return {urlsplit(scrape.EDAMAM_PARSER_URL).netloc: TokenBucket(rate=0.5, capacity=5),
+            urlsplit(scrape.USDA_SEARCH_URL).netloc: TokenBucket(rate=1, capacity=5)}
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--urls', default='urls.txt')
+    argparser.add_argument('--concurrency', type=int, default=8)
+    argparser.add_argument('--per-host', type=int, default=4)
+    argparser.add_argument('--cache', default=scrape.API_CACHE_PATH, help='sqlite file for API lookups')
+    argparser.add_argument('--cache-ttl-days', type=float, default=90)
+    argparser.add_argument('--state', default=scrape.CRAWL_STATE_PATH, help='sqlite file for crawl progress')
+    argparser.add_argument('--images', default=scrape.IMAGE_FOLDER, help='folder for recipe images')
+    argparser.add_argument('--refetch', action='store_true',
+                           help='Conditionally refetch finished pages and mark the changed ones')
+    args = argparser.parse_args()
+
+    scrape.init_db()
+    state = CrawlState(args.state)
+    state.import_legacy('visited_urls.txt', 'unparseable_urls.txt')
+    with open(args.urls) as f:
+        targets = state.pending([tuple(target) for target in json.load(f)], refetch=args.refetch)
+
+    def on_done(url, category, error):
+        print(f'{"OK" if error is None else "FAILED"} - {url} {error or ""}')
+
+    cache = ApiCache(args.cache, ttl=args.cache_ttl_days * DAY)
+    fetcher = Fetcher(per_host=args.per_host, rate_limits=default_rate_limits())
+    pipeline = CrawlPipeline(fetcher, commit=RecipeParser.commit_parsed_data,
+                             on_done=on_done, concurrency=args.concurrency, cache=cache, state=state,
+                             image_folder=args.images)
+    try:
+        asyncio.get_event_loop().run_until_complete(pipeline.run(targets))
+    finally:
+        pipeline.close()
+        fetcher.close()
+        print(f'Crawl state: {state.counts()}')
+        print(f'API cache: {cache.stats()}')
+        cache.close()
+        state.close()
+
+
+if __name__ == '__main__':
+    main()
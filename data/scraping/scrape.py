@@ -1,25 +1,44 @@
+import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import MetaData
-from bs4 import BeautifulSoup
-from secrets import EDEMAM_APP_ID, EDEMAM_APP_KEY, USDA_API_KEY
-from models import db, connect_db, Recipe, Ingredient, Category, RecipeIngredient, Step
+from bs4 import BeautifulSoup, SoupStrainer
+try:
+    from secrets import EDEMAM_APP_ID, EDEMAM_APP_KEY, USDA_API_KEY
+except ImportError:
+    EDEMAM_APP_ID = os.environ.get('EDEMAM_APP_ID')
+    EDEMAM_APP_KEY = os.environ.get('EDEMAM_APP_KEY')
+    USDA_API_KEY = os.environ.get('USDA_API_KEY')
+from models import db, connect_db
 import requests
 import time
 import re
-import os
 import json
-from decimal import Decimal
-import hashlib
-from PIL import Image
+from images import save_derivatives
+from api_cache import ApiCache, NoResult
+from loader import load_recipes
+from crawl_state import CrawlState, DONE, UNPARSEABLE
+
+HOME_CHEF_URL = 'https://www.homechef.com'
+EDAMAM_PARSER_URL = 'https://api.edamam.com/api/food-database/parser'
+USDA_SEARCH_URL = 'https://api.nal.usda.gov/fdc/v1/search'
+USDA_FOOD_URL = 'https://api.nal.usda.gov/fdc/v1/{fdc_id}'
+API_CACHE_PATH = 'api_cache.sqlite'
+CRAWL_STATE_PATH = 'crawl_state.sqlite'
+IMAGE_FOLDER = 'static/images'
+
+# Set by main() to an ApiCache; None queries the APIs every time.
+api_cache = None
 
 test_app = Flask('test_app')
-test_app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///recipe'
+test_app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'postgresql:///recipe')
 test_app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 test_app.config['SQLALCHEMY_ECHO'] = True
 
-connect_db(test_app)
-db.create_all()
+def init_db():
+    """Connects the models to the scraping database and creates missing tables."""
+    connect_db(test_app)
+    db.create_all()
 
 def persist_image(folder_path:str,url:str):
     try:
@@ -27,29 +46,71 @@ def persist_image(folder_path:str,url:str):
 
     except Exception as e:
         print(f"ERROR - Could not download {url} - {e}")
+        return None
 
     try:
-        import io
-        image_file = io.BytesIO(image_content)
-        image = Image.open(image_file).convert('RGB')
-        file_name = hashlib.sha1(image_content).hexdigest()[:10]
-        file_path = os.path.join(folder_path, file_name + '.jpg')
-        with open(file_path, 'wb') as f:
-            image.save(f, "JPEG", quality=85)
-        print(f"SUCCESS - saved {url} - as {file_path}")
+        file_name = save_derivatives(image_content, folder_path)
+        print(f"SUCCESS - saved {url} - as {os.path.join(folder_path, file_name)}.jpg and derivatives")
         return file_name
     except Exception as e:
         print(f"ERROR - Could not save {url} - {e}")
         return None
 
+def default_html_parser():
+    """lxml is much faster than html.parser but is an optional dependency."""
+    try:
+        import lxml
+        return 'lxml'
+    except ImportError:
+        return 'html.parser'
+
+class RecipeSections(SoupStrainer):
+    """
+    Keeps only the parts of a recipe page that RecipeParser reads.
+    BeautifulSoup asks about each start tag outside a kept section,
+    in document order, so the strainer can remember having entered
+    <main> to keep the recipe header but not the site header.
+    """
+    CLASSES = {'meal__overview', 'meal__steps', 'meal__imageCarousel'}
+    ITEMPROPS = {'recipeIngredient', 'totalTime'}
+
+    def __init__(self):
+        super().__init__()
+        self.in_main = False
+
+    def keep(self, name, attrs):
+        attrs = dict(attrs or {})
+        if name == 'main':
+            self.in_main = True
+            return False
+        if name == 'header':
+            return self.in_main
+        classes = attrs.get('class') or []
+        if isinstance(classes, str):
+            classes = classes.split()
+        return bool(self.CLASSES.intersection(classes)) or attrs.get('itemprop') in self.ITEMPROPS
+
+    # beautifulsoup4 < 4.13
+    def search_tag(self, markup_name=None, markup_attrs={}):
+        return self.keep(markup_name, markup_attrs)
+
+    # beautifulsoup4 >= 4.13
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        return self.keep(name, attrs)
+
 class RecipeParser():
     def __init__(self, homeChefUrl=None, category=None):
         if homeChefUrl:
             self.set_url(homeChefUrl, category)
     def set_url(self, homeChefUrl, category=None):
         res = requests.get(homeChefUrl)
-        self.soup = BeautifulSoup(res.text, features='html.parser')
+        self.set_html(res.text, category)
+    def set_html(self, html, category=None, features='html.parser', strained=False):
+        parse_only = RecipeSections() if strained else None
+        self.soup = BeautifulSoup(html, features=features, parse_only=parse_only)
         self.category = category
+        # File name of the saved image, when it was downloaded ahead of the commit
+        self.image = None
     def parseRecipe(self):
         self._extract_difficulty()
         self._extract_ingredients()
@@ -57,12 +118,21 @@ class RecipeParser():
         self._extract_steps()
         self._extract_title()
         self._extract_total_time()
+        self._extract_image_url()
     
+    def as_record(self):
+        """Returns the extracted fields as a JSON serializable dict."""
+        record = {'title': self.title, 'category': self.category, 'total_time': self.total_time,
+                  'difficulty': self.difficulty, 'spice': self.spice, 'steps': self.steps,
+                  'ingredients': self.ingredients, 'image_url': self.image_url}
+        if hasattr(self, 'ingredients_parsed'):
+            record['ingredients_parsed'] = self.ingredients_parsed
+        return record
+
     def commit_parsed_data(self):
-        self._commit_recipe()
-        self._commit_steps()
-        self._commit_categories()
-        self._commit_ingredients()
+        record = self.as_record()
+        record['image'] = self.image or persist_image(IMAGE_FOLDER, self.image_url)
+        self.new_recipe_id = load_recipes([record])[0]
     def _extract_difficulty(self):
         difficulty_div = self.soup.find(class_='meal__overview').find_all('div')[2].find(class_='meal__indicator')
         difficulty = [class_name.replace('meal__indicator--', '') for class_name in difficulty_div['class'] if ('meal__indicator--' in class_name)][0]
@@ -89,77 +159,74 @@ class RecipeParser():
         recipe_steps = [step.find_all('span')[1].get_text() for step in steps]
         self.steps = recipe_steps
     def _extract_title(self):
-        title = self.soup.find('main').find('header')
+        # Strained soups keep the header but not the <main> around it
+        title = (self.soup.find('main') or self.soup).find('header')
         self.title = title.get_text().strip()
     def _extract_total_time(self):
         total_time = self.soup.find(itemprop='totalTime').get('content').strip().replace('PT', '').replace('M', '')
         self.total_time = total_time
     def _extract_image_url(self):
         self.image_url = self.soup.find(class_='meal__imageCarousel').find('img')['data-srcset'].split(', ')[-1].split(' ')[0]
-    def _commit_recipe(self):
-        file_name = persist_image('static/images', myParser.image_url)
-        new_recipe = Recipe(title=self.title, prep_time=self.total_time, difficulty=self.difficulty, spice_level=self.spice, category=self.category, image=file_name)                          
-        db.session.add(new_recipe)
-        db.session.commit()
-        self.new_recipe_id = new_recipe.id 
-    def _commit_steps(self):
-        for i in range(len(self.steps)): 
-            db.session.add(Step(recipe_id=self.new_recipe_id, step_number=i, description=myParser.steps[i]))
-        db.session.commit()
-    def _commit_categories(self):
-        categories = set([(ingr['food_category']['id'], ingr['food_category']['description']) for ingr in self.ingredients_parsed])   
-        for cat_id, cat_label in categories:
-            existing_category = Category.query.get(cat_id)
-            if not existing_category:
-                new_category = Category(id=cat_id, category_label=cat_label) 
-                db.session.add(new_category) 
-        db.session.commit()
-    def _commit_ingredients(self):
-        for ingr in self.ingredients_parsed:
-            ingredient = Ingredient.query.filter(Ingredient.food_name == ingr['food_name'], Ingredient.unit == ingr['unit']).first()
-            if not ingredient:
-                ingredient = Ingredient(food_name=ingr['food_name'], unit=ingr['unit'], category_id=ingr['food_category']['id']) 
-                db.session.add(ingredient) 
-                db.session.commit()
-            recipe_ingredient = RecipeIngredient.query.filter(RecipeIngredient.recipe_id == self.new_recipe_id, RecipeIngredient.ingredient_id == ingredient.id).first()
-            if recipe_ingredient:
-                current_quantity = recipe_ingredient.quantity
-                recipe_ingredient.quanitity = current_quantity + Decimal(ingr['quantity'])
-            else: 
-                recipe_ingredient = RecipeIngredient(recipe_id=self.new_recipe_id, ingredient_id=ingredient.id, quantity=ingr['quantity']) 
-            db.session.add(recipe_ingredient) 
-            db.session.commit()  
+    @staticmethod
+    def edamam_params(ingredient):
+        return {'app_id':EDEMAM_APP_ID, 'app_key':EDEMAM_APP_KEY, 'ingr':ingredient}
 
     @staticmethod
-    def parse_ingredient_edamam(ingredient):
-        edamam_params = {'app_id':EDEMAM_APP_ID, 'app_key':EDEMAM_APP_KEY, 'ingr':ingredient}
-        res = requests.get('https://api.edamam.com/api/food-database/parser', params=edamam_params) 
-        if not res.json()['parsed']:
-            raise LookupError
-        res_data = res.json()['parsed'][0]
+    def read_edamam_response(data):
+        if not data['parsed']:
+            raise NoResult
+        res_data = data['parsed'][0]
         food_name = res_data['food']['label']
         quantity = res_data['quantity']
         unit = res_data['measure']['label']
         return food_name, quantity, unit
 
     @staticmethod
-    def fetch_food_category(food_name):
-        usda_general_params = {'api_key': USDA_API_KEY, 'generalSearchInput': food_name, 'includeDataTypeList': 'SR Legacy'}
-        res = requests.get('https://api.nal.usda.gov/fdc/v1/search', params=usda_general_params)
-        fdcId = res.json()['foods'][0]['fdcId']
+    def request_edamam(ingredient):
+        res = requests.get(EDAMAM_PARSER_URL, params=RecipeParser.edamam_params(ingredient))
+        return RecipeParser.read_edamam_response(res.json())
+
+    @staticmethod
+    def parse_ingredient_edamam(ingredient):
+        if api_cache is None:
+            return RecipeParser.request_edamam(ingredient)
+        return tuple(api_cache.lookup('edamam', ingredient, RecipeParser.request_edamam))
+
+    @staticmethod
+    def usda_search_params(food_name):
+        return {'api_key': USDA_API_KEY, 'generalSearchInput': food_name, 'includeDataTypeList': 'SR Legacy'}
+
+    @staticmethod
+    def read_usda_search_response(data):
+        if not data['foods']:
+            raise NoResult
+        return data['foods'][0]['fdcId']
+
+    @staticmethod
+    def request_food_category(food_name):
+        res = requests.get(USDA_SEARCH_URL, params=RecipeParser.usda_search_params(food_name))
+        fdcId = RecipeParser.read_usda_search_response(res.json())
         usda_single_params = {'api_key': USDA_API_KEY}
-        res = requests.get(f'https://api.nal.usda.gov/fdc/v1/{fdcId}', params=usda_single_params)
+        res = requests.get(USDA_FOOD_URL.format(fdc_id=fdcId), params=usda_single_params)
         food_category = res.json()['foodCategory']
         return food_category
+
+    @staticmethod
+    def fetch_food_category(food_name):
+        if api_cache is None:
+            return RecipeParser.request_food_category(food_name)
+        return api_cache.lookup('usda', food_name, RecipeParser.request_food_category)
     
     def parse_ingredients(self):
         self.ingredients_parsed = []
         for ingredient in self.ingredients:
+            misses = api_cache.misses if api_cache else None
             food_name, quantity, unit = self.parse_ingredient_edamam(ingredient)
             food_category = self.fetch_food_category(food_name)
             self.ingredients_parsed.append({'food_name': food_name, 'quantity':quantity, 'unit': unit, 'food_category':food_category})
-            time.sleep(8)
-
+            # Only wait out the rate limit when the APIs were actually called
+            if api_cache is None or api_cache.misses != misses:
+                time.sleep(8)
 
 
 def collect_meal_urls(base_url, category, max_pages, url_list=[]):
@@ -172,7 +239,7 @@ def collect_meal_urls(base_url, category, max_pages, url_list=[]):
                 url_list.append((base_url + link.get('href'), category))
 def save_all_meal_urls():
     url_list = []
-    base_url = 'https://www.homechef.com'
+    base_url = HOME_CHEF_URL
     categories = [('poultry',8), ('seafood', 5), ('pork', 4), ('beef', 3), ('vegetarian', 11)]
     for category, max_pages in categories:
         collect_meal_urls(base_url=base_url, category=category, max_pages=max_pages, url_list=url_list)
@@ -182,34 +249,37 @@ def save_all_meal_urls():
 
 
 
-# save_all_meal_urls()
-with open('urls.txt', 'r') as f:
-    url_list = json.loads(f.read())
-with open('visited_urls.txt', 'r') as f:
-    visited_urls = json.loads(f.read())
-with open('unparseable_urls.txt', 'r') as f:
-    unparseable_urls = json.loads(f.read())
+def main():
+    global api_cache
+    init_db()
+    api_cache = ApiCache(API_CACHE_PATH)
+    state = CrawlState(CRAWL_STATE_PATH)
+    state.import_legacy('visited_urls.txt', 'unparseable_urls.txt')
+    # save_all_meal_urls()
+    with open('urls.txt', 'r') as f:
+        url_list = json.loads(f.read())
 
-myParser = RecipeParser()
-for target_url, category in url_list:
-    print(target_url)
-    print('unvisited?')
-    print((target_url not in visited_urls) and (target_url not in unparseable_urls))
-    if (target_url not in visited_urls) and (target_url not in unparseable_urls):
+    myParser = RecipeParser()
+    for target_url, category in state.pending(url_list):
+        print(target_url)
+        res = None
         try:
-            myParser.set_url(target_url)
+            res = requests.get(target_url)
+            myParser.set_html(res.text, category)
             myParser.parseRecipe()
             myParser.parse_ingredients()
             print('finished parsing')
             myParser.commit_parsed_data()
             print('finished committing')
-            visited_urls.append((target_url, category))
-            with open('visited_urls.txt', 'w') as f:
-                json.dump(visited_urls, f, indent=4)
+            state.mark(target_url, category, DONE, response=res)
         except LookupError as e:
             print('ABORTING PARSE')
-            unparseable_urls.append((target_url, category))
-            with open('unparseable_urls.txt', 'w') as f:
-                json.dump(unparseable_urls, f, indent=4)
+            state.mark(target_url, category, UNPARSEABLE, response=res, error=e)
             time.sleep(8)
             continue
+    print(f'Crawl state: {state.counts()}')
+    print(f'API cache: {api_cache.stats()}')
+
+
+if __name__ == '__main__':
+    main()
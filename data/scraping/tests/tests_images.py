@@ -0,0 +1,95 @@
+"""Image pipeline tests."""
+
+import os
+import sys
+import io
+import shutil
+import tempfile
+import threading
+from functools import partial
+from unittest import TestCase
+from unittest.mock import patch
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from PIL import Image
+from images import save_derivatives, persist_images, derive_existing, image_name
+
+
+def image_bytes(width, height, color='red'):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class ImagesTestCase(TestCase):
+    """Test downloading images and saving their derivatives."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.out = os.path.join(self.tmp, 'images')
+        os.mkdir(self.out)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def sizes(self, name):
+        sizes = {}
+        for file_name in sorted(os.listdir(self.out)):
+            if file_name.startswith(name):
+                with Image.open(os.path.join(self.out, file_name)) as image:
+                    sizes[file_name[len(name):]] = image.size
+        return sizes
+
+    def test_save_derivatives(self):
+        content = image_bytes(1600, 900)
+        name = save_derivatives(content, self.out)
+
+        self.assertEqual(name, image_name(content))
+        self.assertEqual(self.sizes(name), {'.jpg': (1600, 900), '-card.jpg': (400, 225), '-hero.jpg': (1200, 675),
+                                            '-card.webp': (400, 225), '-hero.webp': (1200, 675)})
+
+        small = save_derivatives(image_bytes(300, 200, 'blue'), self.out)
+        self.assertEqual(self.sizes(small)['-hero.jpg'], (300, 200))
+
+    def test_save_derivatives_requires_webp(self):
+        with patch('images.features.check', return_value=False):
+            with self.assertRaises(RuntimeError):
+                save_derivatives(image_bytes(300, 200), self.out)
+        self.assertEqual(os.listdir(self.out), [])
+
+    def test_persist_images(self):
+        source = os.path.join(self.tmp, 'source')
+        os.mkdir(source)
+        with open(os.path.join(source, 'steak.png'), 'wb') as f:
+            f.write(image_bytes(1600, 900))
+        with open(os.path.join(source, 'broken.png'), 'wb') as f:
+            f.write(b'not an image')
+        server = HTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=source))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{server.server_port}'
+        try:
+            results = persist_images([f'{base_url}/steak.png', f'{base_url}/broken.png', f'{base_url}/missing.png'],
+                                     self.out, workers=2)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(results[f'{base_url}/steak.png'], image_name(image_bytes(1600, 900)))
+        self.assertIsNone(results[f'{base_url}/broken.png'])
+        self.assertIsNone(results[f'{base_url}/missing.png'])
+        self.assertEqual(self.sizes(results[f'{base_url}/steak.png'])['-card.jpg'], (400, 225))
+
+    def test_derive_existing(self):
+        Image.new('RGB', (800, 800), 'green').save(os.path.join(self.out, 'abc123def0.jpg'), 'JPEG')
+
+        self.assertEqual(derive_existing(self.out, workers=2), 1)
+        self.assertEqual(self.sizes('abc123def0')['-card.jpg'], (400, 400))
+        self.assertEqual(derive_existing(self.out, workers=2), 1)
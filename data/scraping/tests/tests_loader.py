@@ -0,0 +1,110 @@
+"""Bulk loader tests."""
+
+import os
+import sys
+from unittest import TestCase
+from decimal import Decimal
+from sqlalchemy import event
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', '..', '..', 'app'))
+
+import scrape
+from loader import load_recipes
+from models import db, Recipe, Step, Category, Ingredient, Conversion, RecipeIngredient, CatalogVersion
+
+scrape.test_app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///recipe-blank"
+scrape.test_app.config['SQLALCHEMY_ECHO'] = False
+scrape.init_db()
+
+FATS = {'id': 4, 'description': 'Fats and Oils'}
+VEGETABLES = {'id': 11, 'description': 'Vegetables and Vegetable Products'}
+
+
+def record(title, ingredients_parsed, steps=('Cook it.',)):
+    return {'title': title, 'category': 'beef', 'total_time': '35', 'difficulty': '2', 'spice': '1',
+            'steps': list(steps), 'image': 'abc123', 'ingredients_parsed': ingredients_parsed}
+
+
+class LoaderTestCase(TestCase):
+    """Test writing batches of parsed recipes."""
+
+    def setUp(self):
+        RecipeIngredient.query.delete()
+        Step.query.delete()
+        Recipe.query.delete()
+        Ingredient.query.delete()
+        Conversion.query.delete()
+        Category.query.delete()
+        db.session.commit()
+
+        db.session.add(Category(id=4, category_label='Fats and Oils'))
+        conversion = Conversion(unit_from='Tablespoon', unit_to='Cup', food_type='General', conversion_factor=0.0625)
+        db.session.add(conversion)
+        db.session.flush()
+        db.session.add(Ingredient(food_name='Olive Oil', unit='Tablespoon', category_id=4, conversion_id=conversion.id))
+        db.session.commit()
+        self.conversion_id = conversion.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_load_recipes(self):
+        version = CatalogVersion.current()
+        steak = record('Garlic Butter Steak', [
+            {'food_name': 'Olive Oil', 'quantity': 1.0, 'unit': 'Tablespoon', 'food_category': FATS},
+            {'food_name': 'Garlic', 'quantity': 2.0, 'unit': 'Clove', 'food_category': VEGETABLES},
+        ], steps=['Season the steak.', 'Sear it.'])
+        salad = record('Garlic Salad', [
+            {'food_name': 'Garlic', 'quantity': 1.0, 'unit': 'Clove', 'food_category': VEGETABLES},
+            {'food_name': 'Garlic', 'quantity': 0.5, 'unit': 'Clove', 'food_category': VEGETABLES},
+        ])
+        inserts = []
+
+        def record_insert(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith(('INSERT INTO recipes ', 'INSERT INTO steps ')):
+                inserts.append((statement.split()[2], executemany))
+
+        event.listen(db.engine, 'before_cursor_execute', record_insert)
+        try:
+            steak_id, salad_id = load_recipes([steak, salad])
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record_insert)
+        # One multi-row statement per table, not one round trip per row
+        self.assertEqual(inserts, [('recipes', False), ('steps', False)])
+
+        self.assertEqual(CatalogVersion.current(), version + 1)
+        self.assertEqual(Recipe.query.get(steak_id).title, 'Garlic Butter Steak')
+        self.assertEqual(Recipe.query.get(salad_id).prep_time, 35)
+        self.assertEqual([step.description for step in
+                          Step.query.filter_by(recipe_id=steak_id).order_by(Step.step_number)],
+                         ['Season the steak.', 'Sear it.'])
+        self.assertEqual(Category.query.get(11).category_label, 'Vegetables and Vegetable Products')
+
+        olive_oil = Ingredient.query.filter_by(food_name='Olive Oil').one()
+        garlic = Ingredient.query.filter_by(food_name='Garlic').one()
+        self.assertEqual(olive_oil.conversion_id, self.conversion_id)
+        identity = Conversion.query.get(garlic.conversion_id)
+        self.assertEqual((identity.unit_from, identity.unit_to, identity.conversion_factor), ('Clove', 'Clove', 1))
+
+        quantities = {(ri.recipe_id, ri.ingredient_id): ri.quantity for ri in RecipeIngredient.query.all()}
+        self.assertEqual(quantities, {(steak_id, olive_oil.id): Decimal('1.0'),
+                                      (steak_id, garlic.id): Decimal('2.0'),
+                                      (salad_id, garlic.id): Decimal('1.5')})
+
+        load_recipes([record('More Garlic', [
+            {'food_name': 'Garlic', 'quantity': 3.0, 'unit': 'Clove', 'food_category': VEGETABLES}])])
+        self.assertEqual(Ingredient.query.filter_by(food_name='Garlic').count(), 1)
+        self.assertEqual(Conversion.query.filter_by(unit_from='Clove').count(), 1)
+
+    def test_load_recipes_rolls_back(self):
+        broken = record('Broken', [{'food_name': 'Garlic', 'quantity': 1.0, 'unit': 'Clove', 'food_category': VEGETABLES}])
+        del broken['title']
+
+        with self.assertRaises(KeyError):
+            load_recipes([record('Fine', []), broken])
+
+        self.assertEqual(Recipe.query.count(), 0)
+        self.assertEqual(Ingredient.query.count(), 1)
+        self.assertIsNone(Category.query.get(11))
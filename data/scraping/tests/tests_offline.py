@@ -0,0 +1,67 @@
+"""Offline parse-only mode tests."""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+from unittest import TestCase
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(HERE, 'fixtures')
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', '..', '..', 'app'))
+
+from scrape import RecipeParser
+from offline import parse_directory, categories_by_slug
+
+with open(os.path.join(FIXTURES, 'meal.html')) as f:
+    MEAL_HTML = f.read()
+
+
+class OfflineParseTestCase(TestCase):
+    """Test parsing saved pages without network access."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_strained_parse_matches_full_parse(self):
+        full = RecipeParser()
+        full.set_html(MEAL_HTML, 'beef')
+        full.parseRecipe()
+        strained = RecipeParser()
+        strained.set_html(MEAL_HTML, 'beef', strained=True)
+        strained.parseRecipe()
+
+        self.assertEqual(strained.as_record(), full.as_record())
+        self.assertEqual(strained.title, 'Garlic Butter Steak')
+        self.assertIsNone(strained.soup.find(class_='site-header'))
+
+    def test_parse_directory(self):
+        html_dir = os.path.join(self.tmp, 'html')
+        os.mkdir(html_dir)
+        for slug in ['garlic-butter-steak', 'steak-frites']:
+            shutil.copy(os.path.join(FIXTURES, 'meal.html'), os.path.join(html_dir, f'{slug}.html'))
+        with open(os.path.join(html_dir, 'not-a-meal.html'), 'w') as f:
+            f.write('<html><body>Page not found</body></html>')
+        urls_path = os.path.join(self.tmp, 'urls.txt')
+        with open(urls_path, 'w') as f:
+            json.dump([['https://www.homechef.com/meals/garlic-butter-steak', 'beef'],
+                       ['https://www.homechef.com/meals/steak-frites/', 'pork']], f)
+        out_path = os.path.join(self.tmp, 'records.jsonl')
+
+        parsed, failed = parse_directory(html_dir, out_path, categories_by_slug(urls_path),
+                                         features='html.parser', workers=2)
+
+        self.assertEqual((parsed, failed), (2, 1))
+        with open(out_path) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([record['source'] for record in records],
+                         ['garlic-butter-steak', 'not-a-meal', 'steak-frites'])
+        self.assertEqual([record.get('category') for record in records], ['beef', None, 'pork'])
+        self.assertIn('error', records[1])
+        self.assertEqual(records[0]['ingredients'], ['1 Tbsp. Olive Oil', '2 Garlic Cloves'])
+        self.assertEqual(records[2]['total_time'], '35')
@@ -0,0 +1,350 @@
+"""Crawl pipeline tests, run offline against a local stub server."""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import tempfile
+import io
+import threading
+from unittest import TestCase
+from contextlib import redirect_stdout
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(HERE, 'fixtures')
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', '..', '..', 'app'))
+
+import scrape
+from pipeline import Fetcher, CrawlPipeline, TokenBucket, FetchError
+from api_cache import ApiCache, NoResult
+from crawl_state import CrawlState, DONE, UNPARSEABLE, FAILED, CHANGED
+
+with open(os.path.join(FIXTURES, 'meal.html')) as f:
+    MEAL_HTML = f.read()
+with open(os.path.join(FIXTURES, 'api_responses.json')) as f:
+    API_RESPONSES = json.load(f)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Serves the saved fixtures in place of Home Chef, Edamam and USDA."""
+    failures = {}
+    requests_seen = []
+    # Extra markup appended to a page, to simulate it changing
+    changes = {}
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.requests_seen.append(url.path)
+        if self.failures.get(url.path, 0) > 0:
+            self.failures[url.path] -= 1
+            return self.respond(503, 'text/plain', 'try again')
+
+        if url.path == '/meals/steak':
+            return self.respond_page(MEAL_HTML + self.changes.get(url.path, ''))
+        if url.path == '/meals/mystery':
+            return self.respond_page(MEAL_HTML.replace('2 Garlic Cloves Info', '1 Mystery Sauce'))
+        if url.path == '/meals/garbled':
+            return self.respond_page(MEAL_HTML.replace('2 Garlic Cloves Info', '1 Garbled Sauce'))
+        if url.path == '/edamam' and params.get('ingr') == '1 Garbled Sauce':
+            return self.respond(200, 'text/html', '<html>Service unavailable</html>')
+        if url.path == '/edamam' and params.get('ingr') in API_RESPONSES['edamam']:
+            return self.respond_json(API_RESPONSES['edamam'][params['ingr']])
+        if url.path == '/usda/search' and params.get('generalSearchInput') in API_RESPONSES['usda_search']:
+            return self.respond_json(API_RESPONSES['usda_search'][params['generalSearchInput']])
+        if url.path.startswith('/usda/food/') and url.path.split('/')[-1] in API_RESPONSES['usda_food']:
+            return self.respond_json(API_RESPONSES['usda_food'][url.path.split('/')[-1]])
+        self.respond(404, 'text/plain', 'not found')
+
+    def respond_page(self, html):
+        etag = '"' + hashlib.sha1(html.encode()).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            return self.respond(304, 'text/html', '')
+        self.respond(200, 'text/html', html, {'ETag': etag})
+
+    def respond_json(self, data):
+        self.respond(200, 'application/json', json.dumps(data))
+
+    def respond(self, status, content_type, body, headers={}):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CrawlPipelineTestCase(TestCase):
+    """Test the crawl pipeline end to end, short of the database commit."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), StubHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}'
+        cls.saved_urls = (scrape.EDAMAM_PARSER_URL, scrape.USDA_SEARCH_URL, scrape.USDA_FOOD_URL)
+        scrape.EDAMAM_PARSER_URL = f'{cls.base_url}/edamam'
+        scrape.USDA_SEARCH_URL = f'{cls.base_url}/usda/search'
+        scrape.USDA_FOOD_URL = cls.base_url + '/usda/food/{fdc_id}'
+
+    @classmethod
+    def tearDownClass(cls):
+        scrape.EDAMAM_PARSER_URL, scrape.USDA_SEARCH_URL, scrape.USDA_FOOD_URL = cls.saved_urls
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StubHandler.failures.clear()
+        StubHandler.requests_seen.clear()
+        StubHandler.changes.clear()
+        self.committed = []
+        self.done = []
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.fetcher = Fetcher(per_host=2, retries=2, backoff=0.01, timeout=5)
+
+    def tearDown(self):
+        # Lookups still running for a page that failed would reach the next test's stub
+        pending = asyncio.all_tasks(self.loop)
+        if pending:
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        self.fetcher.close()
+        self.loop.close()
+
+    def crawl(self, targets, cache=None, state=None):
+        pipeline = CrawlPipeline(self.fetcher, commit=self.committed.append,
+                                 on_done=lambda url, category, error: self.done.append(url),
+                                 concurrency=4, cache=cache, state=state)
+        return self.loop.run_until_complete(pipeline.run(targets))
+
+    def test_crawl_recipe(self):
+        url = f'{self.base_url}/meals/steak'
+        results = self.crawl([(url, 'beef')])
+
+        self.assertEqual(results, {url: None})
+        self.assertEqual(self.done, [url])
+        self.assertEqual(len(self.committed), 1)
+        parser = self.committed[0]
+        self.assertEqual(parser.title, 'Garlic Butter Steak')
+        self.assertEqual(parser.category, 'beef')
+        self.assertEqual(parser.difficulty, '2')
+        self.assertEqual(parser.spice, '1')
+        self.assertEqual(parser.total_time, '35')
+        self.assertEqual(parser.image_url, 'https://example.com/steak-large.jpg')
+        self.assertEqual(parser.steps, ['Season the steak.', 'Sear in olive oil with garlic.'])
+        self.assertEqual(parser.ingredients_parsed, [
+            {'food_name': 'Olive Oil', 'quantity': 1.0, 'unit': 'Tablespoon',
+             'food_category': {'id': 4, 'description': 'Fats and Oils'}},
+            {'food_name': 'Garlic', 'quantity': 2.0, 'unit': 'Clove',
+             'food_category': {'id': 11, 'description': 'Vegetables and Vegetable Products'}}])
+
+    def test_crawl_failures(self):
+        steak = f'{self.base_url}/meals/steak'
+        mystery = f'{self.base_url}/meals/mystery'
+        missing = f'{self.base_url}/meals/missing'
+        results = self.crawl([(steak, 'beef'), (mystery, 'beef'), (missing, 'pork')])
+
+        self.assertIsNone(results[steak])
+        self.assertIsInstance(results[mystery], LookupError)
+        self.assertIsNotNone(results[missing])
+        self.assertEqual(sorted(self.done), sorted([steak, mystery, missing]))
+        self.assertEqual([parser.title for parser in self.committed], ['Garlic Butter Steak'])
+
+    def test_crawl_non_json_api_body(self):
+        steak = f'{self.base_url}/meals/steak'
+        garbled = f'{self.base_url}/meals/garbled'
+        targets = [(garbled, 'beef'), (steak, 'beef')]
+        with tempfile.TemporaryDirectory() as tmp:
+            state = CrawlState(os.path.join(tmp, 'crawl_state.sqlite'))
+            results = self.crawl(targets, state=state)
+            statuses = [state.status(url) for url, category in targets]
+            state.close()
+
+        self.assertIsInstance(results[garbled], ValueError)
+        self.assertIsNone(results[steak])
+        self.assertEqual(statuses, [FAILED, DONE])
+        self.assertEqual(sorted(self.done), sorted([steak, garbled]))
+        self.assertEqual([parser.title for parser in self.committed], ['Garlic Butter Steak'])
+
+    def test_persist_image_download_failure(self):
+        output = io.StringIO()
+        with tempfile.TemporaryDirectory() as tmp, redirect_stdout(output):
+            # Nothing listens on the discard port
+            self.assertIsNone(scrape.persist_image(tmp, 'http://127.0.0.1:9/steak.png'))
+            self.assertEqual(os.listdir(tmp), [])
+        self.assertIn('Could not download', output.getvalue())
+        self.assertNotIn('Could not save', output.getvalue())
+
+    def test_retry_with_backoff(self):
+        StubHandler.failures['/meals/steak'] = 2
+        url = f'{self.base_url}/meals/steak'
+        results = self.crawl([(url, 'beef')])
+
+        self.assertEqual(results, {url: None})
+        self.assertEqual(StubHandler.requests_seen.count('/meals/steak'), 3)
+
+        StubHandler.failures['/meals/steak'] = 3
+        with self.assertRaises(FetchError):
+            self.loop.run_until_complete(self.fetcher.get(url))
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=1000, capacity=2)
+
+        async def drain():
+            for _ in range(5):
+                await bucket.acquire()
+            return bucket.tokens
+
+        self.assertLess(self.loop.run_until_complete(drain()), 1)
+
+    def test_crawl_with_api_cache(self):
+        steak = f'{self.base_url}/meals/steak'
+        mystery = f'{self.base_url}/meals/mystery'
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = ApiCache(os.path.join(tmp, 'api_cache.sqlite'))
+            self.crawl([(steak, 'beef'), (mystery, 'beef')], cache=cache)
+            self.assertEqual(cache.stats()['entries'], {'edamam': 3, 'usda': 2})
+
+            StubHandler.requests_seen.clear()
+            results = self.crawl([(steak, 'beef'), (mystery, 'beef')], cache=cache)
+            cache.close()
+
+        self.assertIsNone(results[steak])
+        self.assertIsInstance(results[mystery], NoResult)
+        self.assertEqual(sorted(StubHandler.requests_seen), ['/meals/mystery', '/meals/steak'])
+        self.assertEqual(self.committed[0].ingredients_parsed, self.committed[1].ingredients_parsed)
+
+    def test_crawl_with_state(self):
+        steak = f'{self.base_url}/meals/steak'
+        mystery = f'{self.base_url}/meals/mystery'
+        missing = f'{self.base_url}/meals/missing'
+        targets = [(steak, 'beef'), (mystery, 'beef'), (missing, 'pork')]
+        with tempfile.TemporaryDirectory() as tmp:
+            state = CrawlState(os.path.join(tmp, 'crawl_state.sqlite'))
+            self.crawl(state.pending(targets), state=state)
+            self.assertEqual([state.status(url) for url, category in targets], [DONE, UNPARSEABLE, FAILED])
+            self.assertEqual(state.pending(targets), [(missing, 'pork')])
+
+            StubHandler.requests_seen.clear()
+            self.crawl(state.pending(targets, refetch=True), state=state)
+            self.assertEqual(len(self.committed), 1)
+            self.assertEqual(sorted(StubHandler.requests_seen), ['/meals/missing', '/meals/steak'])
+            self.assertEqual(state.status(steak), DONE)
+
+            StubHandler.changes['/meals/steak'] = '<!-- new photo -->'
+            self.crawl(state.pending(targets, refetch=True), state=state)
+            state.close()
+
+        self.assertEqual(len(self.committed), 1)
+        self.assertEqual(state.status(steak), CHANGED)
+
+
+class CrawlStateTestCase(TestCase):
+    """Test the crawl state store."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'crawl_state.sqlite')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_import_legacy(self):
+        visited = os.path.join(self.tmp.name, 'visited_urls.txt')
+        unparseable = os.path.join(self.tmp.name, 'unparseable_urls.txt')
+        with open(visited, 'w') as f:
+            json.dump([['https://www.homechef.com/meals/a', 'beef'], ['https://www.homechef.com/meals/b', 'pork']], f)
+        with open(unparseable, 'w') as f:
+            json.dump([['https://www.homechef.com/meals/c', 'beef']], f)
+
+        state = CrawlState(self.path)
+        state.mark('https://www.homechef.com/meals/b', 'pork', FAILED)
+        self.assertEqual(state.import_legacy(visited, unparseable), 2)
+        self.assertEqual(state.import_legacy(visited, unparseable), 0)
+        state.close()
+
+        state = CrawlState(self.path)
+        self.assertEqual(state.counts(), {DONE: 1, FAILED: 1, UNPARSEABLE: 1})
+        self.assertIn('https://www.homechef.com/meals/a', state)
+        targets = [('https://www.homechef.com/meals/a', 'beef'), ('https://www.homechef.com/meals/b', 'pork'),
+                   ('https://www.homechef.com/meals/c', 'beef'), ('https://www.homechef.com/meals/d', 'seafood')]
+        self.assertEqual(state.pending(targets), targets[1:2] + targets[3:])
+        self.assertEqual(state.pending(targets, refetch=True), targets[:2] + targets[3:])
+        state.close()
+
+    def test_conditional_headers(self):
+        class Response():
+            content = b'<html></html>'
+            headers = {'ETag': '"v1"', 'Last-Modified': 'Sat, 01 Aug 2020 00:00:00 GMT'}
+
+        state = CrawlState(self.path)
+        state.mark('https://www.homechef.com/meals/a', 'beef', FAILED, response=Response())
+        self.assertEqual(state.conditional_headers('https://www.homechef.com/meals/a'), {})
+        state.mark('https://www.homechef.com/meals/a', 'beef', DONE, response=Response())
+        self.assertEqual(state.conditional_headers('https://www.homechef.com/meals/a'),
+                         {'If-None-Match': '"v1"', 'If-Modified-Since': 'Sat, 01 Aug 2020 00:00:00 GMT'})
+        self.assertEqual(state.entry('https://www.homechef.com/meals/a')['content_hash'],
+                         hashlib.sha1(b'<html></html>').hexdigest())
+        state.close()
+
+
+class ApiCacheTestCase(TestCase):
+    """Test the persistent API lookup cache."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'api_cache.sqlite')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_lookup(self):
+        calls = []
+
+        def fetch(key):
+            calls.append(key)
+            if key == 'Mystery Sauce':
+                raise NoResult
+            return ['Olive Oil', 1.0, 'Tablespoon']
+
+        cache = ApiCache(self.path)
+        self.assertEqual(cache.lookup('edamam', '1 Tbsp. Olive Oil', fetch), ['Olive Oil', 1.0, 'Tablespoon'])
+        self.assertEqual(cache.lookup('edamam', ' 1 tbsp.  olive oil', fetch), ['Olive Oil', 1.0, 'Tablespoon'])
+        for _ in range(2):
+            with self.assertRaises(NoResult):
+                cache.lookup('edamam', 'Mystery Sauce', fetch)
+        cache.close()
+
+        self.assertEqual(calls, ['1 Tbsp. Olive Oil', 'Mystery Sauce'])
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.negative_hits, 1)
+        self.assertEqual(cache.misses, 2)
+
+        cache = ApiCache(self.path)
+        self.assertEqual(cache.get('edamam', '1 tbsp. olive oil'), (True, ['Olive Oil', 1.0, 'Tablespoon']))
+        self.assertEqual(cache.get('usda', '1 tbsp. olive oil'), (False, None))
+        self.assertEqual(cache.stats()['hit_rate'], 0.5)
+        cache.close()
+
+    def test_expiry(self):
+        cache = ApiCache(self.path, ttl=0.05, negative_ttl=None)
+        cache.set('usda', 'Garlic', {'id': 11})
+        cache.set('usda', 'Mystery Sauce', None)
+        self.assertEqual(cache.get('usda', 'Garlic'), (True, {'id': 11}))
+        time.sleep(0.1)
+
+        self.assertEqual(cache.get('usda', 'Garlic'), (False, None))
+        self.assertEqual(cache.get('usda', 'Mystery Sauce'), (True, None))
+        self.assertEqual(cache.purge_expired(), 1)
+        self.assertEqual(cache.stats()['entries'], {'usda': 1})
+        cache.close()
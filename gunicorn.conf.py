@@ -0,0 +1,27 @@
+"""
+Gunicorn settings.
+
+The app is imported once in the master process and forked into the
+workers, so workers boot without re-importing Flask, SQLAlchemy and
+the models. Importing the app opens no database connections, but
+each worker still disposes the engine after the fork so that it
+builds its own connection pool rather than sharing sockets with the
+master. The sqlite cache backends likewise open their connection on
+first use in each process, never in the master.
+
+Each worker thread holds at most one pooled connection at a time, so
+DB_POOL_SIZE should be at least GUNICORN_THREADS, and workers times
+DB_POOL_SIZE + DB_MAX_OVERFLOW must stay below the server's
+max_connections (or pgbouncer's pool size).
+"""
+
+import os
+
+preload_app = True
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+
+
+def post_fork(server, worker):
+    from models import db
+    db.engine.dispose()